@@ -0,0 +1,49 @@
+"""Benchmark of the limit utilization on a trace of mixed-size reservations with and without backfill.
+
+  poetry run python -m benchmarks.bench_backfill_utilization
+"""
+import asyncio
+import random
+import time
+
+from typing import List
+
+from multi_rate_limit import MultiRateLimit, RateLimit
+
+
+LIMIT = 8000
+PERIOD = 0.1
+
+
+async def work():
+  await asyncio.sleep(0.005)
+  return None, None
+
+
+def trace(count: int) -> List[int]:
+  # Mostly small calls, with some as large as half the limit
+  rand = random.Random(0)
+  return [LIMIT // 2 if rand.random() < 0.1 else rand.randint(1, 100) for _ in range(count)]
+
+
+async def bench(sizes: List[int], backfill_depth: int) -> float:
+  mrl = await MultiRateLimit.create([[RateLimit(LIMIT, PERIOD)]], None, 32, backfill_depth=backfill_depth)
+  start = time.time()
+  tickets = mrl.reserve_many([([size], work()) for size in sizes])
+  await asyncio.gather(*[t.future for t in tickets])
+  seconds = time.time() - start
+  await mrl.term()
+  return seconds
+
+
+async def main():
+  sizes = trace(1000)
+  print(f'{"backfill depth":>15} {"seconds":>8} {"utilization %":>14}')
+  for backfill_depth in [0, 4, 16, 64]:
+    seconds = await bench(sizes, backfill_depth)
+    utilization = sum(sizes) / (LIMIT * seconds / PERIOD)
+    print(f'{backfill_depth:>15} {seconds:>8.3f} {utilization * 100:>14.1f}')
+
+
+if __name__ == '__main__':
+  asyncio.run(main())
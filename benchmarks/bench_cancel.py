@@ -0,0 +1,75 @@
+"""Benchmark of canceling many waiting reservations in NextResourceQueue.
+
+Cancel 10% of the queued items at random and then pop the rest,
+compared with the former strict FIFO queue that looked for the smallest number on every cancel.
+
+  poetry run python -m benchmarks.bench_cancel
+"""
+import random
+import time
+
+from typing import List
+
+from multi_rate_limit.resource_queue import NextResourceQueue
+
+
+class FormerNextResourceQueue:
+  # The former implementation, only with what this benchmark uses
+  def __init__(self, len_resource: int):
+    self.number_to_resource_coro_future = {}
+    self.next_add = 0
+    self.next_run = 0
+    self.sum_resources = [0 for _ in range(len_resource)]
+
+  def push(self, use_resources, coro, future):
+    pos = self.next_add
+    self.number_to_resource_coro_future[pos] = use_resources, coro, future
+    self.next_add += 1
+    self.sum_resources = [x + y for x, y in zip(self.sum_resources, use_resources)]
+    return pos
+
+  def pop(self):
+    while self.next_run < self.next_add:
+      val = self.number_to_resource_coro_future.pop(self.next_run, None)
+      self.next_run += 1
+      if val is not None:
+        self.sum_resources = [x - y for x, y in zip(self.sum_resources, val[0])]
+        return val
+    return None
+
+  def cancel(self, number):
+    val = self.number_to_resource_coro_future.pop(number, None)
+    if val is None:
+      return None
+    self.sum_resources = [x - y for x, y in zip(self.sum_resources, val[0])]
+    is_next_pop = len(self.number_to_resource_coro_future) == 0 or number < min([n for n in self.number_to_resource_coro_future.keys()])
+    return (*val, is_next_pop)
+
+
+def bench(queue, count: int, numbers: List[int]) -> List[float]:
+  for _ in range(count):
+    queue.push([1], None, None)
+  start = time.perf_counter()
+  for number in numbers:
+    queue.cancel(number)
+  cancel_seconds = time.perf_counter() - start
+  start = time.perf_counter()
+  while queue.pop() is not None:
+    pass
+  return [cancel_seconds, time.perf_counter() - start]
+
+
+def main():
+  print(f'{"queue":>8} {"queued":>9} {"canceled":>9} {"cancel s":>9} {"us/cancel":>10} {"drain s":>8}')
+  for count in [10000, 100000, 1000000]:
+    numbers = random.Random(0).sample(range(count), count // 10)
+    queues = [('former', FormerNextResourceQueue(1))] if count <= 100000 else []
+    queues.append(('new', NextResourceQueue(1)))
+    for name, queue in queues:
+      cancel_seconds, drain_seconds = bench(queue, count, numbers)
+      print(f'{name:>8} {count:>9} {len(numbers):>9} {cancel_seconds:>9.3f} {cancel_seconds * 1e6 / len(numbers):>10.3f}'
+          f' {drain_seconds:>8.3f}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,39 @@
+"""Benchmark of the scheduler cost per completion against the number of concurrent coroutines.
+
+  poetry run python -m benchmarks.bench_completion_scaling
+"""
+import asyncio
+import random
+import time
+
+from multi_rate_limit import MultiRateLimit, RateLimit
+
+
+async def work(run_seconds: float):
+  await asyncio.sleep(run_seconds)
+  return None, None
+
+
+async def bench(max_async_run: int, rounds: int) -> float:
+  mrl = await MultiRateLimit.create([[RateLimit(10 ** 9, 1)]], None, max_async_run)
+  rand = random.Random(0)
+  tickets = [mrl.reserve([1], work(rand.random() * 1.0)) for _ in range(max_async_run * rounds)]
+  # CPU time excludes the sleeps, so that it reflects the scheduling cost
+  start = time.process_time()
+  await asyncio.gather(*[t.future for t in tickets])
+  seconds = time.process_time() - start
+  await mrl.term()
+  return seconds
+
+
+async def main():
+  rounds = 2
+  print(f'{"concurrency":>12} {"completions":>12} {"cpu s":>8} {"cpu us/completion":>18}')
+  for max_async_run in [10, 100, 1000, 10000]:
+    seconds = await bench(max_async_run, rounds)
+    completions = max_async_run * rounds
+    print(f'{max_async_run:>12} {completions:>12} {seconds:>8.3f} {seconds * 1e6 / completions:>18.1f}')
+
+
+if __name__ == '__main__':
+  asyncio.run(main())
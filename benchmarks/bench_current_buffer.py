@@ -0,0 +1,139 @@
+"""Benchmark of starting and ending in CurrentResourceBuffer against max_async_run.
+
+Measure the time in microseconds per pair of end and start, in random order so that empty positions are scattered.
+Compare with the former buffer of parallel lists searched linearly from the last position,
+which also mapped tasks to positions through their names.
+
+  poetry run python -m benchmarks.bench_current_buffer
+"""
+import asyncio
+import random
+import time
+
+from asyncio import create_task
+from typing import Callable, List, Tuple
+
+from multi_rate_limit.resource_queue import CurrentResourceBuffer
+
+
+class FormerCurrentResourceBuffer:
+  # The former implementation, only with what this benchmark uses
+  def __init__(self, len_resource: int, max_async_run: int):
+    self.resource_buffer = [None for i in range(max_async_run)]
+    self.task_buffer = [None for i in range(max_async_run)]
+    self.future_buffer = [None for i in range(max_async_run)]
+    self.start_time_buffer = [None for i in range(max_async_run)]
+    self.next = 0
+    self.active_run = 0
+    self.sum_resources = [0 for _ in range(len_resource)]
+
+  def is_full(self):
+    return self.active_run >= len(self.resource_buffer)
+
+  def start_coroutine(self, use_resources, coro, future, done_callback=None, start_time=None):
+    if self.is_full():
+      return False
+    pos = self._empty_position()
+    task = create_task(coro, name=pos)
+    self._occupy(pos, use_resources, task, future, start_time)
+    return True
+
+  def start_slot(self, use_resources, start_time=None):
+    if self.is_full():
+      return None
+    pos = self._empty_position()
+    self._occupy(pos, use_resources, None, None, start_time)
+    return pos
+
+  def position(self, task):
+    return int(task.get_name())
+
+  def end_slot(self, pos):
+    use_resources = self.resource_buffer[pos]
+    self._release(pos)
+    return use_resources
+
+  def _empty_position(self):
+    pos = self.next
+    while True:
+      if self.resource_buffer[pos] is None:
+        return pos
+      pos = (pos + 1) % len(self.resource_buffer)
+
+  def _occupy(self, pos, use_resources, task, future, start_time):
+    self.resource_buffer[pos] = use_resources
+    self.task_buffer[pos] = task
+    self.future_buffer[pos] = future
+    self.start_time_buffer[pos] = start_time
+    self.next = (pos + 1) % len(self.resource_buffer)
+    self.active_run += 1
+    self.sum_resources = [x + y for x, y in zip(self.sum_resources, use_resources)]
+
+  def _release(self, pos):
+    self.sum_resources = [x - y for x, y in zip(self.sum_resources, self.resource_buffer[pos])]
+    self.resource_buffer[pos] = None
+    self.task_buffer[pos] = None
+    self.future_buffer[pos] = None
+    self.start_time_buffer[pos] = None
+    self.active_run -= 1
+
+  def end_coroutine(self, use_time, finished_task):
+    pos = self.position(finished_task)
+    use_resources = self.resource_buffer[pos]
+    overwrite_time_resources, result = finished_task.result()
+    self.future_buffer[pos].set_result(result)
+    self._release(pos)
+    return use_time, use_resources
+
+
+async def noop():
+  return None, None
+
+
+def bench_slots(buf, max_async_run: int, rounds: int) -> float:
+  # Keep the buffer full, and replace one at a time at a random position
+  rand = random.Random(0)
+  positions = [buf.start_slot([1, 2]) for _ in range(max_async_run)]
+  order = [rand.randrange(max_async_run) for _ in range(rounds)]
+  resources = [1, 2]
+  start = time.perf_counter()
+  for i in order:
+    buf.end_slot(positions[i])
+    positions[i] = buf.start_slot(resources)
+  return (time.perf_counter() - start) * 1e6 / rounds
+
+
+async def bench_tasks(buf, max_async_run: int, rounds: int) -> float:
+  # Start, let finish and end coroutines in random order, timing only the buffer
+  loop = asyncio.get_running_loop()
+  rand = random.Random(0)
+  seconds = 0.0
+  for _ in range(rounds):
+    futures = [loop.create_future() for _ in range(max_async_run)]
+    start = time.perf_counter()
+    for future in futures:
+      buf.start_coroutine([1, 2], noop(), future)
+    seconds += time.perf_counter() - start
+    tasks = [*asyncio.all_tasks() - {asyncio.current_task()}]
+    await asyncio.wait(tasks)
+    rand.shuffle(tasks)
+    start = time.perf_counter()
+    for task in tasks:
+      buf.end_coroutine(0, task)
+    seconds += time.perf_counter() - start
+  return seconds * 1e6 / (rounds * max_async_run)
+
+
+async def main():
+  print(f'{"buffer":>8} {"max_async_run":>14} {"slot us":>8} {"task us":>8}')
+  for max_async_run in [100, 1000, 10000]:
+    factories: List[Tuple[str, Callable]] = [('former', FormerCurrentResourceBuffer), ('new', CurrentResourceBuffer)]
+    for name, factory in factories:
+      # The former linear search takes too long with many rounds
+      slot_us = bench_slots(factory(2, max_async_run), max_async_run, 10000000 // max_async_run)
+      task_us = await bench_tasks(factory(2, max_async_run), max_async_run, max(1, 20000 // max_async_run))
+      print(f'{name:>8} {max_async_run:>14} {slot_us:>8.3f} {task_us:>8.3f}')
+
+
+if __name__ == '__main__':
+  asyncio.run(main())
@@ -0,0 +1,62 @@
+"""Benchmark of the latency from MultiRateLimit.reserve() to the start of the coroutine.
+
+  poetry run python -m benchmarks.bench_dispatch_latency
+"""
+import asyncio
+import statistics
+import time
+
+from typing import List
+
+from multi_rate_limit import MultiRateLimit, RateLimit
+
+
+async def work(reserved_at: float, latencies: List[float], run_seconds: float):
+  latencies.append(time.perf_counter() - reserved_at)
+  await asyncio.sleep(run_seconds)
+  return None, None
+
+
+async def bench_idle(count: int) -> List[float]:
+  # One reservation at a time on an idle limiter
+  mrl = await MultiRateLimit.create([[RateLimit(10 ** 9, 1)]], None, 1)
+  latencies: List[float] = []
+  for _ in range(count):
+    await mrl.reserve([1], work(time.perf_counter(), latencies, 0)).future
+  await mrl.term()
+  return latencies
+
+
+async def bench_burst(bursts: int, burst_size: int) -> List[float]:
+  # Bursts of reservations, with enough concurrency to run all of them at once
+  mrl = await MultiRateLimit.create([[RateLimit(10 ** 9, 1)]], None, bursts * burst_size)
+  latencies: List[float] = []
+  tickets = []
+  for _ in range(bursts):
+    for _ in range(burst_size):
+      tickets.append(mrl.reserve([1], work(time.perf_counter(), latencies, 0.01)))
+    # Let the scheduler run between bursts
+    await asyncio.sleep(0)
+  await asyncio.gather(*[t.future for t in tickets])
+  await mrl.term()
+  return latencies
+
+
+def print_result(name: str, total: float, latencies: List[float]):
+  quantiles = statistics.quantiles(latencies, n=100)
+  print(f'{name:>16} {len(latencies):>9} {total:>8.3f} {quantiles[49] * 1e3:>8.3f} {quantiles[98] * 1e3:>8.3f}')
+
+
+async def main():
+  print(f'{"scenario":>16} {"reserves":>9} {"total s":>8} {"p50 ms":>8} {"p99 ms":>8}')
+  start = time.perf_counter()
+  latencies = await bench_idle(5000)
+  print_result('idle', time.perf_counter() - start, latencies)
+  for bursts, burst_size in [(100, 10), (100, 100)]:
+    start = time.perf_counter()
+    latencies = await bench_burst(bursts, burst_size)
+    print_result(f'burst {bursts}x{burst_size}', time.perf_counter() - start, latencies)
+
+
+if __name__ == '__main__':
+  asyncio.run(main())
@@ -0,0 +1,53 @@
+"""Benchmark of FilePastResourceQueue.create against the file size.
+
+Compare the tail-only startup with reading the whole file as FilePastResourceQueue did before.
+
+  poetry run python -m benchmarks.bench_file_startup
+"""
+import aiofiles
+import asyncio
+import os
+import tempfile
+import time
+
+from multi_rate_limit import FilePastResourceQueue
+
+
+async def create_by_full_read(file_path: str) -> FilePastResourceQueue:
+  # Former startup: parse every line, then rewrite the whole file before returning.
+  queue = FilePastResourceQueue(2, 60)
+  queue._file_path = file_path
+  async with aiofiles.open(file_path) as f:
+    async for line in f:
+      queue._append(*queue._parse_line(line))
+  queue._trim()
+  await queue._write_file(file_path, list(queue))
+  return queue
+
+
+def write_file(file_path: str, lines: int) -> None:
+  with open(file_path, 'w') as f:
+    for i in range(1, lines + 1):
+      f.write(f'{float(i)}\t{i}\t{2 * i}\n')
+
+
+async def main():
+  print(f'{"lines":>10} {"full read ms":>13} {"tail read ms":>13}')
+  with tempfile.TemporaryDirectory() as dir:
+    file_path = os.path.join(dir, 'bench.tsv')
+    for lines in [1000, 10000, 100000, 1000000]:
+      write_file(file_path, lines)
+      start = time.perf_counter()
+      await create_by_full_read(file_path)
+      full_seconds = time.perf_counter() - start
+      write_file(file_path, lines)
+      start = time.perf_counter()
+      queue = await FilePastResourceQueue.create(2, 60, file_path)
+      tail_seconds = time.perf_counter() - start
+      # Compaction continues in the background
+      await queue.term()
+      print(f'{lines:>10} {full_seconds * 1e3:>13.2f} {tail_seconds * 1e3:>13.2f}')
+
+
+if __name__ == '__main__':
+  asyncio.run(main())
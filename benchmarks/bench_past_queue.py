@@ -0,0 +1,75 @@
+"""Benchmark of IPastResourceQueue implementations held in memory.
+
+Compare ArrayPastResourceQueue with the deque based implementation that FilePastResourceQueue used before.
+
+  poetry run python -m benchmarks.bench_past_queue
+"""
+import asyncio
+import bisect
+import time
+
+from collections import deque
+from typing import List, Tuple
+
+from multi_rate_limit import ArrayPastResourceQueue, IPastResourceQueue
+
+
+class DequePastResourceQueue(IPastResourceQueue):
+  """Former in-memory part of FilePastResourceQueue, kept only as the benchmark baseline.
+  """
+
+  def __init__(self, len_resource: int, longest_period_in_seconds: float):
+    self._time_resource_queue: deque[Tuple[float, List[int]]] = deque([(0, [0 for _ in range(len_resource)])])
+    self._longest_period_in_seconds = longest_period_in_seconds
+
+  async def sum_resource_after(self, time: float, order: int) -> int:
+    pos = bisect.bisect_right(self._time_resource_queue, time, key=lambda t: t[0])
+    return self._time_resource_queue[-1][1][order] - self._time_resource_queue[max(0, pos - 1)][1][order]
+
+  async def time_accum_resource_within(self, order: int, amount: int) -> float:
+    last_amount = self._time_resource_queue[-1][1][order]
+    pos = bisect.bisect_left(self._time_resource_queue, last_amount - amount, key=lambda t: t[1][order])
+    return self._time_resource_queue[pos][0]
+
+  async def add(self, use_time: float, use_resources: List[int]) -> None:
+    last_elem = self._time_resource_queue[-1]
+    if use_time <= last_elem[0]:
+      self._time_resource_queue[-1] = last_elem[0], [x + y for x, y in zip(last_elem[1], use_resources)]
+      return
+    self._time_resource_queue.append((use_time, [x + y for x, y in zip(last_elem[1], use_resources)]))
+    last_time = self._time_resource_queue[-1][0]
+    pos = bisect.bisect_right(self._time_resource_queue, last_time - self._longest_period_in_seconds, key=lambda t: t[0])
+    for _ in range(max(0, pos - 1)):
+      self._time_resource_queue.popleft()
+
+  async def term(self) -> None:
+    pass
+
+
+async def bench(queue: IPastResourceQueue, entries: int, queries: int) -> Tuple[float, float]:
+  start = time.perf_counter()
+  for i in range(1, entries + 1):
+    await queue.add(i, [1, 2])
+  add_seconds = time.perf_counter() - start
+  start = time.perf_counter()
+  for i in range(queries):
+    await queue.sum_resource_after(entries - 3600 - i, 0)
+    await queue.time_accum_resource_within(1, 2 * i + 1)
+  query_seconds = time.perf_counter() - start
+  return add_seconds, query_seconds
+
+
+async def main():
+  queries = 10000
+  print(f'{"entries":>10} {"class":>24} {"add us/op":>10} {"query us/op":>12}')
+  for entries in [1000, 10000, 100000, 400000]:
+    for queue_class in [DequePastResourceQueue, ArrayPastResourceQueue]:
+      # Keep every entry in the period like a DayRateLimit does
+      queue = queue_class(2, 86400)
+      add_seconds, query_seconds = await bench(queue, entries, queries)
+      print(f'{entries:>10} {queue_class.__name__:>24} {add_seconds * 1e6 / entries:>10.3f}'
+          f' {query_seconds * 1e6 / (2 * queries):>12.3f}')
+
+
+if __name__ == '__main__':
+  asyncio.run(main())
@@ -0,0 +1,46 @@
+"""Benchmark of the latency of interactive reservations behind a throttled batch backlog.
+
+Compare reserving the interactive ones with the same priority as the batch and with a higher priority.
+
+  poetry run python -m benchmarks.bench_priority_latency
+"""
+import asyncio
+import statistics
+import time
+
+from typing import List
+
+from multi_rate_limit import MultiRateLimit, RateLimit
+
+
+async def work(reserved_at: float, latencies: List[float]):
+  latencies.append(time.perf_counter() - reserved_at)
+  await asyncio.sleep(0.001)
+  return None, None
+
+
+async def bench(batch: int, interactive: int, interval: float, priority: int) -> List[float]:
+  # 1000 units per second
+  mrl = await MultiRateLimit.create([[RateLimit(100, 0.1)]], None, 100)
+  batch_latencies: List[float] = []
+  latencies: List[float] = []
+  batch_tickets = mrl.reserve_many([([1], work(time.perf_counter(), batch_latencies)) for _ in range(batch)])
+  tickets = []
+  for _ in range(interactive):
+    tickets.append(mrl.reserve([1], work(time.perf_counter(), latencies), priority))
+    await asyncio.sleep(interval)
+  await asyncio.gather(*[t.future for t in tickets + batch_tickets])
+  await mrl.term()
+  return latencies
+
+
+async def main():
+  print(f'{"priority":>9} {"reserves":>9} {"p50 ms":>9} {"p99 ms":>9}')
+  for priority in [0, -1]:
+    latencies = await bench(2000, 100, 0.01, priority)
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f'{priority:>9} {len(latencies):>9} {quantiles[49] * 1e3:>9.3f} {quantiles[98] * 1e3:>9.3f}')
+
+
+if __name__ == '__main__':
+  asyncio.run(main())
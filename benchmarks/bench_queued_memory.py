@@ -0,0 +1,52 @@
+"""Benchmark of the memory footprint per waiting reservation with reserve() and reserve_lazy().
+
+  poetry run python -m benchmarks.bench_queued_memory
+"""
+import asyncio
+import gc
+import tracemalloc
+
+from multi_rate_limit import MultiRateLimit, RateLimit
+
+
+async def work(url: str, retries: int):
+  await asyncio.sleep(0)
+  return None, (url, retries)
+
+
+async def work_long():
+  await asyncio.sleep(0.1)
+  return None, None
+
+
+async def bench(count: int, lazy: bool) -> float:
+  # Nothing else can start while the first one is running, so that all the others keep waiting
+  mrl = await MultiRateLimit.create([[RateLimit(10 ** 9, 60)]], None, 1)
+  mrl.reserve([1], work_long())
+  await asyncio.sleep(0)
+  urls = [f'https://example.com/{i}' for i in range(count)]
+  gc.collect()
+  tracemalloc.start()
+  start, _ = tracemalloc.get_traced_memory()
+  if lazy:
+    for url in urls:
+      mrl.reserve_lazy([1], work, url, 3)
+  else:
+    for url in urls:
+      mrl.reserve([1], work(url, 3))
+  end, _ = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  await mrl.term(True)
+  return (end - start) / count
+
+
+async def main():
+  print(f'{"waitings":>10} {"reserve B/item":>15} {"reserve_lazy B/item":>20}')
+  for count in [1000, 10000, 100000]:
+    coro_bytes = await bench(count, False)
+    lazy_bytes = await bench(count, True)
+    print(f'{count:>10} {coro_bytes:>15.0f} {lazy_bytes:>20.0f}')
+
+
+if __name__ == '__main__':
+  asyncio.run(main())
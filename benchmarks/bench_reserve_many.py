@@ -0,0 +1,46 @@
+"""Benchmark of enqueueing many reservations with MultiRateLimit.reserve() and reserve_many().
+
+  poetry run python -m benchmarks.bench_reserve_many
+"""
+import asyncio
+import time
+
+from multi_rate_limit import MultiRateLimit, RateLimit
+
+
+async def work():
+  return None, None
+
+
+async def work_long():
+  await asyncio.sleep(0.1)
+  return None, None
+
+
+async def bench(count: int, many: bool) -> float:
+  # Nothing else can start while the first one is running, so that only the enqueueing is measured
+  mrl = await MultiRateLimit.create([[RateLimit(10 ** 9, 3600), RateLimit(10 ** 9, 86400)], [RateLimit(10 ** 9, 60)]], None, 1)
+  mrl.reserve([1, 1], work_long())
+  await asyncio.sleep(0)
+  coros = [work() for _ in range(count)]
+  start = time.perf_counter()
+  if many:
+    mrl.reserve_many([([1, 1], coro) for coro in coros])
+  else:
+    for coro in coros:
+      mrl.reserve([1, 1], coro)
+  seconds = time.perf_counter() - start
+  await mrl.term(True)
+  return seconds
+
+
+async def main():
+  print(f'{"reserves":>10} {"reserve/s":>12} {"reserve_many/s":>15}')
+  for count in [1000, 10000, 50000]:
+    single_seconds = await bench(count, False)
+    many_seconds = await bench(count, True)
+    print(f'{count:>10} {count / single_seconds:>12.0f} {count / many_seconds:>15.0f}')
+
+
+if __name__ == '__main__':
+  asyncio.run(main())
@@ -0,0 +1,68 @@
+"""Benchmark of the cost per reservation against the number of resources.
+
+Measure reserve() alone, and the CPU time per reservation from reserve() to completion with 2 limits per resource.
+Reservations use only the first resource, passed either as a dense list or as a sparse mapping,
+including the cost of building the list or the mapping.
+
+  poetry run python -m benchmarks.bench_resource_dimensions
+"""
+import asyncio
+import time
+
+from typing import Callable, List, Mapping, Union
+
+from multi_rate_limit import MultiRateLimit, RateLimit
+
+
+async def work():
+  return None, None
+
+
+def create_limits(resources: int):
+  return [[RateLimit(10 ** 9, 1), RateLimit(10 ** 12, 60)] for _ in range(resources)]
+
+
+def dense(resources: int) -> List[int]:
+  use_resources = [0] * resources
+  use_resources[0] = 1
+  return use_resources
+
+
+def sparse(resources: int) -> Mapping[int, int]:
+  return {0: 1}
+
+
+async def bench_reserve(resources: int, count: int, resources_of: Callable[[int], Union[List[int], Mapping[int, int]]]) -> float:
+  # Nothing starts while the only position is occupied
+  mrl = await MultiRateLimit.create(create_limits(resources), None, 1)
+  async with mrl.acquire(resources_of(resources)):
+    coros = [work() for _ in range(count)]
+    start = time.perf_counter()
+    for coro in coros:
+      mrl.reserve(resources_of(resources), coro)
+    seconds = time.perf_counter() - start
+  await mrl.term(True)
+  return seconds * 1e6 / count
+
+
+async def bench_run(resources: int, count: int, resources_of: Callable[[int], Union[List[int], Mapping[int, int]]]) -> float:
+  mrl = await MultiRateLimit.create(create_limits(resources), None, 100)
+  start = time.process_time()
+  tickets = [mrl.reserve(resources_of(resources), work()) for _ in range(count)]
+  await asyncio.gather(*[t.future for t in tickets])
+  seconds = time.process_time() - start
+  await mrl.term()
+  return seconds * 1e6 / count
+
+
+async def main():
+  print(f'{"resources":>10} {"format":>7} {"reserve us":>11} {"run cpu us":>11}')
+  for resources in [1, 10, 200]:
+    for name, resources_of in [('dense', dense), ('sparse', sparse)]:
+      reserve_us = await bench_reserve(resources, 10000, resources_of)
+      run_us = await bench_run(resources, 5000, resources_of)
+      print(f'{resources:>10} {name:>7} {reserve_us:>11.2f} {run_us:>11.2f}')
+
+
+if __name__ == '__main__':
+  asyncio.run(main())
@@ -0,0 +1,67 @@
+"""Benchmark of weighted fair queueing across tenants sharing one MultiRateLimit.
+
+Measure the latency of quiet tenants behind a noisy tenant's backlog with and without tenants,
+and the cost of popping from the waiting queue against the number of tenants.
+
+  poetry run python -m benchmarks.bench_tenant_fairness
+"""
+import asyncio
+import statistics
+import time
+
+from typing import List
+
+from multi_rate_limit import MultiRateLimit, RateLimit
+from multi_rate_limit.resource_queue import NextResourceQueue
+
+
+async def work(reserved_at: float, latencies: List[float]):
+  latencies.append(time.perf_counter() - reserved_at)
+  return None, None
+
+
+async def bench_latency(use_tenant: bool) -> List[float]:
+  # 1000 units per second
+  mrl = await MultiRateLimit.create([[RateLimit(100, 0.1)]], None, 100)
+  noisy_latencies: List[float] = []
+  latencies: List[float] = []
+  noisy_tickets = mrl.reserve_many([([1], work(time.perf_counter(), noisy_latencies)) for _ in range(2000)]
+      , tenant='noisy' if use_tenant else None)
+  tickets = []
+  for i in range(100):
+    tenant = f'quiet{i % 10}' if use_tenant else None
+    tickets.append(mrl.reserve([1], work(time.perf_counter(), latencies), tenant=tenant))
+    await asyncio.sleep(0.01)
+  await asyncio.gather(*[t.future for t in tickets + noisy_tickets])
+  await mrl.term()
+  return latencies
+
+
+def bench_pop(tenants: int, count: int) -> float:
+  loop = asyncio.new_event_loop()
+  future = loop.create_future()
+  queue = NextResourceQueue(1)
+  for i in range(count):
+    queue.push([1], None, future, 0, i % tenants)
+  start = time.perf_counter()
+  while queue.pop() is not None:
+    pass
+  seconds = time.perf_counter() - start
+  loop.close()
+  return seconds
+
+
+async def main():
+  print(f'{"tenants":>8} {"quiet p50 ms":>13} {"quiet p99 ms":>13}')
+  for use_tenant in [False, True]:
+    quantiles = statistics.quantiles(await bench_latency(use_tenant), n=100)
+    print(f'{"yes" if use_tenant else "no":>8} {quantiles[49] * 1e3:>13.3f} {quantiles[98] * 1e3:>13.3f}')
+  print()
+  print(f'{"tenants":>8} {"pops":>8} {"us/pop":>8}')
+  for tenants in [1, 100, 10000]:
+    count = 100000
+    print(f'{tenants:>8} {count:>8} {bench_pop(tenants, count) * 1e6 / count:>8.3f}')
+
+
+if __name__ == '__main__':
+  asyncio.run(main())
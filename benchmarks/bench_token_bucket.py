@@ -0,0 +1,45 @@
+"""Benchmark of a token bucket limit against a sliding window of a day at high request rates.
+
+Measure the CPU time per reservation from reserve() to completion, and the memory of the past queue after all of them,
+where the window keeps the history of the whole day and the token bucket keeps none.
+
+  poetry run python -m benchmarks.bench_token_bucket
+"""
+import asyncio
+import time
+
+from multi_rate_limit import ArrayPastResourceQueue, DayRateLimit, MultiRateLimit, RateLimit, TokenBucketRateLimit
+
+
+async def work():
+  return None, None
+
+
+def past_queue_bytes(queue: ArrayPastResourceQueue) -> int:
+  return len(queue._times) * queue._times.itemsize + sum([len(a) * a.itemsize for a in queue._accum_resources])
+
+
+async def bench(limit: RateLimit, count: int):
+  # One at a time, so that every request is a separate event in the past queue
+  mrl = await MultiRateLimit.create([[limit]], None, 1)
+  start = time.process_time()
+  for i in range(0, count, 1000):
+    tickets = [mrl.reserve([1], work()) for _ in range(min(1000, count - i))]
+    await asyncio.gather(*[t.future for t in tickets])
+  seconds = time.process_time() - start
+  entries = len(mrl._past_queue)
+  size = past_queue_bytes(mrl._past_queue)
+  await mrl.term()
+  return seconds * 1e6 / count, entries, size
+
+
+async def main():
+  print(f'{"limit":>12} {"requests":>9} {"cpu us":>7} {"entries":>8} {"past KiB":>9}')
+  for count in [10000, 100000, 300000]:
+    for name, limit in [('day window', DayRateLimit(10 ** 9)), ('token bucket', TokenBucketRateLimit(10 ** 9, 86400))]:
+      cpu_us, entries, size = await bench(limit, count)
+      print(f'{name:>12} {count:>9} {cpu_us:>7.2f} {entries:>8} {size / 1024:>9.1f}')
+
+
+if __name__ == '__main__':
+  asyncio.run(main())
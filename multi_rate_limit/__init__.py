@@ -1,9 +1,10 @@
 """Package for using multiple resources while observing multiple RateLimits.
 """
-from multi_rate_limit.rate_limit import RateLimit, SecondRateLimit, MinuteRateLimit, HourRateLimit, DayRateLimit
-from multi_rate_limit.rate_limit import ResourceOverwriteError
-from multi_rate_limit.rate_limit import FilePastResourceQueue, IPastResourceQueue
-from multi_rate_limit.multi_rate_limit import MultiRateLimit, RateLimitStats, ReservationTicket
+from multi_rate_limit.rate_limit import RateLimit, SecondRateLimit, MinuteRateLimit, HourRateLimit, DayRateLimit, TokenBucketRateLimit
+from multi_rate_limit.rate_limit import ReservationExpiredError, ResourceOverwriteError
+from multi_rate_limit.rate_limit import ArrayPastResourceQueue, FilePastResourceQueue, IPastResourceQueue, ISyncPastResourceQueue
+from multi_rate_limit.rate_limit import FsyncPolicy, JournalPolicy, MmapPastResourceQueue
+from multi_rate_limit.multi_rate_limit import MultiRateLimit, RateLimitStats, ReservationTicket, ResourceSlot, SchedulerStats
 
 __all__ = [
   "RateLimit",
@@ -11,12 +12,21 @@ __all__ = [
   "MinuteRateLimit",
   "HourRateLimit",
   "DayRateLimit",
+  "TokenBucketRateLimit",
+  "ReservationExpiredError",
   "ResourceOverwriteError",
+  "ArrayPastResourceQueue",
   "FilePastResourceQueue",
   "IPastResourceQueue",
+  "ISyncPastResourceQueue",
+  "FsyncPolicy",
+  "JournalPolicy",
+  "MmapPastResourceQueue",
   "MultiRateLimit",
   "RateLimitStats",
   "ReservationTicket",
+  "ResourceSlot",
+  "SchedulerStats",
 ]
 
 __copyright__    = 'Copyright 2023-present largetownsky'
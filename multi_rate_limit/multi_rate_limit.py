@@ -3,13 +3,21 @@
 import asyncio
 import time
 
-from asyncio import Future, Task
-from collections.abc import KeysView
-from dataclasses import dataclass
-from typing import Any, Callable, Coroutine, List, Optional, Tuple
+from asyncio import Future, Task, TimerHandle
+from collections import deque
+from collections.abc import KeysView, Mapping
+from dataclasses import dataclass, field
+from math import inf
+from operator import add, ge, gt, sub
+from typing import Any, AsyncIterable, AsyncIterator, Callable, Coroutine, Dict, Hashable, Iterable, List, Optional, Tuple, TypeVar, Union
 
-from multi_rate_limit.rate_limit import FilePastResourceQueue, IPastResourceQueue, RateLimit
-from multi_rate_limit.resource_queue import CurrentResourceBuffer, NextResourceQueue, check_resources
+from multi_rate_limit.rate_limit import ArrayPastResourceQueue, IPastResourceQueue, ISyncPastResourceQueue, RateLimit
+from multi_rate_limit.rate_limit import ReservationExpiredError, TokenBucketRateLimit
+from multi_rate_limit.resource_queue import CreditLedger, CurrentResourceBuffer, LazyCoroutine, NextResourceQueue, check_resources
+from multi_rate_limit.resource_queue import add_resources, check_sparse_resources, sub_resources, to_dense, TokenBuckets, within
+
+
+T = TypeVar('T')
 
 
 @dataclass
@@ -32,13 +40,18 @@ class RateLimitStats:
     limits (List[List[RateLimit]]): Resource limits
     past_uses (List[List[int]]): Total resource usage that has been executed for each resource limit.
         (For 1 minute limit, resource usage for the past 1 minute.)
+        For token bucket limits, the level of the bucket.
     current_uses (List[int]): Total running resource usage for each resource.
     next_uses (List[int]): Total waiting resource usage for each resource.
+    tenant_waitings (Dict[Hashable, int]): Number of waiting coroutines for each tenant other than None.
+    tenant_next_uses (Dict[Hashable, List[int]]): Total waiting resource usage for each tenant other than None.
   """
   limits: List[List[RateLimit]]
   past_uses: List[List[int]]
   current_uses: List[int]
   next_uses: List[int]
+  tenant_waitings: Dict[Hashable, int] = field(default_factory=dict)
+  tenant_next_uses: Dict[Hashable, List[int]] = field(default_factory=dict)
 
   def past_use_percents(self) -> List[List[float]]:
     """Returns the percentage of total executed resource usage against each resource limit.
@@ -67,21 +80,132 @@ class RateLimitStats:
         for ls, ps, c, n in zip(self.limits, self.past_uses, self.current_uses, self.next_uses)]
 
 
+@dataclass
+class SchedulerStats:
+  """Class that represents how often the internal processing has been woken up.
+
+  Attributes:
+    wakeups (int): Number of passes of the internal processing over the waiting and running coroutines.
+    dispatches (int): Number of coroutines started.
+  """
+  wakeups: int
+  dispatches: int
+
+  def wakeups_per_dispatch(self) -> float:
+    """Returns the number of wakeups per started coroutine.
+
+    Returns:
+        float: The number of wakeups per started coroutine, or 0 if nothing has been started.
+    """
+    return self.wakeups / self.dispatches if self.dispatches > 0 else 0.0
+
+
+class ResourceSlot:
+  """Class for running work in the caller's own task while holding a slot of MultiRateLimit.
+
+  Obtained from MultiRateLimit.acquire() and used with async with.
+  Entering waits until the reservation can start, in the same order as the other reservations.
+  Exiting releases the slot, and the reserved resources are considered to have been consumed at that time,
+  unless overwritten with settle().
+
+  Attributes:
+    reserve_number (Optional[int]): Number of the reservation, after starting to enter.
+  """
+  def __init__(self, mrl: 'MultiRateLimit', use_resources: Union[List[int], Dict[int, int]], priority: int = 0
+      , tenant: Hashable = None, deadline: Optional[float] = None):
+    """Create a slot to be acquired.
+
+    Args:
+        mrl (MultiRateLimit): The owner.
+        use_resources (Union[List[int], Dict[int, int]]): Resource reservation amount, or only the used ones by their indices.
+        priority (int, optional): Priority of the reservation, the smaller first. Defaults to 0.
+        tenant (Hashable, optional): Tenant of the reservation, sharing the limits fairly with the others of the same priority.
+            Defaults to None.
+        deadline (Optional[float], optional): The time compatible with time.time() by which it must start.
+            Otherwise, ReservationExpiredError is set to the future of the ticket, and the coroutine is closed.
+            The default is None, in which case it waits as long as needed.
+    """
+    self.reserve_number: Optional[int] = None
+    self._mrl = mrl
+    self._use_resources = use_resources
+    self._priority = priority
+    self._tenant = tenant
+    self._deadline = deadline
+    # Position in the current buffer while holding it
+    self._pos: Optional[int] = None
+    self._settled: Optional[Tuple[float, List[int]]] = None
+
+  def settle(self, use_time: float, use_resources: Union[List[int], Mapping[int, int]]) -> None:
+    """Overwrite the resource consumption time and amount recorded when exiting.
+
+    Args:
+        use_time (float): Resource usage time compatible with time.time().
+        use_resources (Union[List[int], Mapping[int, int]]): Resource usage amounts for each resource,
+            or only for the used resources by their indices.
+
+    Raises:
+        ValueError: In case of resources list length mismatch, invalid indices or negative values.
+    """
+    self._settled = use_time, check_resources(use_resources, len(self._mrl._limits))
+
+  async def __aenter__(self) -> 'ResourceSlot':
+    ticket = await self._mrl._add_next_wait(self._use_resources, self, self._priority, self._tenant, self._deadline)
+    self.reserve_number = ticket.reserve_number
+    try:
+      await ticket.future
+    except asyncio.CancelledError:
+      if self._pos is not None:
+        # Started but canceled before entering
+        self._mrl._on_slot_done(self)
+      elif not self._mrl.termed():
+        self._mrl.cancel(ticket.reserve_number)
+      raise
+    return self
+
+  async def __aexit__(self, exc_type, exc_value, traceback) -> bool:
+    self._mrl._on_slot_done(self)
+    return False
+
+
 class MultiRateLimit:
   """Class for using multiple resources while observing multiple RateLimits.
 
   Attributes:
     _limits (List[List[RateLimit]]): Resource limits.
+    _limit_values (List[List[int]]): Resource limit values of the sliding windows, without the token buckets.
+    _limit_periods (List[List[float]]): Resource limit periods in seconds of the sliding windows, without the token buckets.
+    _min_limits (List[int]): The smallest resource limit value for each resource.
+    _buckets (Optional[TokenBuckets]): State of the token bucket limits, if any.
     _past_queue (IPastResourceQueue): Executed resource usage manager.
+    _sync_past_queue (Optional[ISyncPastResourceQueue]): The same manager if it can be queried without waiting.
     _current_buffer (CurrentResourceBuffer): Running resource usage manager.
     _next_queue (NextResourceQueue): Waiting resource usage manager.
     _loop (AbstractEventLoop): Cached event loop.
     _in_process (Optional[Task]): Asynchronous execution tasks for internal processing.
+    _wakeup (Future[None]): Future to notify internal processing that the state may have changed.
+    _done_tasks (deque[Union[Task, ResourceSlot]]): Finished tasks reported by their done callbacks
+        and released slots, waiting to be processed.
+    _timer (Optional[TimerHandle]): Timer to resolve the wakeup future when the first waiting coroutine can start.
+    _timer_deadline (Optional[float]): The time compatible with time.time() that the timer is armed for.
+    _wakeups (int): Number of passes of the internal processing.
+    _dispatches (int): Number of coroutines started.
+    _max_waiting (Optional[int]): Maximum number of waiting coroutines.
+    _max_waiting_resources (Optional[List[int]]): Maximum total resource reservation amount of waiting coroutines.
+    _reserve_waiters (deque[Tuple[Future[None], Union[List[int], Dict[int, int]]]]): Futures and resource reservation amounts of
+        reserve_wait() calls waiting for space in the waiting queue, in order.
+    _charge_at_dispatch (bool): Whether the reserved resources are recorded as used when each coroutine starts.
+    _no_resources (List[int]): Zeros for each resource, as the running resource usage if charged at dispatch.
+    _credit_ledger (Optional[CreditLedger]): Refunds of resources charged at dispatch, if charged at dispatch.
+    _backfill_depth (int): Number of waiting coroutines behind the first one that may start before it.
+    _expire_on_prediction (bool): Whether the first waiting coroutine is expired when it is predicted to miss its deadline.
     _terminated (bool): Whether term() has been called.
   """
   @classmethod
   async def create(cls, limits: List[List[RateLimit]]
-      , past_queue_factory: Callable[[int, float], Coroutine[Any, Any, IPastResourceQueue]] = None, max_async_run = 1):
+      , past_queue_factory: Callable[[int, float], Coroutine[Any, Any, IPastResourceQueue]] = None, max_async_run = 1
+      , max_waiting: Optional[int] = None, max_waiting_resources: Optional[List[int]] = None
+      , charge_at_dispatch: bool = False, backfill_depth: int = 0, tenant_weights: Optional[Dict[Hashable, float]] = None
+      , expire_on_prediction: bool = False):
     """Create an object for using multiple resources while observing multiple RateLimits.
 
     Args:
@@ -90,26 +214,80 @@ class MultiRateLimit:
             Pass the factory method to make the executed resource usage manager.
             The default is None, in which case it is managed only in memory.
         max_async_run (int, optional): Maximum asynchronous concurrency. Defaults to 1.
+        max_waiting (Optional[int], optional): Maximum number of waiting coroutines.
+            The default is None, in which case it is unlimited.
+        max_waiting_resources (Optional[List[int]], optional): Maximum total resource reservation amount of waiting coroutines.
+            A single reservation exceeding it is accepted only when nothing is waiting.
+            The default is None, in which case it is unlimited.
+        charge_at_dispatch (bool, optional): If true, the reserved resources are recorded as used when each coroutine starts,
+            and the difference from the overwritten usage is settled when it finishes.
+            A shortage is charged at the overwritten time, and an excess is refunded from the start time.
+            Otherwise, usage is recorded when each coroutine finishes. Defaults to False.
+        backfill_depth (int, optional): While the first waiting coroutine cannot start,
+            up to this number of coroutines behind it are checked, and started if they fit now
+            without delaying the predicted start of the first one. Defaults to 0, in which case they wait in order.
+        tenant_weights (Optional[Dict[Hashable, float]], optional): Weights of tenants to share the limits,
+            in proportion to the largest share of a resource limit reserved by each.
+            The default is None, in which case every tenant has weight 1.
+        expire_on_prediction (bool, optional): If true, the first waiting coroutine is expired without waiting for its deadline
+            when its predicted start time is after the deadline. Defaults to False.
 
     Raises:
         ValueError: If the resource limit array length is 0, or if any value of the resource limit or max_async_run is non-positive.
+        ValueError: If max_waiting is non-positive, or max_waiting_resources has a length mismatch or negative values.
+        ValueError: If backfill_depth is negative.
+        ValueError: If any tenant weight is non-positive.
 
     Returns:
         _type_: Object for using multiple resources while observing multiple RateLimits.
     """
     if len(limits) <= 0 or min([len(ls) for ls in limits]) <= 0 or max_async_run <= 0:
       raise ValueError(f'Invalid None positive length or values : {[len(ls) for ls in limits]}, {max_async_run}')
+    if max_waiting is not None and max_waiting <= 0:
+      raise ValueError(f'Invalid None positive max_waiting : {max_waiting}')
+    if max_waiting_resources is not None:
+      max_waiting_resources = check_resources(max_waiting_resources, len(limits))
+    if backfill_depth < 0:
+      raise ValueError(f'Invalid negative backfill_depth : {backfill_depth}')
+    if tenant_weights is not None and any([w <= 0 for w in tenant_weights.values()]):
+      raise ValueError(f'Invalid None positive tenant_weights : {tenant_weights}')
     if past_queue_factory is None:
-      past_queue_factory = lambda len_resource, longest_period_in_seconds: FilePastResourceQueue.create(
-          len_resource, longest_period_in_seconds)
+      past_queue_factory = ArrayPastResourceQueue.create
     mrl = cls()
     # Copy for overwrite safety
     mrl._limits = [[*ls] for ls in limits]
-    mrl._past_queue = await past_queue_factory(len(limits), max([max([l.period_in_seconds for l in ls]) for ls in limits]))
+    # Flattened for the checks on every reservation and dispatch, where token buckets need no history
+    windows = [[l for l in ls if not isinstance(l, TokenBucketRateLimit)] for ls in mrl._limits]
+    buckets = [[l for l in ls if isinstance(l, TokenBucketRateLimit)] for ls in mrl._limits]
+    mrl._limit_values: List[List[int]] = [[l.resource_limit for l in ls] for ls in windows]
+    mrl._limit_periods: List[List[float]] = [[l.period_in_seconds for l in ls] for ls in windows]
+    mrl._min_limits: List[int] = [min([l.resource_limit for l in ls]) for ls in mrl._limits]
+    mrl._buckets: Optional[TokenBuckets] = (TokenBuckets([[l.resource_limit for l in ls] for ls in buckets]
+        , [[l.period_in_seconds for l in ls] for ls in buckets]) if any([len(ls) > 0 for ls in buckets]) else None)
+    mrl._past_queue = await past_queue_factory(len(limits), max([max(ps, default=0) for ps in mrl._limit_periods]))
+    mrl._sync_past_queue: Optional[ISyncPastResourceQueue] = (mrl._past_queue
+        if isinstance(mrl._past_queue, ISyncPastResourceQueue) else None)
+    if mrl._sync_past_queue is not None:
+      mrl._sync_past_queue.set_windows(mrl._limit_periods)
     mrl._current_buffer = CurrentResourceBuffer(len(limits), max_async_run)
-    mrl._next_queue = NextResourceQueue(len(limits))
+    mrl._next_queue = NextResourceQueue(len(limits), [1 / ml for ml in mrl._min_limits], tenant_weights)
     mrl._loop = asyncio.get_running_loop()
     mrl._in_process: Optional[Task] = None
+    mrl._wakeup: Future[None] = mrl._loop.create_future()
+    mrl._done_tasks: deque[Union[Task, ResourceSlot]] = deque()
+    mrl._timer: Optional[TimerHandle] = None
+    mrl._timer_deadline: Optional[float] = None
+    mrl._wakeups: int = 0
+    mrl._dispatches: int = 0
+    mrl._max_waiting: Optional[int] = max_waiting
+    mrl._max_waiting_resources: Optional[List[int]] = max_waiting_resources
+    mrl._reserve_waiters: deque[Tuple[Future[None], Union[List[int], Dict[int, int]]]] = deque()
+    mrl._charge_at_dispatch: bool = charge_at_dispatch
+    mrl._no_resources: List[int] = [0 for _ in limits]
+    mrl._credit_ledger: Optional[CreditLedger] = (CreditLedger(len(limits), mrl._limit_periods)
+        if charge_at_dispatch else None)
+    mrl._backfill_depth: int = backfill_depth
+    mrl._expire_on_prediction: bool = expire_on_prediction
     mrl._teminated: bool = False
     return mrl
   
@@ -148,17 +326,22 @@ class MultiRateLimit:
   async def _process(self) -> None:
     """Internal processing that manages waiting, running, and executed state transitions.
 
+    It keeps running while there are waiting or running coroutines, and sleeps on the wakeup future
+    instead of being restarted when the state is changed from outside.
+
     Raises:
         Exception: In case of unknown logic errors.
     """
-    ex: Optional[Exception] = None
-    while True:
-      try:
-        # The only time next is swapped during await is if it is canceled,
-        # in which case it will start over from the beginning,
-        # so unless "changing a state that cannot maintain consistency",
-        # do not worry about the discrepancy between before and after await.
-        delay = 0
+    try:
+      while True:
+        # Changes from outside during the following awaits resolve the new future,
+        # so that they are reflected in the next loop.
+        if self._wakeup.done():
+          self._wakeup = self._loop.create_future()
+        self._wakeups += 1
+        time_to_start: Optional[float] = None
+        if len(self._next_queue.number_to_deadline) > 0:
+          self._expire(time.time())
         # Stuff into the current buffer
         if self._next_queue.is_empty():
           if self._current_buffer.is_empty():
@@ -168,58 +351,326 @@ class MultiRateLimit:
         else:
           current_time = time.time()
           resource_margin_from_past: Optional[List[int]] = None
+          # Nothing fits while the running ones exceed the margin, such as by overwriting with more
+          has_margin = False
           while not self._next_queue.is_empty():
             if self._current_buffer.is_full():
               break
+            next_number = self._next_queue.peek_number()
             next_resources, coro, future = self._next_queue.peek()
             # Check the resource usage of current and next within their limits 
-            sum_resources = [c + r for c, r in zip(self._current_buffer.sum_resources, next_resources)]
-            if any([any([l.resource_limit < sr for l in ls]) for ls, sr in zip(self._limits, sum_resources)]):
+            if not self._within(self._min_limits, next_resources):
               break
             # Check the total resource usage within their limits
             if resource_margin_from_past is None:
               resource_margin_from_past = await self._resource_margin_from_past(current_time)
-            if all([rm >= sr for rm, sr in zip(resource_margin_from_past, sum_resources)]):
+              has_margin = all(map(ge, resource_margin_from_past, self._current_sum_resources()))
+              # The next may have been canceled during await
+              continue
+            if (has_margin and self._within(resource_margin_from_past, next_resources)
+                and (self._buckets is None or self._buckets.fits(current_time, self._sum_with_current(next_resources)))):
               self._next_queue.pop()
-              self._current_buffer.start_coroutine(next_resources, coro, future)
+              if self._start(current_time, next_resources, coro, future) and self._charge_at_dispatch:
+                await asyncio.shield(self._add_past([(current_time, next_resources)]))
+                # The margin is changed by the charge, and the next may have been canceled during await
+                resource_margin_from_past = None
               continue
             # Predict time to accept
+            sum_resources = self._sum_with_current(next_resources)
             time_to_start = await self._time_to_start(sum_resources)
-            delay = max(0, time_to_start - current_time)
-            if delay <= 0:
+            if time_to_start <= current_time:
               raise Exception('Internal logic error')
+            deadline = self._next_queue.deadline(next_number) if self._expire_on_prediction else None
+            if deadline is not None and time_to_start > deadline:
+              # It would be expired before starting, so give its place to the next
+              _, coro, future, _ = self._next_queue.cancel(next_number)
+              self._fail_expired(coro, future, ReservationExpiredError(deadline, time_to_start))
+              time_to_start = None
+              continue
+            if self._backfill_depth > 0:
+              await self._backfill(current_time, time_to_start, sum_resources, resource_margin_from_past)
             break
-        # Wait for current buffer (and past queue to free up space)
-        tasks = [t for t in self._current_buffer.task_buffer if t is not None]
-        if delay > 0:
-          tasks.append(asyncio.create_task(asyncio.sleep(delay), name=''))
-        if len(tasks) <= 0:
-          raise Exception('Internal logic error')
-        dones, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        # Coroutines may have left the waiting queue
+        if len(self._reserve_waiters) > 0:
+          self._wake_reserve_waiters()
+        # The timer is kept as it is while the time to start does not change
+        next_deadline = self._next_queue.next_deadline()
+        if next_deadline is not None and (time_to_start is None or next_deadline < time_to_start):
+          # Wake up to expire it
+          time_to_start = next_deadline
+        self._arm_timer(time_to_start)
+        # Wait for current buffer (and past queue to free up space) or changes from outside
+        # Finished tasks and the timer resolve the wakeup future.
+        if len(self._done_tasks) <= 0:
+          if time_to_start is not None:
+            await self._wakeup
+          elif self._current_buffer.is_empty():
+            if self._next_queue.is_empty():
+              # All the waiting ones have left without running, such as failing to start or expiring
+              break
+            raise Exception('Internal logic error')
+          else:
+            await self._wakeup
         current_time = time.time()
-        for done in dones:
-          name = done.get_name()
-          if name == '':
-            # Since the resource usage may change, the interpretation of next queue is passed to the next loop
-            continue
-          use_time, use_resources = self._current_buffer.end_coroutine(current_time, done)
+        # Since the resource usage may change, the interpretation of next queue is passed to the next loop
+        time_resources = [self._end(current_time, self._done_tasks.popleft()) for _ in range(len(self._done_tasks))]
+        if self._charge_at_dispatch:
+          # Nothing more to charge unless the usage is overwritten with more
+          time_resources = [(t, rs) for t, rs in time_resources if any([r > 0 for r in rs])]
+        if len(time_resources) > 0:
           # The only time when there is a possibility that consistency will not be maintained if it is canceled.
           # By shielding, the await itself is canceled, but the internal add task continues to be executed.
-          await asyncio.shield(self._past_queue.add(use_time, use_resources))
-      except asyncio.exceptions.CancelledError:
-        # Do not set the process to None since it has been reset externally
-        return
-      except Exception as ex:
-        self._in_process = None
-        raise ex
-    self._in_process = None
+          await asyncio.shield(self._add_past(time_resources))
+    finally:
+      self._arm_timer(None)
+      self._in_process = None
+
+  def _start(self, current_time: float, next_resources: Union[List[int], Dict[int, int]]
+      , coro: Union[Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]
+      , Callable[[], Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]], ResourceSlot]
+      , future: Future[Any]) -> bool:
+    """Start a reservation popped from the waiting queue in the current buffer.
+
+    Args:
+        current_time (float): The current time compatible with time.time().
+        next_resources (Union[List[int], Dict[int, int]]): Resource reservation amount, or only the used ones by their indices.
+        coro (Union[Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]
+            , Callable[[], Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]], ResourceSlot]):
+            Coroutine object, a function to create it, or a slot to resolve.
+        future (Future[Any]): Future of the ticket.
+
+    Returns:
+        bool: Whether it has started.
+    """
+    started = False
+    if isinstance(coro, ResourceSlot):
+      # The caller's task runs instead of a new task
+      if not future.done():
+        coro._pos = self._current_buffer.start_slot(next_resources, current_time)
+        future.set_result(coro)
+        started = True
+    # Not started if the coroutine reserved lazily cannot be created
+    else:
+      started = self._current_buffer.start_coroutine(next_resources, coro, future, self._on_done, current_time)
+    if started:
+      self._dispatches += 1
+    return started
+
+  async def _backfill(self, current_time: float, head_start_time: float, sum_resources: List[int]
+      , resource_margin_from_past: List[int]) -> None:
+    """Start reservations behind the first waiting one that fit now without delaying its predicted start.
+
+    A reservation is started only if its resources also fit the windows ending at the predicted start,
+    in addition to the usage recorded so far, the running ones and the first waiting one,
+    and a position in the current buffer is left for the first waiting one.
+    Refunds of resources charged at dispatch are ignored, which only overestimates the usage.
+
+    Args:
+        current_time (float): The current time compatible with time.time().
+        head_start_time (float): The predicted time compatible with time.time() when the first waiting one can start.
+        sum_resources (List[int]): The running and the first waiting resource usage.
+        resource_margin_from_past (List[int]): How much of each resource can be allocated now.
+    """
+    times = [[head_start_time - p for p in ps] for ps in self._limit_periods]
+    if self._sync_past_queue is not None:
+      sums = self._sync_past_queue.sum_resource_after_batch_sync(times)
+    else:
+      sums = await self._past_queue.sum_resource_after_batch(times)
+    slack = [min(map(sub, lv, ss), default=inf) - sr for lv, ss, sr in zip(self._limit_values, sums, sum_resources)]
+    margin = [*map(sub, resource_margin_from_past, self._current_sum_resources())]
+    if self._buckets is not None:
+      slack = [*map(min, slack, map(sub, self._buckets.margins(head_start_time), sum_resources))]
+    if min(slack, default=0) < 0 or min(margin, default=0) < 0:
+      # Nothing fits, and sparse resources are compared only where used
+      return
+    # Running resources including the started ones, to check the token buckets now
+    running = [*self._current_sum_resources()]
+    charges: List[Tuple[float, List[int]]] = []
+    # The first one is the head
+    for number in self._next_queue.peek_numbers(self._backfill_depth + 1)[1:]:
+      if self._current_buffer.active_run + 1 >= self._current_buffer.max_async_run:
+        break
+      next_resources = self._next_queue.number_to_resource_coro_future[number][0]
+      if not within(slack, next_resources) or not within(margin, next_resources):
+        continue
+      if (self._buckets is not None
+          and not self._buckets.fits(current_time, [*map(add, running, to_dense(next_resources, len(running)))])):
+        continue
+      next_resources, coro, future, _ = self._next_queue.cancel(number)
+      if self._start(current_time, next_resources, coro, future):
+        sub_resources(slack, next_resources)
+        sub_resources(margin, next_resources)
+        add_resources(running, next_resources)
+        charges.append((current_time, next_resources))
+    if self._charge_at_dispatch and len(charges) > 0:
+      await asyncio.shield(self._add_past(charges))
+
+  def _expire(self, current_time: float) -> None:
+    """Remove the waiting coroutines whose deadlines have passed.
+
+    Args:
+        current_time (float): The current time compatible with time.time().
+    """
+    for deadline, _, coro, future in self._next_queue.expire(current_time):
+      self._fail_expired(coro, future, ReservationExpiredError(deadline))
+
+  def _fail_expired(self, coro: Union[Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]
+      , Callable[[], Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]], ResourceSlot]
+      , future: Future[Any], error: ReservationExpiredError) -> None:
+    """Notify the client of an expired reservation and close its coroutine.
+
+    Args:
+        coro (Union[Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]
+            , Callable[[], Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]], ResourceSlot]):
+            Coroutine object, a function to create it, or a slot.
+        future (Future[Any]): Future of the ticket.
+        error (ReservationExpiredError): Error to set to the future.
+    """
+    if not future.done():
+      future.set_exception(error)
+    if asyncio.iscoroutine(coro):
+      coro.close()
+
+  async def _add_past(self, time_resources: List[Tuple[float, Union[List[int], Dict[int, int]]]]) -> None:
+    """Add executed resource usages to the past queue in order.
+
+    Sparse resources are made dense here, as the past queue keeps every resource.
+
+    Args:
+        time_resources (List[Tuple[float, Union[List[int], Dict[int, int]]]]): Resource usage times and amounts.
+    """
+    for use_time, use_resources in time_resources:
+      use_resources = to_dense(use_resources, len(self._limits))
+      if self._buckets is not None:
+        self._buckets.add(use_time, use_resources)
+      await self._past_queue.add(use_time, use_resources)
+
+  def _arm_timer(self, time_to_start: Optional[float]) -> None:
+    """Arm the timer to wake up internal processing at the given time, or disarm it.
+
+    Nothing is done if the timer is already armed for the same time.
+
+    Args:
+        time_to_start (Optional[float]): The time compatible with time.time() to wake up, or None to disarm.
+    """
+    if self._timer is not None and self._timer_deadline == time_to_start:
+      return
+    if self._timer is not None:
+      self._timer.cancel()
+      self._timer = None
+    self._timer_deadline = time_to_start
+    if time_to_start is not None:
+      # Convert to the monotonic clock of the loop
+      self._timer = self._loop.call_at(self._loop.time() + time_to_start - time.time(), self._on_timer)
+
+  def _on_timer(self) -> None:
+    """Callback when the time to start has come, which wakes up internal processing.
+    """
+    self._timer = None
+    self._timer_deadline = None
+    if not self._wakeup.done():
+      self._wakeup.set_result(None)
+
+  def _end(self, current_time: float, done: Union[Task[Tuple[Optional[Tuple[float, List[int]]], Any]], ResourceSlot]
+      ) -> Tuple[float, Union[List[int], Dict[int, int]]]:
+    """Release the position of a finished task or slot in the current buffer.
+
+    Args:
+        current_time (float): The current time compatible with time.time().
+        done (Union[Task[Tuple[Optional[Tuple[float, List[int]]], Any]], ResourceSlot]): The finished task or released slot.
+
+    Returns:
+        Tuple[float, Union[List[int], Dict[int, int]]]: Resource usage time and amounts to add to the past queue.
+    """
+    pos = done._pos if isinstance(done, ResourceSlot) else self._current_buffer.position(done)
+    record = self._current_buffer.records[pos]
+    start_time = record.start_time
+    reserved_resources = record.use_resources
+    if not isinstance(done, ResourceSlot):
+      use_time, use_resources = self._current_buffer.end_coroutine(current_time, done)
+    else:
+      use_resources = self._current_buffer.end_slot(pos)
+      done._pos = None
+      use_time, use_resources = done._settled if done._settled is not None else (current_time, use_resources)
+    if not self._charge_at_dispatch:
+      return use_time, use_resources
+    # Settle the difference from the reserved resources charged at dispatch
+    reserved_resources = to_dense(reserved_resources, len(self._limits))
+    use_resources = to_dense(use_resources, len(self._limits))
+    credits = [max(0, r - u) for r, u in zip(reserved_resources, use_resources)]
+    if any([c > 0 for c in credits]):
+      self._credit_ledger.add(current_time, start_time, credits)
+      if self._buckets is not None:
+        self._buckets.refund(credits)
+    return use_time, [max(0, u - r) for r, u in zip(reserved_resources, use_resources)]
+
+  def _current_sum_resources(self) -> List[int]:
+    """Returns the total running resource usage that is not yet recorded in the past queue.
+
+    Returns:
+        List[int]: The total running resource usage, or zeros if charged at dispatch.
+    """
+    if self._charge_at_dispatch:
+      return self._no_resources
+    return self._current_buffer.sum_resources
+
+  def _sum_with_current(self, use_resources: Union[List[int], Dict[int, int]]) -> List[int]:
+    """Returns the total running resource usage with the given one.
+
+    Args:
+        use_resources (Union[List[int], Dict[int, int]]): Resource reservation amount, or only the used ones by their indices.
+
+    Returns:
+        List[int]: The total resource usage for each resource.
+    """
+    return [*map(add, self._current_sum_resources(), to_dense(use_resources, len(self._limits)))]
+
+  def _within(self, limits: List[int], use_resources: Union[List[int], Dict[int, int]]) -> bool:
+    """Returns whether the total running resource usage with the given one is within the limits.
+
+    Sparse resources are compared only where used, so the running ones must be known to be within the others.
+
+    Args:
+        limits (List[int]): The limit for each resource.
+        use_resources (Union[List[int], Dict[int, int]]): Resource reservation amount, or only the used ones by their indices.
+
+    Returns:
+        bool: Whether it is within the limits.
+    """
+    current = self._current_sum_resources()
+    if isinstance(use_resources, dict):
+      return all([current[i] + r <= limits[i] for i, r in use_resources.items()])
+    return all(map(ge, limits, map(add, current, use_resources)))
+
+  def _on_slot_done(self, slot: ResourceSlot) -> None:
+    """Passes a released slot to internal processing.
+
+    Args:
+        slot (ResourceSlot): The released slot.
+    """
+    self._done_tasks.append(slot)
+    if not self._wakeup.done():
+      self._wakeup.set_result(None)
+
+  def _on_done(self, task: Task[Tuple[Optional[Tuple[float, List[int]]], Any]]) -> None:
+    """Callback when a running coroutine finishes, which passes it to internal processing.
+
+    Args:
+        task (Task[Tuple[Optional[Tuple[float, List[int]]], Any]]): The finished task.
+    """
+    self._done_tasks.append(task)
+    if not self._wakeup.done():
+      self._wakeup.set_result(None)
 
   def _try_process(self) -> None:
     """Trigger internal processing.
+
+    Start it if not running, otherwise wake it up.
     """
-    if self._in_process is not None:
-      self._in_process.cancel()
-    self._in_process = asyncio.create_task(self._process())
+    if self._in_process is None:
+      self._in_process = asyncio.create_task(self._process())
+    elif not self._wakeup.done():
+      self._wakeup.set_result(None)
   
   async def _resouce_sum_from_past(self, current_time: float) -> List[List[int]]:
     """For each resource limit, calculate the resource usage during the limit period given the current time.
@@ -230,20 +681,27 @@ class MultiRateLimit:
     Returns:
         List[List[int]]: The resource usage during the limit period for each resource limit.
     """
-    times = [[(current_time - l.period_in_seconds) for l in ls] for ls in self._limits]
-    return await asyncio.gather(*[asyncio.gather(*[self._past_queue.sum_resource_after(t, i) for t in ts]) for i, ts in enumerate(times)])
+    if self._sync_past_queue is not None:
+      sums = self._sync_past_queue.sum_resource_windows_sync(current_time)
+    else:
+      times = [[current_time - p for p in ps] for ps in self._limit_periods]
+      sums = await self._past_queue.sum_resource_after_batch(times)
+    if self._credit_ledger is None:
+      return sums
+    return [[max(0, s - c) for s, c in zip(ss, cs)] for ss, cs in zip(sums, self._credit_ledger.window_sums(current_time))]
 
   async def _resource_margin_from_past(self, current_time: float) -> List[int]:
     """Calculate how much of each resource can be allocated to resource consumption during execution.
 
+    Token buckets are not included, which are checked with their own state.
+
     Args:
         current_time (float): The current time compatible with time.time().
 
     Returns:
         List[int]: How much of each resource can be allocated to resource consumption during execution.
     """
-    return [min([l.resource_limit - r for l, r in zip(ls, rs)])
-        for ls, rs in zip(self._limits, await self._resouce_sum_from_past(current_time))]
+    return [min(map(sub, lv, rs), default=inf) for lv, rs in zip(self._limit_values, await self._resouce_sum_from_past(current_time))]
 
   async def _time_to_start(self, sum_resourcs_without_past: List[int]) -> float:
     """Returns the time when the next execution can start based on the current and next execution's resource usage.
@@ -254,28 +712,120 @@ class MultiRateLimit:
     Returns:
         float: The time compatible with time.time() when the next execution can start.
     """
-    base_times = await asyncio.gather(*[asyncio.gather(*[self._past_queue.time_accum_resource_within
-        (i, l.resource_limit - sr) for l in ls]) for i, (ls, sr) in enumerate(zip(self._limits, sum_resourcs_without_past))])
-    return max([max([l.period_in_seconds + t for l, t in zip(ls, bt)]) for ls, bt in zip(self._limits, base_times)])
+    amounts = [[l - sr for l in lv] for lv, sr in zip(self._limit_values, sum_resourcs_without_past)]
+    if self._sync_past_queue is not None:
+      base_times = self._sync_past_queue.time_accum_resource_within_batch_sync(amounts)
+    else:
+      base_times = await self._past_queue.time_accum_resource_within_batch(amounts)
+    time_to_start = max([max(map(add, ps, bt), default=0.0) for ps, bt in zip(self._limit_periods, base_times)])
+    if self._buckets is None:
+      return time_to_start
+    return max(time_to_start, self._buckets.time_to_start(sum_resourcs_without_past))
   
-  def _add_next(self, use_resources: List[int], coro: Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]
-      , future: Future[Any]) -> ReservationTicket:
-    """Puts the task on a waiting queue and returns a ticket to receive the result.
+  def _check_reserve(self, use_resources: Union[List[int], Mapping[int, int]]) -> Union[List[int], Dict[int, int]]:
+    """Check whether a reservation can be accepted.
 
     Args:
-        use_resources (List[int]): Resource reservation amount.
-        coro (Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]):
-            Coroutine object that is the process to reserve
-        future (Future[Any]): Future for receiving processing results.
+        use_resources (Union[List[int], Mapping[int, int]]): Resource reservation amount for each resource,
+            or only for the used resources by their indices.
+
+    Raises:
+        Exception: If already terminated.
+        ValueError: In case of resources list length mismatch, invalid indices or any single resource reservation exceeds its limit. 
+
+    Returns:
+        Union[List[int], Dict[int, int]]: A copy of the resource reservation amount,
+            which is kept sparse while waiting and running if given as a mapping.
+    """
+    if self._teminated:
+      raise Exception('Already terminated')
+    if isinstance(use_resources, Mapping):
+      use_resources = check_sparse_resources(use_resources, len(self._limits))
+      if any([r > self._min_limits[i] for i, r in use_resources.items()]):
+        raise ValueError(f'Using resources exceed the capacity : {use_resources}')
+      return use_resources
+    use_resources = check_resources(use_resources, len(self._limits))
+    if any(map(gt, use_resources, self._min_limits)):
+      raise ValueError(f'Using resources exceed the capacity : {use_resources}')
+    return use_resources
+
+  def _is_waiting_full(self, count: int, sum_resources: Union[List[int], Dict[int, int]]) -> bool:
+    """Returns whether the waiting queue has no space for the reservations.
+
+    Args:
+        count (int): The number of reservations.
+        sum_resources (Union[List[int], Dict[int, int]]): The total resource reservation amount of the reservations,
+            or only the used ones by their indices.
+
+    Returns:
+        bool: Whether the waiting queue has no space for the reservations.
+    """
+    if self._max_waiting is not None and self.waitings() + count > self._max_waiting:
+      return True
+    # A single reservation is always accepted while nothing is waiting, so that it cannot wait forever
+    if self._max_waiting_resources is None or (count == 1 and self._next_queue.is_empty()):
+      return False
+    next_sums = self._next_queue.sum_resources
+    if isinstance(sum_resources, dict):
+      # The unused ones may have been exceeded by a single reservation accepted while nothing was waiting
+      return (any(map(gt, next_sums, self._max_waiting_resources))
+          or any([next_sums[i] + r > self._max_waiting_resources[i] for i, r in sum_resources.items()]))
+    return any([n + r > m for n, r, m in zip(next_sums, sum_resources, self._max_waiting_resources)])
+
+  def _wake_reserve_waiters(self) -> None:
+    """Wake up the first reserve_wait() call waiting for space if there is space for it.
+
+    On termination, wake up all of them.
+    """
+    while len(self._reserve_waiters) > 0:
+      waiter, use_resources = self._reserve_waiters[0]
+      if not self._teminated and not waiter.done() and self._is_waiting_full(1, use_resources):
+        return
+      self._reserve_waiters.popleft()
+      if not waiter.done():
+        waiter.set_result(None)
+        if not self._teminated:
+          return
+
+  def _add_next(self, use_resources: Union[List[int], Dict[int, int]]
+      , coro: Union[Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]
+      , Callable[[], Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]]], priority: int = 0
+      , tenant: Hashable = None, deadline: Optional[float] = None) -> ReservationTicket:
+    """Puts the task on a waiting queue, wakes up internal processing if needed and returns a ticket to receive the result.
+
+    Args:
+        use_resources (Union[List[int], Dict[int, int]]): Resource reservation amount, or only the used ones by their indices.
+        coro (Union[Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]
+            , Callable[[], Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]]]):
+            Coroutine object that is the process to reserve, or a function to create it.
+        priority (int, optional): Priority of the reservation, the smaller first. Defaults to 0.
+        tenant (Hashable, optional): Tenant of the reservation, sharing the limits fairly with the others of the same priority.
+            Defaults to None.
+        deadline (Optional[float], optional): The time compatible with time.time() by which it must start.
+            Otherwise, ReservationExpiredError is set to the future of the ticket, and the coroutine is closed.
+            The default is None, in which case it waits as long as needed.
 
     Returns:
         ReservationTicket: Ticket for receiving processing results.
     """
-    reserve_number = self._next_queue.push(use_resources, coro, future)
-    return ReservationTicket(reserve_number, future)
+    future = self._loop.create_future()
+    ticket = ReservationTicket(self._next_queue.push(use_resources, coro, future, priority, tenant, deadline), future)
+    if deadline is not None and (self._timer_deadline is None or deadline < self._timer_deadline):
+      # Rearm the timer to expire it in time
+      self._try_process()
+      return ticket
+    # Unless it becomes the head of the queue or may be backfilled, adding it does not change what is monitored,
+    # and neither does it when the current buffer is the bottleneck
+    if ((self._backfill_depth <= 0 and self._next_queue.peek_number() != ticket.reserve_number)
+        or self._current_buffer.is_full()):
+      return ticket
+    if self._within(self._min_limits, use_resources):
+      self._try_process()
+    return ticket
 
-  def reserve(self, use_resources: List[int]
-      , coro: Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]) -> ReservationTicket:
+  def reserve(self, use_resources: Union[List[int], Mapping[int, int]]
+      , coro: Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]], priority: int = 0
+      , tenant: Hashable = None, deadline: Optional[float] = None) -> ReservationTicket:
     """Schedules the task and returns a ticket to receive the result.
 
     Unless explicitly stated in the return value or exception parameter of coroutine,
@@ -288,36 +838,357 @@ class MultiRateLimit:
     If you do not want to overwrite, please use the followin format.
     (None, return_value_to_user)
 
+    Waiting coroutines start in ascending order of priority.
+    Within the same priority, tenants share the limits by weighted fair queueing,
+    and the coroutines of each tenant start in the order of reservation.
+
     Args:
-        use_resources (List[int]): Resource reservation amount.
+        use_resources (Union[List[int], Mapping[int, int]]): Resource reservation amount for each resource,
+            or only for the used resources by their indices.
         coro (Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]):
             Coroutine object that is the process to reserve
+        priority (int, optional): Priority of the reservation, the smaller first. Defaults to 0.
+        tenant (Hashable, optional): Tenant of the reservation, sharing the limits fairly with the others of the same priority.
+            Defaults to None.
+        deadline (Optional[float], optional): The time compatible with time.time() by which it must start.
+            Otherwise, ReservationExpiredError is set to the future of the ticket, and the coroutine is closed.
+            The default is None, in which case it waits as long as needed.
 
     Raises:
         Exception: If already terminated.
-        ValueError: In case of resources list length mismatch or any single resource reservation exceeds its limit. 
+        ValueError: In case of resources list length mismatch, invalid indices or any single resource reservation exceeds its limit. 
+        ValueError: If the passed process is not a coroutine.
+        asyncio.QueueFull: If max_waiting or max_waiting_resources is reached.
+
+    Returns:
+        ReservationTicket: Ticket to receive the result.
+    """
+    use_resources = self._check_reserve(use_resources)
+    if not asyncio.iscoroutine(coro):
+      raise ValueError('Parameter is not a coroutine')
+    if self._is_waiting_full(1, use_resources):
+      raise asyncio.QueueFull()
+    return self._add_next(use_resources, coro, priority, tenant, deadline)
+
+  async def reserve_wait(self, use_resources: Union[List[int], Mapping[int, int]]
+      , coro: Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]], priority: int = 0
+      , tenant: Hashable = None, deadline: Optional[float] = None) -> ReservationTicket:
+    """Schedules the task and returns a ticket to receive the result, waiting for space in the waiting queue.
+
+    Same as reserve(), except that it waits instead of raising asyncio.QueueFull
+    while max_waiting or max_waiting_resources is reached.
+    Callers are accepted in the order they started waiting, regardless of priority.
+
+    Args:
+        use_resources (Union[List[int], Mapping[int, int]]): Resource reservation amount for each resource,
+            or only for the used resources by their indices.
+        coro (Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]):
+            Coroutine object that is the process to reserve
+        priority (int, optional): Priority of the reservation, the smaller first. Defaults to 0.
+        tenant (Hashable, optional): Tenant of the reservation, sharing the limits fairly with the others of the same priority.
+            Defaults to None.
+        deadline (Optional[float], optional): The time compatible with time.time() by which it must start.
+            Otherwise, ReservationExpiredError is set to the future of the ticket, and the coroutine is closed.
+            The default is None, in which case it waits as long as needed.
+
+    Raises:
+        Exception: If already terminated, including while waiting.
+        ValueError: In case of resources list length mismatch, invalid indices or any single resource reservation exceeds its limit. 
         ValueError: If the passed process is not a coroutine.
 
     Returns:
         ReservationTicket: Ticket to receive the result.
     """
+    use_resources = self._check_reserve(use_resources)
+    if not asyncio.iscoroutine(coro):
+      raise ValueError('Parameter is not a coroutine')
+    return await self._add_next_wait(use_resources, coro, priority, tenant, deadline)
+
+  async def _add_next_wait(self, use_resources: Union[List[int], Dict[int, int]]
+      , coro: Union[Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]
+      , Callable[[], Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]]], priority: int = 0
+      , tenant: Hashable = None, deadline: Optional[float] = None) -> ReservationTicket:
+    """Waits for space in the waiting queue, and then puts the task on it as _add_next().
+
+    Args:
+        use_resources (Union[List[int], Dict[int, int]]): Resource reservation amount, or only the used ones by their indices.
+        coro (Union[Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]
+            , Callable[[], Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]]]):
+            Coroutine object that is the process to reserve, or a function to create it.
+        priority (int, optional): Priority of the reservation, the smaller first. Defaults to 0.
+        tenant (Hashable, optional): Tenant of the reservation, sharing the limits fairly with the others of the same priority.
+            Defaults to None.
+        deadline (Optional[float], optional): The time compatible with time.time() by which it must start.
+            Otherwise, ReservationExpiredError is set to the future of the ticket, and the coroutine is closed.
+            The default is None, in which case it waits as long as needed.
+
+    Raises:
+        Exception: If terminated while waiting.
+
+    Returns:
+        ReservationTicket: Ticket for receiving processing results.
+    """
+    if len(self._reserve_waiters) > 0 or self._is_waiting_full(1, use_resources):
+      waiter = self._loop.create_future()
+      self._reserve_waiters.append((waiter, use_resources))
+      try:
+        while True:
+          await waiter
+          if self._teminated:
+            raise Exception('Already terminated')
+          if not self._is_waiting_full(1, use_resources):
+            break
+          # Space was taken by reserve() in the meantime, so wait again at the top
+          waiter = self._loop.create_future()
+          self._reserve_waiters.appendleft((waiter, use_resources))
+      except asyncio.CancelledError:
+        if not waiter.done():
+          waiter.cancel()
+        self._reserve_waiters = deque([(w, r) for w, r in self._reserve_waiters if w is not waiter])
+        # Pass the chance to the next if woken up
+        self._wake_reserve_waiters()
+        raise
+    ticket = self._add_next(use_resources, coro, priority, tenant, deadline)
+    # There may be still space for the next
+    self._wake_reserve_waiters()
+    return ticket
+
+  async def amap(self, items: Union[Iterable[T], AsyncIterable[T]], cost: Callable[[T], Union[List[int], Mapping[int, int]]]
+      , coro_func: Callable[[T], Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]]
+      , window: Optional[int] = None, ordered: bool = True, priority: int = 0
+      , tenant: Hashable = None) -> AsyncIterator[Any]:
+    """Runs a coroutine for each item under the limits and yields the results.
+
+    Items are read from the iterable only as needed, so that at most window items are waiting or running at the same time.
+    Each coroutine is created only when it starts running, as in reserve_lazy().
+    If a coroutine raises an exception, it is raised from this generator.
+    When this generator is closed early, the items that have not started yet are canceled.
+
+    Args:
+        items (Union[Iterable[T], AsyncIterable[T]]): Items to process.
+        cost (Callable[[T], Union[List[int], Mapping[int, int]]]): Function that returns the resource reservation amount
+            for an item, in the same format as reserve().
+        coro_func (Callable[[T], Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]]):
+            Function that creates the coroutine object for an item, in the same format as reserve().
+        window (Optional[int], optional): Maximum number of items waiting or running at the same time.
+            The default is None, in which case twice max_async_run is used.
+        ordered (bool, optional): If true, yield the results in the order of the items,
+            otherwise in the order of completion. Defaults to True.
+        priority (int, optional): Priority of the reservations, the smaller first. Defaults to 0.
+        tenant (Hashable, optional): Tenant of the reservations. Defaults to None.
+
+    Raises:
+        Exception: If already terminated.
+        ValueError: If window is non-positive.
+        ValueError: In case of resources list length mismatch, invalid indices or any single resource reservation exceeds its limit. 
+
+    Yields:
+        Any: The results of the coroutines.
+    """
+    if self._teminated:
+      raise Exception('Already terminated')
+    if window is None:
+      window = 2 * self._current_buffer.max_async_run
+    if window <= 0:
+      raise ValueError(f'Invalid None positive window : {window}')
+    sync_items = iter(items) if isinstance(items, Iterable) else None
+    async_items = aiter(items) if sync_items is None else None
+    # Tickets by their futures in the order of the items
+    in_flight: Dict[Future[Any], ReservationTicket] = {}
+    # Finished futures and the future to wait for them, only when not ordered
+    done_futures: deque[Future[Any]] = deque()
+    done_waiter: List[Optional[Future[None]]] = [None]
+    def on_done(future: Future[Any]) -> None:
+      done_futures.append(future)
+      if done_waiter[0] is not None and not done_waiter[0].done():
+        done_waiter[0].set_result(None)
+    exhausted = False
+    try:
+      while True:
+        # Fill the window
+        while not exhausted and len(in_flight) < window:
+          try:
+            item = next(sync_items) if sync_items is not None else await anext(async_items)
+          except (StopIteration, StopAsyncIteration):
+            exhausted = True
+            break
+          use_resources = self._check_reserve(cost(item))
+          ticket = await self._add_next_wait(use_resources, LazyCoroutine(coro_func, (item,), None), priority, tenant)
+          if not ordered:
+            ticket.future.add_done_callback(on_done)
+          in_flight[ticket.future] = ticket
+        if len(in_flight) <= 0:
+          break
+        if ordered:
+          future = next(iter(in_flight))
+          await asyncio.wait([future])
+        else:
+          while len(done_futures) <= 0:
+            done_waiter[0] = self._loop.create_future()
+            await done_waiter[0]
+          future = done_futures.popleft()
+        del in_flight[future]
+        yield future.result()
+    finally:
+      for ticket in in_flight.values():
+        if not self._teminated:
+          self.cancel(ticket.reserve_number)
+        # Retrieve exceptions of the running ones, which are no longer awaited
+        ticket.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+  def acquire(self, use_resources: Union[List[int], Mapping[int, int]], priority: int = 0, tenant: Hashable = None
+      , deadline: Optional[float] = None) -> ResourceSlot:
+    """Returns a slot to run work in the caller's own task under the limits, used with async with.
+
+    No coroutine or task is created for the work.
+    Entering the slot waits until the reservation can start, and exiting releases it.
+    The reserved resources are considered to have been consumed when exiting, even with an exception,
+    unless overwritten with ResourceSlot.settle().
+
+      async with mrl.acquire([1, 3]) as slot:
+        response = await call_api()
+        slot.settle(time.time(), [1, response.used_tokens])
+
+    Args:
+        use_resources (Union[List[int], Mapping[int, int]]): Resource reservation amount for each resource,
+            or only for the used resources by their indices.
+        priority (int, optional): Priority of the reservation, the smaller first. Defaults to 0.
+        tenant (Hashable, optional): Tenant of the reservation, sharing the limits fairly with the others of the same priority.
+            Defaults to None.
+        deadline (Optional[float], optional): The time compatible with time.time() by which it must start.
+            Otherwise, ReservationExpiredError is set to the future of the ticket, and the coroutine is closed.
+            The default is None, in which case it waits as long as needed.
+
+    Raises:
+        Exception: If already terminated.
+        ValueError: In case of resources list length mismatch, invalid indices or any single resource reservation exceeds its limit. 
+
+    Returns:
+        ResourceSlot: Slot to use with async with.
+    """
+    return ResourceSlot(self, self._check_reserve(use_resources), priority, tenant, deadline)
+
+  def reserve_lazy(self, use_resources: Union[List[int], Mapping[int, int]]
+      , coro_func: Callable[..., Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]]
+      , *args: Any, **kwargs: Any) -> ReservationTicket:
+    """Schedules the task without creating its coroutine, and returns a ticket to receive the result.
+
+    Same as reserve(use_resources, coro_func(*args, **kwargs)),
+    except that the coroutine is created only when it starts running.
+    While waiting, only the function and its arguments are kept,
+    which takes much less memory than a coroutine object and never warns that it was not awaited.
+    If the function raises an exception or does not return a coroutine, the exception is set to the future of the ticket.
+
+    When canceled or terminated, the function with its arguments bound is returned in place of the coroutine.
+
+    Args:
+        use_resources (Union[List[int], Mapping[int, int]]): Resource reservation amount for each resource,
+            or only for the used resources by their indices.
+        coro_func (Callable[..., Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]]):
+            Function to create the coroutine object that is the process to reserve, such as an async function.
+        *args (Any): Positional arguments of the function.
+        **kwargs (Any): Keyword arguments of the function.
+
+    Raises:
+        Exception: If already terminated.
+        ValueError: In case of resources list length mismatch, invalid indices or any single resource reservation exceeds its limit. 
+        ValueError: If the passed function is not callable.
+        asyncio.QueueFull: If max_waiting or max_waiting_resources is reached.
+
+    Returns:
+        ReservationTicket: Ticket to receive the result.
+    """
+    use_resources = self._check_reserve(use_resources)
+    if not callable(coro_func):
+      raise ValueError('Parameter is not callable')
+    if self._is_waiting_full(1, use_resources):
+      raise asyncio.QueueFull()
+    if len(args) > 0 or len(kwargs) > 0:
+      coro_func = LazyCoroutine(coro_func, args, kwargs if len(kwargs) > 0 else None)
+    return self._add_next(use_resources, coro_func)
+
+  def reserve_many(self, items: List[Tuple[Union[List[int], Mapping[int, int]], Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]]]
+      , priority: int = 0, tenant: Hashable = None
+      , deadline: Optional[float] = None) -> List[ReservationTicket]:
+    """Schedules many tasks at once and returns tickets to receive the results.
+
+    Same as calling reserve() for each item in order, but validates all items first
+    and wakes up the internal processing at most once.
+    If any item is invalid, nothing is scheduled.
+
+    Args:
+        items (List[Tuple[Union[List[int], Mapping[int, int]], Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]]]):
+            Pairs of resource reservation amount in the same format as reserve()
+            and coroutine object that is the process to reserve.
+        priority (int, optional): Priority of all the reservations, the smaller first. Defaults to 0.
+        tenant (Hashable, optional): Tenant of all the reservations. Defaults to None.
+        deadline (Optional[float], optional): The time compatible with time.time() by which each of them must start.
+            The default is None, in which case they wait as long as needed.
+
+    Raises:
+        Exception: If already terminated.
+        ValueError: In case of resources list length mismatch, invalid indices or any single resource reservation exceeds its limit. 
+        ValueError: If any passed process is not a coroutine.
+        asyncio.QueueFull: If max_waiting or max_waiting_resources would be exceeded by the items.
+
+    Returns:
+        List[ReservationTicket]: Tickets to receive the results in the same order as items.
+    """
     if self._teminated:
       raise Exception('Already terminated')
-    use_resources = check_resources(use_resources, len(self._limits))
-    if any([any([l.resource_limit < r for l in ls]) for ls, r in zip(self._limits, use_resources)]):
-      raise ValueError(f'Using resources exceed the capacity : {use_resources}')
-    if not asyncio.iscoroutine(coro):
+    min_limits = self._min_limits
+    len_resource = len(self._limits)
+    # Copy for overwrite safety, and sparse ones are kept sparse
+    checked_resources = [check_sparse_resources(use_resources, len_resource) if isinstance(use_resources, Mapping)
+        else [*use_resources] for use_resources, _ in items]
+    dense_resources = [use_resources for use_resources in checked_resources if not isinstance(use_resources, dict)]
+    sparse_resources = [use_resources for use_resources in checked_resources if isinstance(use_resources, dict)]
+    coros = [coro for _, coro in items]
+    # Validate dense ones column by column, and look for the first invalid item only when there is one
+    if any([len(use_resources) != len_resource for use_resources in dense_resources]):
+      for use_resources in dense_resources:
+        check_resources(use_resources, len_resource)
+    columns = [*zip(*dense_resources)]
+    if any([min(c) < 0 for c in columns]):
+      for use_resources in dense_resources:
+        check_resources(use_resources, len_resource)
+    if any([ml < max(c) for ml, c in zip(min_limits, columns)]):
+      for use_resources in dense_resources:
+        if any([ml < r for ml, r in zip(min_limits, use_resources)]):
+          raise ValueError(f'Using resources exceed the capacity : {use_resources}')
+    for use_resources in sparse_resources:
+      if any([r > min_limits[i] for i, r in use_resources.items()]):
+        raise ValueError(f'Using resources exceed the capacity : {use_resources}')
+    if not all(map(asyncio.iscoroutine, coros)):
       raise ValueError('Parameter is not a coroutine')
-    is_next_empty = self._next_queue.is_empty()
-    ticket = self._add_next(use_resources, coro, self._loop.create_future())
-    # The current buffer is the bottleneck, so adding it to the queue does not change what is monitored
-    if not is_next_empty or self._current_buffer.is_full():
-      return ticket
-    rest_resources = [min([l.resource_limit for l in ls]) - cr - ur
-        for ls, cr, ur in zip(self._limits, self._current_buffer.sum_resources, use_resources)]
-    if 0 <= min(rest_resources):
+    if len(dense_resources) > 0:
+      sum_resources: Union[List[int], Dict[int, int]] = [sum(c) for c in columns]
+      for use_resources in sparse_resources:
+        add_resources(sum_resources, use_resources)
+    else:
+      sum_resources = {}
+      for use_resources in sparse_resources:
+        for i, r in use_resources.items():
+          sum_resources[i] = sum_resources.get(i, 0) + r
+    if self._is_waiting_full(len(checked_resources), sum_resources):
+      raise asyncio.QueueFull()
+    # Futures are created only after all items are validated
+    create_future = self._loop.create_future
+    checked = [(use_resources, coro, create_future()) for use_resources, coro in zip(checked_resources, coros)]
+    first_number = self._next_queue.push_many(checked, priority, tenant, deadline)
+    tickets = [ReservationTicket(first_number + i, future) for i, (_, _, future) in enumerate(checked)]
+    if (len(checked) > 0 and deadline is not None
+        and (self._timer_deadline is None or deadline < self._timer_deadline)):
+      # Rearm the timer to expire them in time
       self._try_process()
-    return ticket
+      return tickets
+    # As in reserve(), only the first item can change what is monitored
+    if (len(checked) <= 0 or (self._backfill_depth <= 0 and self._next_queue.peek_number() != first_number)
+        or self._current_buffer.is_full()):
+      return tickets
+    if self._within(min_limits, checked[0][0]):
+      self._try_process()
+    return tickets
 
   def cancel(self, number: int, auto_close: bool = False) -> Optional[Tuple[List[int], Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]]]:
     """Cancel the reservation of a waiting coroutine.
@@ -336,6 +1207,7 @@ class MultiRateLimit:
     Returns:
         Optional[Tuple[List[int], Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]]]:
             Reserved resource amount and coroutine object.
+            For reserve_lazy(), the function with its arguments bound is returned in place of the coroutine object.
     """
     if self._teminated:
       raise Exception('Already terminated')
@@ -345,15 +1217,26 @@ class MultiRateLimit:
     use_resources, coro, future, is_next_pop = res
     # Cancel it so you don't have to wait forever due to client's logic mistakes
     future.cancel()
-    if auto_close:
+    if auto_close and asyncio.iscoroutine(coro):
       coro.close()
     if is_next_pop and not self._current_buffer.is_full():
       self._try_process()
-    return use_resources, coro
+    self._wake_reserve_waiters()
+    return to_dense(use_resources, len(self._limits)), coro
+
+  def scheduler_stats(self) -> SchedulerStats:
+    """Returns how often the internal processing has been woken up.
+
+    Returns:
+        SchedulerStats: The number of wakeups of the internal processing and started coroutines.
+    """
+    return SchedulerStats(self._wakeups, self._dispatches)
 
   async def stats(self, current_time: Optional[float] = None) -> RateLimitStats:
     """Returns resource usage.
 
+    If charged at dispatch, running resource usage is included in the executed one, and the running one is 0.
+
     Args:
         current_time (Optional[float], optional): The current time.
             The default is None, in which case the result of time.time() is used.
@@ -368,8 +1251,14 @@ class MultiRateLimit:
       raise Exception('Already terminated')
     if current_time is None:
       current_time = time.time()
-    return RateLimitStats([[*ls] for ls in self._limits], await self._resouce_sum_from_past(current_time)
-        , [*self._current_buffer.sum_resources], [*self._next_queue.sum_resources])
+    past_uses = await self._resouce_sum_from_past(current_time)
+    if self._buckets is not None:
+      # Put the levels of the token buckets in the places of their limits
+      past_uses = [[next(bl) if isinstance(l, TokenBucketRateLimit) else next(wl) for l in ls]
+          for ls, wl, bl in zip(self._limits, map(iter, past_uses), map(iter, self._buckets.levels(current_time)))]
+    return RateLimitStats([[*ls] for ls in self._limits], past_uses
+        , [*self._current_sum_resources()], [*self._next_queue.sum_resources], {**self._next_queue.tenant_counts}
+        , {t: [*rs] for t, rs in self._next_queue.tenant_sums.items()})
   
   async def term(self, auto_close: bool = False) -> List[Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]]:
     """End processing.
@@ -388,6 +1277,7 @@ class MultiRateLimit:
     Returns:
         List[Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]]:
             Waiting coroutines.
+            For reserve_lazy(), the function with its arguments bound is returned in place of the coroutine object.
     """
     coros: List[Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]] = []
     if self._teminated:
@@ -401,11 +1291,13 @@ class MultiRateLimit:
       _, coro, future = res
       coros.append(coro)
       future.cancel()
-      if auto_close:
+      if auto_close and asyncio.iscoroutine(coro):
         coro.close()
+    # Waiting reserve_wait() calls raise an exception
+    self._wake_reserve_waiters()
     # The internal process continues to run until all current tasks are completed
-    # Reset the internal process bacause the it already start to consume the canceled task
     self._try_process()
-    await self._in_process
+    if self._in_process is not None:
+      await self._in_process
     await self._past_queue.term()
     return coros
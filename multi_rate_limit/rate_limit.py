@@ -2,14 +2,20 @@
 """
 import abc
 import aiofiles
+import asyncio
 import bisect
+import mmap
 import os
+import struct
+import time
 
 from aiofiles.os import replace, wrap
 from aiofiles.threadpool.text import AsyncTextIOWrapper
-from collections import deque
+from array import array
+from dataclasses import dataclass
+from enum import Enum
 from os.path import isfile
-from typing import List, Optional, Tuple
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
 
 class RateLimit:
   """Class to define a single resource limit.
@@ -105,6 +111,25 @@ class DayRateLimit(RateLimit):
     """
     super().__init__(resource_limit, 86400 * period_in_days)
 
+class TokenBucketRateLimit(RateLimit):
+  """Variant of RateLimit as a token bucket, which is equivalent to GCRA (Generic Cell Rate Algorithm).
+
+  Instead of a sliding window over the history of resource usage, the bucket is filled by resource usage
+  and drains at a constant rate of resource_limit per period, and it must never overflow.
+  So a burst of up to resource_limit is allowed, and then the resource can be used at the drain rate.
+  Only a time is kept for each bucket without the history, and it can be mixed with the other RateLimits.
+  The state of the buckets is kept in memory and is not restored from the past queue.
+  """
+
+  def __init__(self, resource_limit: int, period_in_seconds: float):
+    """Create an object to define a single resource limit as a token bucket.
+
+    Args:
+        resource_limit (int): Capacity of the bucket, which is the largest burst.
+        period_in_seconds (float): Time for the full bucket to drain in seconds.
+    """
+    super().__init__(resource_limit, period_in_seconds)
+
 
 class ResourceOverwriteError(Exception):
   """Error to customize resource usage.
@@ -146,6 +171,35 @@ class ResourceOverwriteError(Exception):
     return f'MultiRateLimitError: time={self.use_time}, res={self.use_resources}, cause={self.cause}'
 
 
+class ReservationExpiredError(Exception):
+  """Error set to the future of a reservation that could not start by its deadline.
+
+  Attributes:
+      deadline (float): The deadline compatible with time.time().
+      predicted (Optional[float]): The predicted start time compatible with time.time(),
+          if it was expired before the deadline because the prediction was after it.
+  """
+
+  def __init__(self, deadline: float, predicted: Optional[float] = None):
+    """Create an error for a reservation that could not start by its deadline.
+
+    Args:
+        deadline (float): The deadline compatible with time.time().
+        predicted (Optional[float], optional): The predicted start time compatible with time.time(),
+            if it was expired before the deadline because the prediction was after it. Defaults to None.
+    """
+    self.deadline = deadline
+    self.predicted = predicted
+
+  def __str__(self) -> str:
+    """Return exception information as a string.
+
+    Returns:
+        str: Exception information as a string.
+    """
+    return f'ReservationExpiredError: deadline={self.deadline}, predicted={self.predicted}'
+
+
 class IPastResourceQueue(metaclass=abc.ABCMeta):
   """Interface to customize how used resources are managed.
   """
@@ -182,6 +236,36 @@ class IPastResourceQueue(metaclass=abc.ABCMeta):
         float: The last timing compatible with time.time() when resource usage falls within the specified amount.
     """
     raise NotImplementedError()
+
+  async def sum_resource_after_batch(self, times: List[List[float]]) -> List[List[int]]:
+    """Returns the amounts of resources used after each of the specified times, for every resource at once.
+
+    By default, sum_resource_after is called for each time.
+    Override this to answer in a single call, for example for a remote backend.
+
+    Args:
+        times (List[List[float]]): The specified times compatible with time.time() for each resource.
+
+    Returns:
+        List[List[int]]: The amounts of resources used after each of the specified times, in the same shape as times.
+    """
+    return await asyncio.gather(*[asyncio.gather(*[self.sum_resource_after(t, i) for t in ts]) for i, ts in enumerate(times)])
+
+  async def time_accum_resource_within_batch(self, amounts: List[List[int]]) -> List[List[float]]:
+    """Returns the last timings when resource usage falls within each of the specified amounts, for every resource at once.
+
+    By default, time_accum_resource_within is called for each amount.
+    Override this to answer in a single call, for example for a remote backend.
+
+    Args:
+        amounts (List[List[int]]): The specified amounts for each resource.
+
+    Returns:
+        List[List[float]]: The last timings compatible with time.time() when resource usage falls within
+            each of the specified amounts, in the same shape as amounts.
+    """
+    return await asyncio.gather(*[asyncio.gather(*[self.time_accum_resource_within(i, a) for a in ams])
+        for i, ams in enumerate(amounts)])
   
   @abc.abstractmethod
   async def add(self, use_time: float, use_resources: List[int]) -> None:
@@ -211,16 +295,173 @@ class IPastResourceQueue(metaclass=abc.ABCMeta):
     raise NotImplementedError()
 
 
-class FilePastResourceQueue(IPastResourceQueue):
-  """Class to manage resource usage with memory and file(Optional).
+class ISyncPastResourceQueue(IPastResourceQueue):
+  """Interface for IPastResourceQueue implementations that can answer queries without waiting.
+
+  MultiRateLimit calls the synchronous methods directly instead of awaiting the asynchronous ones,
+  which is much cheaper for in-memory lookups.
+  Only the queries are synchronous; add and term remain asynchronous.
+  """
+
+  @abc.abstractmethod
+  def sum_resource_after_sync(self, time: float, order: int) -> int:
+    """Returns the amount of resources of specified order used after the specified time.
+
+    If the specified time is before the last resource use beyond the period passed at the constructor,
+    it is okay to return incorrect information.
+    This allows old information unrelated to resource limit management to be forgotten.
+
+    Args:
+        time (float): The specified time compatible with time.time().
+        order (int): The order of resource.
+
+    Returns:
+        int: The amount of resources of specified order used after the specified time.
+    """
+    raise NotImplementedError()
+
+  @abc.abstractmethod
+  def time_accum_resource_within_sync(self, order: int, amount: int) -> float:
+    """Returns the last timing when resource usage falls within the specified amount.
+
+    Returns the latest timing at which the cumulative amount of resource usage
+    exceeds the specified amount, going back from the current time.
+
+    Args:
+        order (int): The order of resource.
+        amount (int): The specified amount.
+
+    Returns:
+        float: The last timing compatible with time.time() when resource usage falls within the specified amount.
+    """
+    raise NotImplementedError()
+
+  async def sum_resource_after(self, time: float, order: int) -> int:
+    """Returns the amount of resources of specified order used after the specified time.
+
+    If the specified time is before the last resource use beyond the period passed at the constructor,
+    it is okay to return incorrect information.
+    This allows old information unrelated to resource limit management to be forgotten.
+
+    Args:
+        time (float): The specified time compatible with time.time().
+        order (int): The order of resource.
+
+    Returns:
+        int: The amount of resources of specified order used after the specified time.
+    """
+    return self.sum_resource_after_sync(time, order)
+
+  async def time_accum_resource_within(self, order: int, amount: int) -> float:
+    """Returns the last timing when resource usage falls within the specified amount.
+
+    Returns the latest timing at which the cumulative amount of resource usage
+    exceeds the specified amount, going back from the current time.
+
+    Args:
+        order (int): The order of resource.
+        amount (int): The specified amount.
+
+    Returns:
+        float: The last timing compatible with time.time() when resource usage falls within the specified amount.
+    """
+    return self.time_accum_resource_within_sync(order, amount)
+
+  def sum_resource_after_batch_sync(self, times: List[List[float]]) -> List[List[int]]:
+    """Returns the amounts of resources used after each of the specified times, for every resource at once.
+
+    By default, sum_resource_after_sync is called for each time.
+
+    Args:
+        times (List[List[float]]): The specified times compatible with time.time() for each resource.
+
+    Returns:
+        List[List[int]]: The amounts of resources used after each of the specified times, in the same shape as times.
+    """
+    return [[self.sum_resource_after_sync(t, i) for t in ts] for i, ts in enumerate(times)]
+
+  def time_accum_resource_within_batch_sync(self, amounts: List[List[int]]) -> List[List[float]]:
+    """Returns the last timings when resource usage falls within each of the specified amounts, for every resource at once.
+
+    By default, time_accum_resource_within_sync is called for each amount.
+
+    Args:
+        amounts (List[List[int]]): The specified amounts for each resource.
+
+    Returns:
+        List[List[float]]: The last timings compatible with time.time() when resource usage falls within
+            each of the specified amounts, in the same shape as amounts.
+    """
+    return [[self.time_accum_resource_within_sync(i, a) for a in ams] for i, ams in enumerate(amounts)]
+
+  def set_windows(self, periods: List[List[float]]) -> None:
+    """Register the periods of the windows that are queried repeatedly with sum_resource_windows_sync.
+
+    Args:
+        periods (List[List[float]]): The periods in seconds of the windows for each resource.
+    """
+    self._window_periods: List[List[float]] = [[*ps] for ps in periods]
+
+  def sum_resource_windows_sync(self, current_time: float) -> List[List[int]]:
+    """Returns the amounts of resources used within each registered window ending at the current time.
+
+    By default, sum_resource_after_batch_sync is called with the start times of the windows.
+
+    Args:
+        current_time (float): The current time compatible with time.time().
+
+    Returns:
+        List[List[int]]: The amounts of resources used within each window, in the same shape as the registered periods.
+    """
+    return self.sum_resource_after_batch_sync([[current_time - p for p in ps] for ps in self._window_periods])
+
+  async def sum_resource_after_batch(self, times: List[List[float]]) -> List[List[int]]:
+    """Returns the amounts of resources used after each of the specified times, for every resource at once.
+
+    Args:
+        times (List[List[float]]): The specified times compatible with time.time() for each resource.
+
+    Returns:
+        List[List[int]]: The amounts of resources used after each of the specified times, in the same shape as times.
+    """
+    return self.sum_resource_after_batch_sync(times)
+
+  async def time_accum_resource_within_batch(self, amounts: List[List[int]]) -> List[List[float]]:
+    """Returns the last timings when resource usage falls within each of the specified amounts, for every resource at once.
+
+    Args:
+        amounts (List[List[int]]): The specified amounts for each resource.
+
+    Returns:
+        List[List[float]]: The last timings compatible with time.time() when resource usage falls within
+            each of the specified amounts, in the same shape as amounts.
+    """
+    return self.time_accum_resource_within_batch_sync(amounts)
+
+
+class ArrayPastResourceQueue(ISyncPastResourceQueue):
+  """Class to manage resource usage in memory with contiguous columnar arrays.
+
+  Resource usage times and cumulative resource usages are kept column by column in typed arrays,
+  so that every lookup is a true O(log n) binary search.
+  Old information is forgotten by advancing the head position, and the arrays are compacted
+  only after more than half of them have become unnecessary, so trimming is amortized O(1).
 
   Attributes:
-      _time_resource_queue (deque[Tuple[float, List[int]]]): Queue to manage resource usage.
+      _times (array): Resource usage times in ascending order.
+      _accum_resources (List[array]): Cumulative resource usages for each resource.
+      _head (int): Position of the oldest information still in use.
       _longest_period_in_seconds (float): Information before this is forgotten.
-      _file_path (Optional[str]): File name to use when you want to reuse resource usage information in another execution.
-          If the file does not exist, it will be created automatically.
+      _window_periods (List[List[float]]): The periods of the registered windows for each resource.
+      _window_cursors (Dict[float, int]): For each distinct registered period,
+          the position of the last information at or before the start of the window when last queried.
   """
 
+  # Do not compact the arrays while the unused part is smaller than this.
+  _MIN_COMPACT_SIZE = 1024
+  # Search by bisection instead when a window cursor has to move further than this.
+  _MAX_CURSOR_STEPS = 8
+
   def __init__(self, len_resource: int, longest_period_in_seconds: float):
     """Create a queue to manage past resouce usages with memory.
 
@@ -229,12 +470,350 @@ class FilePastResourceQueue(IPastResourceQueue):
         longest_period_in_seconds (float): How far in the past should information be remembered?
     """
     # Append the first element with time and accumulated resource usages.
-    self._time_resource_queue: deque[Tuple[float, List[int]]] = deque([(0, [0 for _ in range(len_resource)])])
+    self._times: array = array('d', [0])
+    self._accum_resources: List[array] = [array('q', [0]) for _ in range(len_resource)]
+    self._head: int = 0
     self._longest_period_in_seconds: float = longest_period_in_seconds
+    self._window_periods: List[List[float]] = []
+    self._window_cursors: Dict[float, int] = {}
+
+  @classmethod
+  async def create(cls, len_resource: int, longest_period_in_seconds: float):
+    """Create a queue to manage past resouce usages with memory.
+
+    Args:
+        len_resource (int): Number of resource types.
+        longest_period_in_seconds (float): How far in the past should information be remembered?
+
+    Returns:
+        _type_: An class to manage resource usage with memory.
+    """
+    return cls(len_resource, longest_period_in_seconds)
+
+  def __len__(self) -> int:
+    """Returns the number of resource information in use.
+
+    Returns:
+        int: The number of resource information in use.
+    """
+    return len(self._times) - self._head
+
+  def __getitem__(self, pos: int) -> Tuple[float, List[int]]:
+    """Returns the resource information at the specified position.
+
+    Args:
+        pos (int): The position from the oldest information. Negative values count from the latest.
+
+    Raises:
+        IndexError: If the position is out of range.
+
+    Returns:
+        Tuple[float, List[int]]: Resource usage time and cumulative resource usages.
+    """
+    if pos < 0:
+      pos += len(self)
+    if pos < 0 or pos >= len(self):
+      raise IndexError(f'Position out of range : {pos}')
+    pos += self._head
+    return self._times[pos], [accum[pos] for accum in self._accum_resources]
+
+  def __iter__(self) -> Iterator[Tuple[float, List[int]]]:
+    """Iterate resource information from the oldest.
+
+    Yields:
+        Tuple[float, List[int]]: Resource usage time and cumulative resource usages.
+    """
+    for pos in range(len(self)):
+      yield self[pos]
+
+  def _append(self, use_time: float, accum_resources: List[int]) -> None:
+    """Append resource information as it is.
+
+    Args:
+        use_time (float): Resource usage time.
+        accum_resources (List[int]): Cumulative resource usages.
+    """
+    self._times.append(use_time)
+    for accum, r in zip(self._accum_resources, accum_resources):
+      accum.append(r)
+
+  def pos_time_after(self, time: float) -> int:
+    """Returns the position on the first resource information queue after the specified time.
+
+    If there is no match, return the queue length.
+
+    Args:
+        time (float): The specified time.
+
+    Returns:
+        int: The position on the first resource information queue after the specified time.
+    """
+    return bisect.bisect_right(self._times, time, self._head) - self._head
+
+  def sum_resource_after_sync(self, time: float, order: int) -> int:
+    """Returns the amount of resources of specified order used after the specified time.
+
+    If the specified time is before the last resource use beyond the period passed at the constructor,
+    it is okay to return incorrect information.
+    This allows old information unrelated to resource limit management to be forgotten.
+
+    Args:
+        time (float): The specified time compatible with time.time().
+        order (int): The order of resource.
+
+    Returns:
+        int: The amount of resources of specified order used after the specified time.
+    """
+    pos = bisect.bisect_right(self._times, time, self._head)
+    accum = self._accum_resources[order]
+    return accum[-1] - accum[max(self._head, pos - 1)]
+
+  def pos_accum_resouce_within(self, order: int, amount: int) -> int:
+    """Returns the last index in the queue when resource usage falls within the specified amount.
+
+    Returns the latest index at which the cumulative amount of resource usage
+    exceeds the specified amount, going back from the end of the queue.
+
+    Args:
+        order (int): The order of resource.
+        amount (int): The specified amount.
+
+    Returns:
+        int: The last index in the queue when resource usage falls within the specified amount.
+    """
+    accum = self._accum_resources[order]
+    return bisect.bisect_left(accum, accum[-1] - amount, self._head) - self._head
+
+  def time_accum_resource_within_sync(self, order: int, amount: int) -> float:
+    """Returns the last timing when resource usage falls within the specified amount.
+
+    Returns the latest timing at which the cumulative amount of resource usage
+    exceeds the specified amount, going back from the current time.
+
+    Args:
+        order (int): The order of resource.
+        amount (int): The specified amount.
+
+    Returns:
+        float: The last timing compatible with time.time() when resource usage falls within the specified amount.
+    """
+    return self._times[self._head + self.pos_accum_resouce_within(order, amount)]
+
+  def sum_resource_after_batch_sync(self, times: List[List[float]]) -> List[List[int]]:
+    """Returns the amounts of resources used after each of the specified times, for every resource at once.
+
+    The distinct times are searched in ascending order, each search starting from the previous position,
+    so that windows shared by several resources are searched only once.
+
+    Args:
+        times (List[List[float]]): The specified times compatible with time.time() for each resource.
+
+    Returns:
+        List[List[int]]: The amounts of resources used after each of the specified times, in the same shape as times.
+    """
+    time_to_pos: Dict[float, int] = {}
+    pos = self._head
+    for t in sorted({t for ts in times for t in ts}):
+      pos = bisect.bisect_right(self._times, t, pos)
+      time_to_pos[t] = max(self._head, pos - 1)
+    return [[accum[-1] - accum[time_to_pos[t]] for t in ts] for accum, ts in zip(self._accum_resources, times)]
+
+  def time_accum_resource_within_batch_sync(self, amounts: List[List[int]]) -> List[List[float]]:
+    """Returns the last timings when resource usage falls within each of the specified amounts, for every resource at once.
+
+    For each resource, the amounts are searched in descending order, each search starting from the previous position.
+
+    Args:
+        amounts (List[List[int]]): The specified amounts for each resource.
+
+    Returns:
+        List[List[float]]: The last timings compatible with time.time() when resource usage falls within
+            each of the specified amounts, in the same shape as amounts.
+    """
+    result: List[List[float]] = []
+    for accum, ams in zip(self._accum_resources, amounts):
+      amount_to_time: Dict[int, float] = {}
+      pos = self._head
+      for a in sorted(set(ams), reverse=True):
+        pos = bisect.bisect_left(accum, accum[-1] - a, pos)
+        amount_to_time[a] = self._times[pos]
+      result.append([amount_to_time[a] for a in ams])
+    return result
+
+  def set_windows(self, periods: List[List[float]]) -> None:
+    """Register the periods of the windows that are queried repeatedly with sum_resource_windows_sync.
+
+    Args:
+        periods (List[List[float]]): The periods in seconds of the windows for each resource.
+    """
+    self._window_periods = [[*ps] for ps in periods]
+    self._window_cursors = {p: self._head for ps in periods for p in ps}
+
+  def sum_resource_windows_sync(self, current_time: float) -> List[List[int]]:
+    """Returns the amounts of resources used within each registered window ending at the current time.
+
+    Each window keeps a cursor at the start of the window, which only moves forward as time advances,
+    so that a query is amortized O(1) for each window.
+    If the current time goes backward, the cursor is searched again by bisection.
+
+    Args:
+        current_time (float): The current time compatible with time.time().
+
+    Returns:
+        List[List[int]]: The amounts of resources used within each window, in the same shape as the registered periods.
+    """
+    times = self._times
+    end = len(times) - 1
+    for p, pos in self._window_cursors.items():
+      time = current_time - p
+      pos = max(self._head, pos)
+      if times[pos] > time:
+        pos = max(self._head, bisect.bisect_right(times, time, self._head) - 1)
+      else:
+        steps = 0
+        while pos < end and times[pos + 1] <= time:
+          pos += 1
+          steps += 1
+          if steps >= self._MAX_CURSOR_STEPS:
+            pos = bisect.bisect_right(times, time, pos) - 1
+            break
+      self._window_cursors[p] = pos
+    return [[accum[-1] - accum[self._window_cursors[p]] for p in ps]
+        for accum, ps in zip(self._accum_resources, self._window_periods)]
+
+  def _add(self, use_time: float, use_resources: List[int]) -> bool:
+    """Add resource usage information to memory.
+
+    Args:
+        use_time (float): Resource usage time compatible with time.time().
+        use_resources (List[int]): Resource usage amounts.
+
+    Returns:
+        bool: True if a new information is appended, False if merged into the last.
+    """
+    last_time = self._times[-1]
+    if use_time <= last_time:
+      # Never add before last registered time
+      # For search uniqueness, information from the same time is merged.
+      for accum, r in zip(self._accum_resources, use_resources):
+        accum[-1] += r
+      return False
+    # Append the last
+    self._append(use_time, [accum[-1] + r for accum, r in zip(self._accum_resources, use_resources)])
+    self._trim()
+    return True
+
+  async def add(self, use_time: float, use_resources: List[int]) -> None:
+    """Add resource usage information.
+
+    Cancel from MultiRateLimit is protected by shield,
+    so it can be executed until the end unless you cancel it yourself.
+    On the other hand, there is a possibility that another function will be called before completion,
+    so if you use await internally, you need to properly make newcoming functions wait so that the integrity is not compromised.
+
+    In this implementation, if you try to add information with a time before the existing last resource usage information,
+    the resource will be forced to be used at the time of the last resource usage.
+
+    Args:
+        use_time (float): Resource usage time compatible with time.time().
+        use_resources (List[int]): Resource usage amounts.
+            The length of list must be same as the number of resources.
+            Each resource usage amaount must not be negative.
+    """
+    self._add(use_time, use_resources)
+
+  def _trim(self) -> None:
+    """Cut unnecessary old information.
+    """
+    last_time = self._times[-1]
+    pos = bisect.bisect_right(self._times, last_time - self._longest_period_in_seconds, self._head)
+    # To obtain the difference, one additional previous information is required.
+    self._head = max(self._head, pos - 1)
+    # Compact only when more than half is unnecessary, so that each trim is amortized O(1).
+    if self._head >= self._MIN_COMPACT_SIZE and 2 * self._head >= len(self._times):
+      del self._times[:self._head]
+      for accum in self._accum_resources:
+        del accum[:self._head]
+      # Cursors behind the head are moved to the head on the next query
+      self._window_cursors = {p: max(0, pos - self._head) for p, pos in self._window_cursors.items()}
+      self._head = 0
+
+  async def term(self) -> None:
+    """Called when finished. Do nothing.
+    """
+    pass
+
+
+class FsyncPolicy(Enum):
+  """When to fsync the journal of FilePastResourceQueue.
+
+  Attributes:
+      NONE: Never fsync while running, leave it to the OS.
+      INTERVAL: Fsync at most once per flush interval, and when finished.
+      EVERY_BATCH: Fsync after every batch is written.
+  """
+  NONE = 'none'
+  INTERVAL = 'interval'
+  EVERY_BATCH = 'every_batch'
+
+
+@dataclass
+class JournalPolicy:
+  """Class to define how FilePastResourceQueue buffers appends to the file.
+
+  Attributes:
+      flush_size (int): Number of buffered records that triggers a batch write.
+      flush_interval_in_seconds (float): Longest time a record stays only in memory.
+      fsync_policy (FsyncPolicy): When to fsync the written batches.
+  """
+  flush_size: int = 256
+  flush_interval_in_seconds: float = 1.0
+  fsync_policy: FsyncPolicy = FsyncPolicy.NONE
+
+
+class FilePastResourceQueue(ArrayPastResourceQueue):
+  """Class to manage resource usage with memory and file(Optional).
+
+  Attributes:
+      _file_path (Optional[str]): File name to use when you want to reuse resource usage information in another execution.
+          If the file does not exist, it will be created automatically.
+      _journal_policy (Optional[JournalPolicy]): How to buffer appends to the file.
+          If None, each record is appended by opening and closing the file.
+      _journal_file (Optional[AsyncTextIOWrapper]): File handler kept open for buffered appends.
+      _journal_lines (List[str]): Records waiting to be written.
+      _journal_timer (Optional[TimerHandle]): Timer to write the waiting records by the flush interval.
+      _journal_task (Optional[Task]): Task writing the waiting records.
+      _file_lock (asyncio.Lock): Lock to keep the order of writes to the file.
+      _last_fsync_time (float): Last fsync time compatible with time.time().
+      _compaction_task (Optional[Task]): Task rewriting the file without unnecessary old information.
+      _compacted_time (float): The last time written by the compaction.
+  """
+
+  # Size of each block read backward from the end of the file at startup.
+  _READ_BLOCK_SIZE = 65536
+
+  def __init__(self, len_resource: int, longest_period_in_seconds: float):
+    """Create a queue to manage past resouce usages with memory.
+
+    Args:
+        len_resource (int): Number of resource types.
+        longest_period_in_seconds (float): How far in the past should information be remembered?
+    """
+    super().__init__(len_resource, longest_period_in_seconds)
     self._file_path: Optional[str] = None
+    self._journal_policy: Optional[JournalPolicy] = None
+    self._journal_file: Optional[AsyncTextIOWrapper] = None
+    self._journal_lines: List[str] = []
+    self._journal_timer: Optional[asyncio.TimerHandle] = None
+    self._journal_task: Optional[asyncio.Task] = None
+    self._file_lock = asyncio.Lock()
+    self._last_fsync_time: float = 0
+    self._compaction_task: Optional[asyncio.Task] = None
+    self._compacted_time: float = float('-inf')
   
   @classmethod
-  async def create(cls, len_resource: int, longest_period_in_seconds: float, file_path: Optional[str] = None):
+  async def create(cls, len_resource: int, longest_period_in_seconds: float, file_path: Optional[str] = None
+      , journal_policy: Optional[JournalPolicy] = None):
     """Create a queue to manage past resouce usages with memory and file(Optional).
 
     Args:
@@ -243,6 +822,10 @@ class FilePastResourceQueue(IPastResourceQueue):
         file_path (Optional[str], optional): File name to use when you want to reuse resource usage information in another execution.
             If the file does not exist, it will be created automatically.
             Defaults to None.
+        journal_policy (Optional[JournalPolicy], optional): How to buffer appends to the file.
+            If specified, the file is kept open and records are written in batches in the background,
+            so that term() must be called to write the last records.
+            Defaults to None, in which case each record is appended to the file immediately.
 
     Returns:
         _type_: An class to manage resource usage with memory and file(Optional).
@@ -251,8 +834,12 @@ class FilePastResourceQueue(IPastResourceQueue):
     queue._file_path = file_path
     if file_path is not None:
       await queue._read_file(file_path)
-      # Rewrite the file with unnecessary old information removed. 
-      await queue._write_file(file_path)
+      if journal_policy is not None:
+        queue._journal_policy = journal_policy
+        queue._journal_file = await aiofiles.open(file_path, mode = 'a')
+        queue._last_fsync_time = time.time()
+      # Rewrite the file with unnecessary old information removed in the background.
+      queue._compaction_task = asyncio.create_task(queue._compact_file())
     return queue
 
   def _parse_line(self, line: str) -> Tuple[float, List[int]]:
@@ -271,7 +858,7 @@ class FilePastResourceQueue(IPastResourceQueue):
     if len(line_core) == len(line):
       raise ValueError(f'Sudden file end : {line_core}')
     tokens = line_core.split('\t')
-    if len(tokens) != 1 + len(self._time_resource_queue[0][1]):
+    if len(tokens) != 1 + len(self._accum_resources):
       raise ValueError(f'Resource length mismatch : {line_core}')
     try:
       use_time = float(tokens[0])
@@ -288,35 +875,93 @@ class FilePastResourceQueue(IPastResourceQueue):
         use_time (float): Resource usage time.
         accum_resources (List[int]): Cumulative resource usages.
     """
+    await f.write(self._format_line(use_time, accum_resources))
+
+  def _format_line(self, use_time: float, accum_resources: List[int]) -> str:
+    """Format resource usage information as a line of file.
+
+    Args:
+        use_time (float): Resource usage time.
+        accum_resources (List[int]): Cumulative resource usages.
+
+    Returns:
+        str: A line of resource information with the line terminator.
+    """
     line = '\t'.join([str(v) for v in [use_time, *accum_resources]])
-    await f.write(f'{line}\n')
+    return f'{line}\n'
 
   async def _read_file(self, file_path: str) -> None:
     """Read resource information from file and set internally.
 
+    The file is read backward from the end, and only the information within the longest period
+    and one additional previous information are read, so that startup does not depend on the file size.
+
     Args:
         file_path (str): File name to use when you want to reuse resource usage information in another execution.
             If the file does not exist, it will be skipped automatically.
+
+    Raises:
+        ValueError: In case of abnormal resource information.
     """
     if not await wrap(isfile)(file_path):
       # Ignore if file does not exist
       return
-    async with aiofiles.open(file_path) as f:
-      async for line in f:
-        self._time_resource_queue.append(self._parse_line(line))
-      self._trim()
+    records: List[Tuple[float, List[int]]] = []
+    async with aiofiles.open(file_path, mode = 'rb') as f:
+      pos = await f.seek(0, os.SEEK_END)
+      buffer = b''
+      # The lines before this are not read yet
+      end = 0
+      while end > 0 or pos > 0:
+        line_start = buffer.rfind(b'\n', 0, max(0, end - 1)) + 1
+        if line_start <= 0 and pos > 0:
+          # The line may continue to the previous block
+          size = min(self._READ_BLOCK_SIZE, pos)
+          pos -= size
+          await f.seek(pos)
+          buffer = await f.read(size) + buffer[:end]
+          if end <= 0 and not buffer.endswith(b'\n'):
+            last_line = buffer[buffer.rfind(b'\n') + 1:].decode()
+            raise ValueError(f'Sudden file end : {last_line}')
+          end = len(buffer)
+          continue
+        records.append(self._parse_line(buffer[line_start:end].decode()))
+        end = line_start
+        # One additional previous information is required to obtain the difference.
+        if records[-1][0] <= records[0][0] - self._longest_period_in_seconds:
+          break
+    for record in reversed(records):
+      self._append(*record)
+    self._trim()
   
-  async def _write_file(self, file_path: str) -> None:
+  async def _compact_file(self) -> None:
+    """Rewrite the file with unnecessary old information removed.
+
+    Records added during the compaction are written to the new file afterwards.
+    """
+    async with self._file_lock:
+      # Records buffered or waiting to be appended are in memory, so they are written by the snapshot.
+      records = list(self)
+      self._compacted_time = records[-1][0]
+      self._journal_lines = []
+      if self._journal_file is not None:
+        await self._journal_file.close()
+      await self._write_file(self._file_path, records)
+      if self._journal_file is not None:
+        self._journal_file = await aiofiles.open(self._file_path, mode = 'a')
+
+  async def _write_file(self, file_path: str, records: List[Tuple[float, List[int]]]) -> None:
     """Write resource information to file.
 
     Args:
         file_path (str): File name to use when you want to reuse resource usage information in another execution.
             If the file does not exist, it will be created automatically.
+        records (List[Tuple[float, List[int]]]): Resource usage times and cumulative resource usages to write.
     """
     # Write to a work file
     work_file_path = str(file_path) + '._work_'
     async with aiofiles.open(work_file_path, mode = 'w') as f:
-      for use_time, use_resources in self._time_resource_queue:
+      for use_time, use_resources in records:
         await self._write_line(f, use_time, use_resources)
       await f.flush()
       await wrap(os.fsync)(f.fileno())
@@ -331,9 +976,333 @@ class FilePastResourceQueue(IPastResourceQueue):
         use_time (float): Resource usage time.
         accum_resources (List[int]): Cumulative resource usages.
     """
-    async with aiofiles.open(file_path, mode = 'a') as f:
-      await self._write_line(f, use_time, accum_resources)
+    async with self._file_lock:
+      if use_time <= self._compacted_time:
+        # Already written by the compaction
+        return
+      async with aiofiles.open(file_path, mode = 'a') as f:
+        await self._write_line(f, use_time, accum_resources)
+
+  def _append_journal(self, use_time: float, accum_resources: List[int]) -> None:
+    """Buffer resource information and schedule a batch write by size or interval.
+
+    Args:
+        use_time (float): Resource usage time.
+        accum_resources (List[int]): Cumulative resource usages.
+    """
+    self._journal_lines.append(self._format_line(use_time, accum_resources))
+    if len(self._journal_lines) >= self._journal_policy.flush_size:
+      self._schedule_flush()
+    elif self._journal_timer is None:
+      self._journal_timer = asyncio.get_running_loop().call_later(
+          self._journal_policy.flush_interval_in_seconds, self._schedule_flush)
+
+  def _schedule_flush(self) -> None:
+    """Start writing the buffered records in the background unless it is already running.
+    """
+    if self._journal_timer is not None:
+      self._journal_timer.cancel()
+      self._journal_timer = None
+    if self._journal_task is None or self._journal_task.done():
+      self._journal_task = asyncio.create_task(self._flush_journal())
+
+  async def _flush_journal(self, force_fsync: bool = False) -> None:
+    """Write all buffered records to the file.
+
+    Args:
+        force_fsync (bool, optional): If true, fsync unless the policy is FsyncPolicy.NONE. Defaults to False.
+    """
+    async with self._file_lock:
+      policy = self._journal_policy.fsync_policy
+      # Records added while writing are written by the next batch.
+      while len(self._journal_lines) > 0:
+        lines, self._journal_lines = self._journal_lines, []
+        await self._journal_file.write(''.join(lines))
+        await self._journal_file.flush()
+        if policy == FsyncPolicy.EVERY_BATCH or (policy == FsyncPolicy.INTERVAL
+            and time.time() - self._last_fsync_time >= self._journal_policy.flush_interval_in_seconds):
+          await self._fsync_journal()
+      if force_fsync and policy != FsyncPolicy.NONE:
+        await self._fsync_journal()
+
+  async def _fsync_journal(self) -> None:
+    """Fsync the journal file.
+    """
+    await wrap(os.fsync)(self._journal_file.fileno())
+    self._last_fsync_time = time.time()
   
+  async def add(self, use_time: float, use_resources: List[int]) -> None:
+    """Add resource usage information.
+
+    Cancel from MultiRateLimit is protected by shield,
+    so it can be executed until the end unless you cancel it yourself.
+    On the other hand, there is a possibility that another function will be called before completion,
+    so if you use await internally, you need to properly make newcoming functions wait so that the integrity is not compromised.
+
+    In this implementation, if you try to add information with a time before the existing last resource usage information,
+    the resource will be forced to be used at the time of the last resource usage.
+
+    Args:
+        use_time (float): Resource usage time compatible with time.time().
+        use_resources (List[int]): Resource usage amounts.
+            The length of list must be same as the number of resources.
+            Each resource usage amaount must not be negative.
+    """
+    # Log output to file for data persistence
+    if self._add(use_time, use_resources) and self._file_path is not None:
+      if self._journal_file is not None:
+        self._append_journal(*self[-1])
+      else:
+        await self._append_file(self._file_path, *self[-1])
+
+  async def term(self) -> None:
+    """Called when finished. Wait for the compaction, and write the buffered records and close the file if journal is used.
+    """
+    if self._compaction_task is not None:
+      await self._compaction_task
+      self._compaction_task = None
+    if self._journal_file is None:
+      return
+    if self._journal_timer is not None:
+      self._journal_timer.cancel()
+      self._journal_timer = None
+    if self._journal_task is not None:
+      await self._journal_task
+    await self._flush_journal(True)
+    await self._journal_file.close()
+    self._journal_file = None
+
+
+class MmapPastResourceQueue(ISyncPastResourceQueue):
+  """Class to manage resource usage with a memory-mapped binary file.
+
+  The file consists of a header and a circular region of fixed-width records,
+  each of which is a float64 time followed by int64 cumulative resource usages in native byte order.
+  Since the records are read through the mapping as they are, restarts only map the file
+  and bisect it directly without parsing. The region grows automatically when it becomes full.
+
+  Attributes:
+      _len_resource (int): Number of resource types.
+      _longest_period_in_seconds (float): Information before this is forgotten.
+      _file (Optional[BinaryIO]): File object of the mapped file.
+      _mm (Optional[mmap.mmap]): Memory map of the file.
+      _times (Optional[memoryview]): View of the record region as float64.
+      _accums (Optional[memoryview]): View of the record region as int64.
+      _capacity (int): Number of records the circular region can hold.
+      _head (int): Slot of the oldest record in use.
+      _count (int): Number of records in use.
+  """
+
+  # Magic, number of resources, capacity, head slot and record count.
+  _HEADER = struct.Struct('=8sqqqq')
+  _MAGIC = b'MRLPQ\x00\x00\x01'
+
+  def __init__(self, len_resource: int, longest_period_in_seconds: float):
+    """Create a queue to manage past resouce usages with a memory-mapped file.
+
+    Use create() to open the file.
+
+    Args:
+        len_resource (int): Number of resource types.
+        longest_period_in_seconds (float): How far in the past should information be remembered?
+    """
+    self._len_resource: int = len_resource
+    self._longest_period_in_seconds: float = longest_period_in_seconds
+    self._file: Optional[BinaryIO] = None
+    self._mm: Optional[mmap.mmap] = None
+    self._times: Optional[memoryview] = None
+    self._accums: Optional[memoryview] = None
+    self._capacity: int = 0
+    self._head: int = 0
+    self._count: int = 0
+
+  @classmethod
+  async def create(cls, len_resource: int, longest_period_in_seconds: float, file_path: str, initial_capacity: int = 1024):
+    """Create a queue to manage past resouce usages with a memory-mapped file.
+
+    Args:
+        len_resource (int): Number of resource types.
+        longest_period_in_seconds (float): How far in the past should information be remembered?
+        file_path (str): File name to use when you want to reuse resource usage information in another execution.
+            If the file does not exist, it will be created automatically.
+        initial_capacity (int, optional): Number of records the file can hold when newly created. Defaults to 1024.
+
+    Raises:
+        ValueError: If the existing file is not for this class or the number of resources differs.
+
+    Returns:
+        _type_: An class to manage resource usage with a memory-mapped file.
+    """
+    queue = cls(len_resource, longest_period_in_seconds)
+    await wrap(queue._open)(str(file_path), max(2, initial_capacity))
+    queue._trim()
+    return queue
+
+  @classmethod
+  async def convert_from_tsv(cls, len_resource: int, longest_period_in_seconds: float, tsv_path: str, file_path: str) -> None:
+    """Convert a file of FilePastResourceQueue into the format of this class.
+
+    The TSV file is left as it is.
+
+    Args:
+        len_resource (int): Number of resource types.
+        longest_period_in_seconds (float): How far in the past should information be remembered?
+        tsv_path (str): File name used with FilePastResourceQueue.
+        file_path (str): File name to create for this class. If the file exists, it will be overwritten.
+    """
+    source = FilePastResourceQueue(len_resource, longest_period_in_seconds)
+    await source._read_file(tsv_path)
+    if await wrap(isfile)(file_path):
+      await wrap(os.remove)(file_path)
+    queue = await cls.create(len_resource, longest_period_in_seconds, file_path, len(source))
+    # The first record of the source is the baseline, which may be a trimmed record instead of zeros
+    queue._head, queue._count = 0, 0
+    for use_time, accum_resources in list(source):
+      queue._append(use_time, accum_resources)
+    await queue.term()
+
+  def _open(self, file_path: str, initial_capacity: int) -> None:
+    """Open or create the file and map it.
+
+    Args:
+        file_path (str): File name.
+        initial_capacity (int): Number of records the file can hold when newly created.
+
+    Raises:
+        ValueError: If the existing file is not for this class or the number of resources differs.
+    """
+    if isfile(file_path):
+      self._file = open(file_path, 'r+b')
+      magic, len_resource, capacity, head, count = self._HEADER.unpack(self._file.read(self._HEADER.size))
+      if magic != self._MAGIC or len_resource != self._len_resource:
+        self._file.close()
+        raise ValueError(f'Incompatible file : {magic}, {len_resource}')
+      self._capacity, self._head, self._count = capacity, head, count
+      self._map()
+    else:
+      self._file = open(file_path, 'w+b')
+      self._capacity = initial_capacity
+      self._file.truncate(self._file_size(self._capacity))
+      self._map()
+      # Append the first element with time and accumulated resource usages.
+      self._append(0, [0 for _ in range(self._len_resource)])
+
+  def _file_size(self, capacity: int) -> int:
+    """Returns the file size to hold the specified number of records.
+
+    Args:
+        capacity (int): Number of records.
+
+    Returns:
+        int: The file size in bytes.
+    """
+    return self._HEADER.size + 8 * (1 + self._len_resource) * capacity
+
+  def _map(self) -> None:
+    """Map the file and make views of the record region.
+    """
+    self._mm = mmap.mmap(self._file.fileno(), self._file_size(self._capacity))
+    region = memoryview(self._mm)[self._HEADER.size:]
+    self._times = region.cast('d')
+    self._accums = region.cast('q')
+    region.release()
+
+  def _unmap(self) -> None:
+    """Release the views and the map.
+    """
+    self._times.release()
+    self._accums.release()
+    self._mm.close()
+    self._times, self._accums, self._mm = None, None, None
+
+  def _write_header(self) -> None:
+    """Write the position of the circular region to the header.
+    """
+    self._HEADER.pack_into(self._mm, 0, self._MAGIC, self._len_resource, self._capacity, self._head, self._count)
+
+  def _index(self, pos: int) -> int:
+    """Returns the index of the view at which the record of the specified position starts.
+
+    Args:
+        pos (int): The position from the oldest record.
+
+    Returns:
+        int: The index of the view.
+    """
+    return ((self._head + pos) % self._capacity) * (1 + self._len_resource)
+
+  def __len__(self) -> int:
+    """Returns the number of resource information in use.
+
+    Returns:
+        int: The number of resource information in use.
+    """
+    return self._count
+
+  def __getitem__(self, pos: int) -> Tuple[float, List[int]]:
+    """Returns the resource information at the specified position.
+
+    Args:
+        pos (int): The position from the oldest information. Negative values count from the latest.
+
+    Raises:
+        IndexError: If the position is out of range.
+
+    Returns:
+        Tuple[float, List[int]]: Resource usage time and cumulative resource usages.
+    """
+    if pos < 0:
+      pos += self._count
+    if pos < 0 or pos >= self._count:
+      raise IndexError(f'Position out of range : {pos}')
+    index = self._index(pos)
+    return self._times[index], self._accums[index + 1:index + 1 + self._len_resource].tolist()
+
+  def __iter__(self) -> Iterator[Tuple[float, List[int]]]:
+    """Iterate resource information from the oldest.
+
+    Yields:
+        Tuple[float, List[int]]: Resource usage time and cumulative resource usages.
+    """
+    for pos in range(self._count):
+      yield self[pos]
+
+  def _append(self, use_time: float, accum_resources: List[int]) -> None:
+    """Append resource information as it is, growing the file if full.
+
+    Args:
+        use_time (float): Resource usage time.
+        accum_resources (List[int]): Cumulative resource usages.
+    """
+    if self._count >= self._capacity:
+      self._grow()
+    index = self._index(self._count)
+    self._times[index] = use_time
+    self._accums[index + 1:index + 1 + self._len_resource] = array('q', accum_resources)
+    # Update the header after the record so that a crash never exposes a broken record.
+    self._count += 1
+    self._write_header()
+
+  def _grow(self) -> None:
+    """Double the circular region, copying the records to the added half.
+
+    The added half holds none of the records in use, and the header is switched only after all of them are copied,
+    so that a crash while growing leaves the old layout as it is.
+    """
+    records = list(self)
+    old_capacity = self._capacity
+    self._unmap()
+    self._capacity *= 2
+    self._file.truncate(self._file_size(self._capacity))
+    self._map()
+    width = 1 + self._len_resource
+    for pos, (use_time, accum_resources) in enumerate(records):
+      index = (old_capacity + pos) * width
+      self._times[index] = use_time
+      self._accums[index + 1:index + width] = array('q', accum_resources)
+    self._head, self._count = old_capacity, len(records)
+    self._write_header()
+
   def pos_time_after(self, time: float) -> int:
     """Returns the position on the first resource information queue after the specified time.
 
@@ -345,9 +1314,16 @@ class FilePastResourceQueue(IPastResourceQueue):
     Returns:
         int: The position on the first resource information queue after the specified time.
     """
-    return bisect.bisect_right(self._time_resource_queue, time, key=lambda t: t[0])
-  
-  async def sum_resource_after(self, time: float, order: int) -> int:
+    lo, hi = 0, self._count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if time < self._times[self._index(mid)]:
+        hi = mid
+      else:
+        lo = mid + 1
+    return lo
+
+  def sum_resource_after_sync(self, time: float, order: int) -> int:
     """Returns the amount of resources of specified order used after the specified time.
 
     If the specified time is before the last resource use beyond the period passed at the constructor,
@@ -362,7 +1338,7 @@ class FilePastResourceQueue(IPastResourceQueue):
         int: The amount of resources of specified order used after the specified time.
     """
     pos = self.pos_time_after(time)
-    return self._time_resource_queue[-1][1][order] - self._time_resource_queue[max(0, pos - 1)][1][order]
+    return self._accums[self._index(self._count - 1) + 1 + order] - self._accums[self._index(max(0, pos - 1)) + 1 + order]
 
   def pos_accum_resouce_within(self, order: int, amount: int) -> int:
     """Returns the last index in the queue when resource usage falls within the specified amount.
@@ -377,10 +1353,17 @@ class FilePastResourceQueue(IPastResourceQueue):
     Returns:
         int: The last index in the queue when resource usage falls within the specified amount.
     """
-    last_amount = self._time_resource_queue[-1][1][order]
-    return bisect.bisect_left(self._time_resource_queue, last_amount - amount, key=lambda t: t[1][order])
-  
-  async def time_accum_resource_within(self, order: int, amount: int) -> float:
+    target = self._accums[self._index(self._count - 1) + 1 + order] - amount
+    lo, hi = 0, self._count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self._accums[self._index(mid) + 1 + order] < target:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def time_accum_resource_within_sync(self, order: int, amount: int) -> float:
     """Returns the last timing when resource usage falls within the specified amount.
 
     Returns the latest timing at which the cumulative amount of resource usage
@@ -393,9 +1376,8 @@ class FilePastResourceQueue(IPastResourceQueue):
     Returns:
         float: The last timing compatible with time.time() when resource usage falls within the specified amount.
     """
-    pos = self.pos_accum_resouce_within(order, amount)
-    return self._time_resource_queue[pos][0]
-  
+    return self._times[self._index(self.pos_accum_resouce_within(order, amount))]
+
   async def add(self, use_time: float, use_resources: List[int]) -> None:
     """Add resource usage information.
 
@@ -413,33 +1395,42 @@ class FilePastResourceQueue(IPastResourceQueue):
             The length of list must be same as the number of resources.
             Each resource usage amaount must not be negative.
     """
-    last_elem = self._time_resource_queue[-1]
-    if use_time <= last_elem[0]:
+    index = self._index(self._count - 1)
+    if use_time <= self._times[index]:
       # Never add before last registered time
-      use_time = last_elem[0]
       # For search uniqueness, information from the same time is merged.
-      use_resources = [x + y for x, y in zip(last_elem[1], use_resources)]
-      # Replace the last
-      self._time_resource_queue[-1] = use_time, use_resources
+      for i, r in enumerate(use_resources):
+        self._accums[index + 1 + i] += r
       return
-    # Append the last
-    self._time_resource_queue.append((use_time, [x + y for x, y in zip(last_elem[1], use_resources)]))
+    accum_resources = [self._accums[index + 1 + i] + r for i, r in enumerate(use_resources)]
+    if self._count >= self._capacity:
+      # Free slots before growing the file
+      self._trim(use_time)
+    self._append(use_time, accum_resources)
     self._trim()
-    # Log output to file for data persistence
-    if self._file_path is not None:
-      await self._append_file(self._file_path, *self._time_resource_queue[-1])
 
-  def _trim(self):
-    """Cut unnecessary old information.
+  def _trim(self, last_time: Optional[float] = None) -> None:
+    """Cut unnecessary old information by advancing the head of the circular region.
+
+    Args:
+        last_time (Optional[float], optional): The time of the latest information.
+            The default is None, in which case the time of the last record is used.
     """
-    # Delete old unnecessary information
-    last_time = self._time_resource_queue[-1][0]
-    pos = self.pos_time_after(last_time - self._longest_period_in_seconds)
+    if last_time is None:
+      last_time = self._times[self._index(self._count - 1)]
     # To obtain the difference, one additional previous information is required.
-    for _ in range(max(0, pos - 1)):
-      self._time_resource_queue.popleft()
+    drop = max(0, self.pos_time_after(last_time - self._longest_period_in_seconds) - 1)
+    if drop > 0:
+      self._head = (self._head + drop) % self._capacity
+      self._count -= drop
+      self._write_header()
 
   async def term(self) -> None:
-    """Called when finished. Do nothing.
+    """Called when finished. Flush and close the file.
     """
-    pass
+    if self._mm is None:
+      return
+    self._mm.flush()
+    self._unmap()
+    self._file.close()
+    self._file = None
@@ -1,27 +1,108 @@
 """Classes for internal use.
 """
-from asyncio import create_task, Future, Task
-from typing import Any, Coroutine, Dict, List, Optional, Tuple
+from asyncio import create_task, Future, iscoroutine, Task
+from collections import deque
+from collections.abc import Mapping
+from heapq import heapify, heappop, heappush, heapreplace, merge
+from math import inf, nextafter
+from operator import add, ge, mul, sub
+from typing import Any, Callable, Coroutine, Deque, Dict, Hashable, List, Optional, Tuple, Union
 
 from multi_rate_limit.rate_limit import ResourceOverwriteError
 
 
-def check_resources(resources: List[float], len_res: int) -> List[float]:
+def check_resources(resources: Union[List[float], Mapping[int, float]], len_res: int) -> List[float]:
+  if isinstance(resources, Mapping):
+    return to_dense(check_sparse_resources(resources, len_res), len_res)
   if len(resources) != len_res or 0 > min(resources):
     raise ValueError(f'Invalid resources with invalid length or negative values : {resources} : {len_res}')
   # Copy for overwrite safety
   return [*resources]
 
 
+def check_sparse_resources(resources: Mapping[int, float], len_res: int) -> Dict[int, float]:
+  # Copy only the used resources by their indices, as a dict that tells it from a dense list
+  sparse: Dict[int, float] = {}
+  for i, r in resources.items():
+    if not isinstance(i, int) or not 0 <= i < len_res or 0 > r:
+      raise ValueError(f'Invalid resources with invalid indices or negative values : {resources} : {len_res}')
+    if r > 0:
+      sparse[i] = r
+  return sparse
+
+
+def to_dense(resources: Union[List[float], Dict[int, float]], len_res: int) -> List[float]:
+  if not isinstance(resources, dict):
+    return resources
+  dense: List[float] = [0] * len_res
+  for i, r in resources.items():
+    dense[i] = r
+  return dense
+
+
+def add_resources(sums: List[float], resources: Union[List[float], Dict[int, float]]) -> None:
+  # In place, touching only the used ones of sparse resources
+  if isinstance(resources, dict):
+    for i, r in resources.items():
+      sums[i] += r
+  else:
+    sums[:] = map(add, sums, resources)
+
+
+def sub_resources(sums: List[float], resources: Union[List[float], Dict[int, float]]) -> None:
+  if isinstance(resources, dict):
+    for i, r in resources.items():
+      sums[i] -= r
+  else:
+    sums[:] = map(sub, sums, resources)
+
+
+def within(rooms: List[float], resources: Union[List[float], Dict[int, float]]) -> bool:
+  # Sparse resources are compared only where used, so the caller ensures that the others have room of 0 or more
+  if isinstance(resources, dict):
+    return all([r <= rooms[i] for i, r in resources.items()])
+  return all(map(ge, rooms, resources))
+
+
+class LazyCoroutine:
+  # Lighter than functools.partial, which has its own dictionary
+  __slots__ = ('func', 'args', 'kwargs')
+
+  def __init__(self, func: Callable[..., Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]]
+      , args: Tuple[Any, ...], kwargs: Optional[Dict[str, Any]]):
+    self.func = func
+    self.args = args
+    self.kwargs = kwargs
+
+  def __call__(self) -> Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]:
+    if self.kwargs is None:
+      return self.func(*self.args)
+    return self.func(*self.args, **self.kwargs)
+
+  def __repr__(self) -> str:
+    return f'LazyCoroutine({self.func!r}, {self.args!r}, {self.kwargs!r})'
+
+
+class RunningRecord:
+  # Reused for each position of the current buffer, where use_resources is None while empty
+  __slots__ = ('use_resources', 'task', 'future', 'start_time')
+
+  def __init__(self):
+    self.use_resources: Optional[Union[List[int], Dict[int, int]]] = None
+    self.task: Optional[Task[Tuple[Optional[Tuple[float, List[int]]], Any]]] = None
+    # Future returned to client
+    self.future: Optional[Future[Any]] = None
+    # Used to charge resources at dispatch
+    self.start_time: Optional[float] = None
+
+
 class CurrentResourceBuffer:
   def __init__(self, len_resource: int, max_async_run: int):
-    # Candidate amount list to use resources
-    self.resource_buffer: List[Optional[List[int]]] = [None for i in range(max_async_run)]
-    self.task_buffer: List[Optional[Task[Tuple[Optional[Tuple[float, List[int]]], Any]]]] = [None for i in range(max_async_run)]
-    # Future list returned to client
-    self.future_buffer: List[Optional[Future[Any]]] = [None for i in range(max_async_run)]
-    # Next buffer position for fast search
-    self.next: int = 0
+    self.max_async_run: int = max_async_run
+    self.records: List[RunningRecord] = [RunningRecord() for _ in range(max_async_run)]
+    # Stack of empty positions, with the smallest on top at first
+    self.free: List[int] = [*range(max_async_run - 1, -1, -1)]
+    self.task_positions: Dict[Task[Tuple[Optional[Tuple[float, List[int]]], Any]], int] = {}
     self.active_run: int = 0
     self.sum_resources: List[int] = [0 for _ in range(len_resource)]
   
@@ -29,99 +110,413 @@ class CurrentResourceBuffer:
     return self.active_run <= 0
 
   def is_full(self) -> bool:
-    return self.active_run >= len(self.resource_buffer)
+    return len(self.free) <= 0
   
-  def start_coroutine(self, use_resources: List[int]
-      , coro: Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]], future: Future[Any]) -> bool:
+  def start_coroutine(self, use_resources: Union[List[int], Dict[int, int]]
+      , coro: Union[Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]
+      , Callable[[], Coroutine[Any, Any, Tuple[Optional[Tuple[float, List[int]]], Any]]]], future: Future[Any]
+      , done_callback: Optional[Callable[[Task[Tuple[Optional[Tuple[float, List[int]]], Any]]], None]] = None
+      , start_time: Optional[float] = None) -> bool:
     if self.is_full():
       return False
-    # Search an empty index
-    pos = self.next
-    while True:
-      if self.resource_buffer[pos] is None:
-        break
-      pos = (pos + 1) % len(self.resource_buffer)
-      if pos == self.next:
-        raise Exception(f'Unexpected buffer full with {self.active_run} / {len(self.resource_buffer)}')
+    # Create a coroutine reserved lazily
+    if not iscoroutine(coro):
+      try:
+        coro = coro()
+        if not iscoroutine(coro):
+          raise ValueError(f'Function did not return a coroutine : {coro}')
+      except Exception as e:
+        future.set_exception(e)
+        return False
     # Start a coroutine
-    task = create_task(coro, name=pos)
-    self.resource_buffer[pos] = use_resources
-    self.task_buffer[pos] = task
-    self.future_buffer[pos] = future
-    self.next = (pos + 1) % len(self.resource_buffer)
-    self.active_run += 1
-    self.sum_resources = [x + y for x, y in zip(self.sum_resources, use_resources)]
+    task = create_task(coro)
+    if done_callback is not None:
+      task.add_done_callback(done_callback)
+    self.task_positions[task] = self._occupy(use_resources, task, future, start_time)
     return True
+
+  def start_slot(self, use_resources: Union[List[int], Dict[int, int]], start_time: Optional[float] = None) -> Optional[int]:
+    # Occupy a position without a task, for work done by the caller's own task
+    if self.is_full():
+      return None
+    return self._occupy(use_resources, None, None, start_time)
+
+  def position(self, task: Task[Tuple[Optional[Tuple[float, List[int]]], Any]]) -> int:
+    return self.task_positions[task]
+
+  def end_slot(self, pos: int) -> Union[List[int], Dict[int, int]]:
+    use_resources = self.records[pos].use_resources
+    self._release(pos)
+    return use_resources
+
+  def _occupy(self, use_resources: Union[List[int], Dict[int, int]]
+      , task: Optional[Task[Tuple[Optional[Tuple[float, List[int]]], Any]]], future: Optional[Future[Any]]
+      , start_time: Optional[float]) -> int:
+    pos = self.free.pop()
+    record = self.records[pos]
+    record.use_resources = use_resources
+    record.task = task
+    record.future = future
+    record.start_time = start_time
+    self.active_run += 1
+    add_resources(self.sum_resources, use_resources)
+    return pos
+
+  def _release(self, pos: int) -> None:
+    record = self.records[pos]
+    sub_resources(self.sum_resources, record.use_resources)
+    record.use_resources = None
+    record.task = None
+    record.future = None
+    record.start_time = None
+    self.free.append(pos)
+    self.active_run -= 1
   
   def end_coroutine(self, use_time: float
-      , finished_task: Task[Tuple[Optional[Tuple[float, List[int]]], Any]]) -> Tuple[float, List[int]]:
-    pos = int(finished_task.get_name())
-    use_resources = self.resource_buffer[pos]
+      , finished_task: Task[Tuple[Optional[Tuple[float, List[int]]], Any]]) -> Tuple[float, Union[List[int], Dict[int, int]]]:
+    pos = self.task_positions.pop(finished_task)
+    record = self.records[pos]
+    use_resources = record.use_resources
     # Finish a futuer for the client
     try:
       overwrite_time_resources, result = finished_task.result()
       if overwrite_time_resources is not None:
         use_resources = check_resources(overwrite_time_resources[1], len(self.sum_resources))
         use_time = overwrite_time_resources[0]
-      self.future_buffer[pos].set_result(result)
+      record.future.set_result(result)
     except ResourceOverwriteError as e:
       try:
         use_resources = check_resources(e.use_resources, len(self.sum_resources))
         use_time = e.use_time
-        self.future_buffer[pos].set_exception(e.cause)
+        record.future.set_exception(e.cause)
       except Exception as e2:
-        self.future_buffer[pos].set_exception(e2)
+        record.future.set_exception(e2)
     except Exception as e:
-      self.future_buffer[pos].set_exception(e)
+      record.future.set_exception(e)
     # Update parameters
-    self.sum_resources = [x - y for x, y in zip(self.sum_resources, self.resource_buffer[pos])]
-    self.resource_buffer[pos] = None
-    self.task_buffer[pos] = None
-    self.future_buffer[pos] = None
-    self.active_run -= 1
+    self._release(pos)
     return use_time, use_resources
 
 
+class CreditLedger:
+  # Refunds of resources charged in advance, which cannot be subtracted from past queues
+  def __init__(self, len_resource: int, periods: List[List[float]]):
+    self.periods: List[List[float]] = [[*ps] for ps in periods]
+    # For each distinct period, credits within the window in a heap by time, and their sum
+    self.heaps: Dict[float, List[Tuple[float, int, List[int]]]] = {p: [] for ps in periods for p in ps}
+    self.sums: Dict[float, List[int]] = {p: [0 for _ in range(len_resource)] for p in self.heaps.keys()}
+    # Tie breaker to avoid comparing lists
+    self.count: int = 0
+
+  def add(self, current_time: float, credit_time: float, credits: List[int]) -> None:
+    for p, heap in self.heaps.items():
+      if credit_time > current_time - p:
+        heappush(heap, (credit_time, self.count, credits))
+        self.count += 1
+        self.sums[p] = [*map(add, self.sums[p], credits)]
+
+  def window_sums(self, current_time: float) -> List[List[int]]:
+    # Expired credits are forgotten, so that going back in time only overestimates usage
+    for p, heap in self.heaps.items():
+      start = current_time - p
+      while len(heap) > 0 and heap[0][0] <= start:
+        _, _, credits = heappop(heap)
+        self.sums[p] = [*map(sub, self.sums[p], credits)]
+    return [[self.sums[p][i] for p in ps] for i, ps in enumerate(self.periods)]
+
+
+class TokenBuckets:
+  # GCRA state of the token bucket limits, which is the theoretical arrival time when each bucket becomes empty
+  def __init__(self, capacities: List[List[int]], periods: List[List[float]]):
+    self.capacities: List[List[int]] = [[*cs] for cs in capacities]
+    self.periods: List[List[float]] = [[*ps] for ps in periods]
+    # Time for a unit of resource to drain
+    self.intervals: List[List[float]] = [[p / c for c, p in zip(cs, ps)] for cs, ps in zip(capacities, periods)]
+    self.tats: List[List[float]] = [[0.0 for _ in cs] for cs in capacities]
+    # Resources with buckets, to skip the others
+    self.indices: List[int] = [i for i, cs in enumerate(capacities) if len(cs) > 0]
+
+  def add(self, use_time: float, use_resources: List[int]) -> None:
+    for i in self.indices:
+      r = use_resources[i]
+      if r > 0:
+        tats = self.tats[i]
+        for j, interval in enumerate(self.intervals[i]):
+          tats[j] = max(tats[j], use_time) + r * interval
+
+  def refund(self, credits: List[int]) -> None:
+    # Drained buckets have nothing to refund, as their levels never go below 0
+    for i in self.indices:
+      c = credits[i]
+      if c > 0:
+        tats = self.tats[i]
+        for j, interval in enumerate(self.intervals[i]):
+          tats[j] -= c * interval
+
+  def levels(self, current_time: float) -> List[List[float]]:
+    return [[max(0.0, tat - current_time) / interval for tat, interval in zip(ts, its)]
+        for ts, its in zip(self.tats, self.intervals)]
+
+  def margins(self, current_time: float) -> List[float]:
+    # Infinite for the resources without buckets
+    return [min([c - max(0.0, tat - current_time) / interval for c, tat, interval in zip(cs, ts, its)], default=inf)
+        for cs, ts, its in zip(self.capacities, self.tats, self.intervals)]
+
+  def fits(self, current_time: float, sum_resources: List[int]) -> bool:
+    # Each bucket has room for the resources when its level is at most the capacity minus them
+    return all([tat - current_time <= (c - sum_resources[i]) * interval for i in self.indices
+        for c, tat, interval in zip(self.capacities[i], self.tats[i], self.intervals[i])])
+
+  def time_to_start(self, sum_resources: List[int]) -> float:
+    # The earliest time when fits() holds, as the same formula rounded differently may not hold exactly then
+    time_to_start = 0.0
+    for i in self.indices:
+      for c, tat, interval in zip(self.capacities[i], self.tats[i], self.intervals[i]):
+        allowed = (c - sum_resources[i]) * interval
+        t = tat - allowed
+        while tat - t > allowed:
+          t = nextafter(t, inf)
+        time_to_start = max(time_to_start, t)
+    return time_to_start
+
+
 class NextResourceQueue:
-  def __init__(self, len_resource: int):
-    self.number_to_resource_coro_future: Dict[int, Tuple[List[int]
+  def __init__(self, len_resource: int, cost_scales: Optional[List[float]] = None
+      , tenant_weights: Optional[Dict[Hashable, float]] = None):
+    self.number_to_resource_coro_future: Dict[int, Tuple[Union[List[int], Dict[int, int]]
         , Coroutine[Any, Any, Tuple[Optional[List[int]], Any]], Future[Any]]] = {}
     self.next_add: int = 0
-    self.next_run: int = 0
+    # Cost of a reservation is its largest resource multiplied by the scale, divided by the weight of its tenant
+    self.cost_scales: List[float] = [*cost_scales] if cost_scales is not None else [1.0 for _ in range(len_resource)]
+    self.tenant_weights: Dict[Hashable, float] = {**tenant_weights} if tenant_weights is not None else {}
+    # FIFO of reservation numbers and virtual finish tags for each priority and tenant,
+    # which may include canceled numbers until they reach the head
+    self.flows: Dict[Tuple[int, Hashable], Deque[Tuple[int, float]]] = {}
+    # For each priority, heap of the finish tags, numbers and tenants of the flow heads, and the virtual time
+    self.heaps: Dict[int, List[Tuple[float, int, Hashable]]] = {}
+    self.virtual_times: Dict[int, float] = {}
+    # Heap of priorities with a flow, the smaller first
+    self.priorities: List[int] = []
     self.sum_resources: List[int] = [0 for _ in range(len_resource)]
+    # Waiting count and resources of each tenant other than None
+    self.number_to_tenant: Dict[int, Hashable] = {}
+    self.tenant_counts: Dict[Hashable, int] = {}
+    self.tenant_sums: Dict[Hashable, List[int]] = {}
+    # Deadlines of waiting reservations with one, and a heap of them which may include those no longer waiting
+    self.number_to_deadline: Dict[int, float] = {}
+    self.deadlines: List[Tuple[float, int]] = []
+    # Number of canceled or expired numbers still in the flows
+    self.stale: int = 0
+
+  @property
+  def next_run(self) -> int:
+    return min([flow[0][0] for flow in self.flows.values()], default=self.next_add)
   
   def is_empty(self) -> bool:
     return len(self.number_to_resource_coro_future) <= 0
+
+  def _cost(self, use_resources: Union[List[int], Dict[int, int]], weight: float) -> float:
+    if isinstance(use_resources, dict):
+      return max([r * self.cost_scales[i] for i, r in use_resources.items()], default=0.0) / weight
+    return max(map(mul, use_resources, self.cost_scales), default=0.0) / weight
+
+  def _flow(self, priority: int, tenant: Hashable) -> Tuple[Deque[Tuple[int, float]], float]:
+    # The flow and the finish tag to start from
+    heap = self.heaps.get(priority)
+    if heap is None:
+      self.heaps[priority] = []
+      self.virtual_times[priority] = 0.0
+      heappush(self.priorities, priority)
+    flow = self.flows.get((priority, tenant))
+    if flow is None:
+      flow = deque()
+      self.flows[(priority, tenant)] = flow
+      return flow, self.virtual_times[priority]
+    return flow, max(flow[-1][1], self.virtual_times[priority])
+
+  def _head(self) -> Optional[int]:
+    while len(self.priorities) > 0:
+      priority = self.priorities[0]
+      heap = self.heaps[priority]
+      while len(heap) > 0:
+        _, number, tenant = heap[0]
+        if number in self.number_to_resource_coro_future:
+          return number
+        # Canceled, so move on to the next of the flow
+        self.stale -= 1
+        self._advance(priority, tenant)
+      heappop(self.priorities)
+      del self.heaps[priority]
+      del self.virtual_times[priority]
+    return None
+
+  def _advance(self, priority: int, tenant: Hashable) -> None:
+    # Remove the head of the flow and replace its entry in the heap with the next one
+    flow = self.flows[(priority, tenant)]
+    flow.popleft()
+    if len(flow) > 0:
+      heapreplace(self.heaps[priority], (flow[0][1], flow[0][0], tenant))
+    else:
+      heappop(self.heaps[priority])
+      del self.flows[(priority, tenant)]
+
+  def _compact(self) -> None:
+    # Drop canceled and expired numbers once they outnumber the waiting ones, so that the cost is amortized
+    if self.stale < 64 or self.stale <= len(self.number_to_resource_coro_future):
+      return
+    heaps: Dict[int, List[Tuple[float, int, Hashable]]] = {priority: [] for priority in self.heaps.keys()}
+    for (priority, tenant), flow in [*self.flows.items()]:
+      flow = deque([e for e in flow if e[0] in self.number_to_resource_coro_future])
+      if len(flow) > 0:
+        self.flows[(priority, tenant)] = flow
+        heaps[priority].append((flow[0][1], flow[0][0], tenant))
+      else:
+        del self.flows[(priority, tenant)]
+    for heap in heaps.values():
+      heapify(heap)
+    self.heaps = heaps
+    self.deadlines = [(d, n) for d, n in self.deadlines if n in self.number_to_deadline]
+    heapify(self.deadlines)
+    self.stale = 0
+
+  def _add_tenant(self, tenant: Hashable, count: int, use_resources: Union[List[int], Dict[int, int]]) -> None:
+    if tenant not in self.tenant_counts:
+      self.tenant_counts[tenant] = 0
+      self.tenant_sums[tenant] = [0 for _ in self.sum_resources]
+    self.tenant_counts[tenant] += count
+    add_resources(self.tenant_sums[tenant], use_resources)
+
+  def _remove_tenant(self, tenant: Hashable, use_resources: Union[List[int], Dict[int, int]]) -> None:
+    self.tenant_counts[tenant] -= 1
+    if self.tenant_counts[tenant] <= 0:
+      del self.tenant_counts[tenant]
+      del self.tenant_sums[tenant]
+    else:
+      sub_resources(self.tenant_sums[tenant], use_resources)
+
+  def _remove(self, number: int) -> Tuple[Union[List[int], Dict[int, int]]
+      , Coroutine[Any, Any, Tuple[Optional[List[int]], Any]], Future[Any]]:
+    val = self.number_to_resource_coro_future.pop(number)
+    sub_resources(self.sum_resources, val[0])
+    tenant = self.number_to_tenant.pop(number, None)
+    if tenant is not None:
+      self._remove_tenant(tenant, val[0])
+    self.number_to_deadline.pop(number, None)
+    return val
+
+  def _add_deadline(self, number: int, deadline: float) -> None:
+    self.number_to_deadline[number] = deadline
+    heappush(self.deadlines, (deadline, number))
+
+  def deadline(self, number: int) -> Optional[float]:
+    return self.number_to_deadline.get(number)
+
+  def next_deadline(self) -> Optional[float]:
+    while len(self.deadlines) > 0 and self.deadlines[0][1] not in self.number_to_deadline:
+      heappop(self.deadlines)
+    return self.deadlines[0][0] if len(self.deadlines) > 0 else None
+
+  def expire(self, current_time: float) -> List[Tuple[float, Union[List[int], Dict[int, int]]
+      , Coroutine[Any, Any, Tuple[Optional[List[int]], Any]], Future[Any]]]:
+    # Remove the reservations whose deadlines have passed, with their deadlines
+    expired = []
+    while len(self.deadlines) > 0 and self.deadlines[0][0] <= current_time:
+      deadline, number = heappop(self.deadlines)
+      if number in self.number_to_deadline:
+        expired.append((deadline, *self._remove(number)))
+        self.stale += 1
+    self._compact()
+    return expired
     
-  def push(self, use_resources: List[int]
-      , coro: Coroutine[Any, Any, Tuple[Optional[List[int]], Any]], future: Future[Any]) -> int:
+  def push(self, use_resources: Union[List[int], Dict[int, int]]
+      , coro: Coroutine[Any, Any, Tuple[Optional[List[int]], Any]], future: Future[Any]
+      , priority: int = 0, tenant: Hashable = None, deadline: Optional[float] = None) -> int:
     pos = self.next_add
     self.number_to_resource_coro_future[pos] = use_resources, coro, future
+    flow, tag = self._flow(priority, tenant)
+    tag += self._cost(use_resources, self.tenant_weights.get(tenant, 1.0))
+    flow.append((pos, tag))
+    if len(flow) == 1:
+      heappush(self.heaps[priority], (tag, pos, tenant))
     self.next_add += 1
-    self.sum_resources = [x + y for x, y in zip(self.sum_resources, use_resources)]
+    add_resources(self.sum_resources, use_resources)
+    if tenant is not None:
+      self.number_to_tenant[pos] = tenant
+      self._add_tenant(tenant, 1, use_resources)
+    if deadline is not None:
+      self._add_deadline(pos, deadline)
     return pos
 
-  def pop(self) -> Optional[Tuple[List[int], Coroutine[Any, Any, Tuple[Optional[List[int]], Any]], Future[Any]]]:
-    while self.next_run < self.next_add:
-      val = self.number_to_resource_coro_future.pop(self.next_run, None)
-      self.next_run += 1
-      if val is not None:
-        self.sum_resources = [x - y for x, y in zip(self.sum_resources, val[0])]
-        return val
-    return None
+  def push_many(self, items: List[Tuple[Union[List[int], Dict[int, int]]
+      , Coroutine[Any, Any, Tuple[Optional[List[int]], Any]], Future[Any]]]
+      , priority: int = 0, tenant: Hashable = None, deadline: Optional[float] = None) -> int:
+    pos = self.next_add
+    self.number_to_resource_coro_future.update(zip(range(pos, pos + len(items)), items))
+    self.next_add += len(items)
+    if len(items) > 0:
+      flow, tag = self._flow(priority, tenant)
+      is_new = len(flow) <= 0
+      weight = self.tenant_weights.get(tenant, 1.0)
+      tags = []
+      for item in items:
+        tag += self._cost(item[0], weight)
+        tags.append(tag)
+      flow.extend(zip(range(pos, pos + len(items)), tags))
+      if is_new:
+        heappush(self.heaps[priority], (tags[0], pos, tenant))
+      # Dense ones are summed column by column, and sparse ones only where used
+      dense = [item[0] for item in items if not isinstance(item[0], dict)]
+      sums = [*map(sum, zip(*dense))] if len(dense) > 0 else [0 for _ in self.sum_resources]
+      for item in items:
+        if isinstance(item[0], dict):
+          add_resources(sums, item[0])
+      add_resources(self.sum_resources, sums)
+      if tenant is not None:
+        self.number_to_tenant.update((number, tenant) for number in range(pos, pos + len(items)))
+        self._add_tenant(tenant, len(items), sums)
+      if deadline is not None:
+        for number in range(pos, pos + len(items)):
+          self._add_deadline(number, deadline)
+    return pos
 
-  def peek(self) -> Optional[Tuple[List[int], Coroutine[Any, Any, Tuple[Optional[List[int]], Any]], Future[Any]]]:
-    while self.next_run < self.next_add:
-      val = self.number_to_resource_coro_future.get(self.next_run)
-      if val is not None:
-        return val
-      self.next_run += 1
-    return None
+  def pop(self) -> Optional[Tuple[Union[List[int], Dict[int, int]], Coroutine[Any, Any, Tuple[Optional[List[int]], Any]], Future[Any]]]:
+    number = self._head()
+    if number is None:
+      return None
+    priority = self.priorities[0]
+    tag, _, tenant = self.heaps[priority][0]
+    # Self-clocked, the virtual time is the finish tag of the last one started
+    self.virtual_times[priority] = tag
+    self._advance(priority, tenant)
+    return self._remove(number)
+
+  def peek(self) -> Optional[Tuple[Union[List[int], Dict[int, int]], Coroutine[Any, Any, Tuple[Optional[List[int]], Any]], Future[Any]]]:
+    number = self._head()
+    if number is None:
+      return None
+    return self.number_to_resource_coro_future[number]
+
+  def peek_number(self) -> Optional[int]:
+    return self._head()
+
+  def peek_numbers(self, count: int) -> List[int]:
+    # Up to count numbers from the head in the order to pop
+    numbers: List[int] = []
+    for priority in sorted(self.priorities):
+      flows = [flow for (p, _), flow in self.flows.items() if p == priority]
+      for number, _ in merge(*flows, key=lambda e: (e[1], e[0])):
+        if len(numbers) >= count:
+          return numbers
+        if number in self.number_to_resource_coro_future:
+          numbers.append(number)
+    return numbers
   
-  def cancel(self, number: int) -> Optional[Tuple[List[int], Coroutine[Any, Any, Tuple[Optional[List[int]], Any]], Future[Any], bool]]:
-    val = self.number_to_resource_coro_future.pop(number, None)
-    if val is None:
+  def cancel(self, number: int) -> Optional[Tuple[Union[List[int], Dict[int, int]]
+      , Coroutine[Any, Any, Tuple[Optional[List[int]], Any]], Future[Any], bool]]:
+    if number not in self.number_to_resource_coro_future:
       return None
-    self.sum_resources = [x - y for x, y in zip(self.sum_resources, val[0])]
-    is_next_pop = len(self.number_to_resource_coro_future) == 0 or number < min([n for n in self.number_to_resource_coro_future.keys()])
+    is_next_pop = self._head() == number
+    val = self._remove(number)
+    self.stale += 1
+    self._compact()
     return (*val, is_next_pop)
@@ -2,10 +2,11 @@ import asyncio
 import pytest
 import time
 
-from typing import Any, Coroutine, List, Set
+from typing import Any, Coroutine, List, Set, Tuple
 
-from multi_rate_limit.rate_limit import RateLimit, ResourceOverwriteError
-from multi_rate_limit.multi_rate_limit import MultiRateLimit, RateLimitStats, ReservationTicket
+from multi_rate_limit.rate_limit import ArrayPastResourceQueue, IPastResourceQueue, RateLimit, ReservationExpiredError
+from multi_rate_limit.rate_limit import ResourceOverwriteError, TokenBucketRateLimit
+from multi_rate_limit.multi_rate_limit import MultiRateLimit, RateLimitStats, ReservationTicket, ResourceSlot
 
 
 def test_rate_limit_stats():
@@ -58,6 +59,12 @@ async def cosume_coroutine_to_avoid_warnings(*args: Coroutine[Any, Any, Any]):
     task.cancel()
   await asyncio.wait(tasks)
 
+async def check_process_ends(mrl: MultiRateLimit, task: asyncio.Task):
+  # The internal processing exits normally once nothing is waiting or running
+  await asyncio.wait([task])
+  assert task.exception() is None
+  assert mrl._in_process is None
+
 @pytest.mark.asyncio
 async def test_multi_rate_limit():
   # (relative time, resources)
@@ -206,3 +213,554 @@ async def test_multi_rate_limit_no_invalid_loop():
   for i, t in enumerate(tickets):
     assert t.future.done() == True
     assert await t.future == i
+
+@pytest.mark.asyncio
+async def test_multi_rate_limit_timer():
+  limits = [[RateLimit(1, 0.3)]]
+  mrl = await MultiRateLimit.create(limits, None, 2)
+  t0 = mrl.reserve([1], wait_and_return(0, (None, 0)))
+  t1 = mrl.reserve([0], wait_and_return(0.1, (None, 1)))
+  t2 = mrl.reserve([1], wait_and_return(0, (None, 2)))
+  await t0.future
+  await asyncio.sleep(0.05)
+  # Throttled by the past usage, so the timer is armed
+  timer = mrl._timer
+  assert timer is not None
+  await t1.future
+  await asyncio.sleep(0.05)
+  # The time to start does not change with the end of t1, so the timer is kept
+  assert mrl._timer is timer
+  assert await t2.future == 2
+  stats = mrl.scheduler_stats()
+  assert stats.dispatches == 3
+  assert stats.wakeups_per_dispatch() <= 2
+  await mrl.term()
+  assert mrl._timer is None
+
+
+class AsyncPastResourceQueue(IPastResourceQueue):
+  # Only with asynchronous queries, like a remote backend
+  def __init__(self, len_resource: int, longest_period_in_seconds: float):
+    self.queue = ArrayPastResourceQueue(len_resource, longest_period_in_seconds)
+    self.queries = 0
+
+  async def sum_resource_after(self, time: float, order: int) -> int:
+    self.queries += 1
+    await asyncio.sleep(0)
+    return await self.queue.sum_resource_after(time, order)
+
+  async def time_accum_resource_within(self, order: int, amount: int) -> float:
+    self.queries += 1
+    await asyncio.sleep(0)
+    return await self.queue.time_accum_resource_within(order, amount)
+
+  async def add(self, use_time: float, use_resources: List[int]) -> None:
+    await self.queue.add(use_time, use_resources)
+
+  async def term(self) -> None:
+    await self.queue.term()
+
+@pytest.mark.asyncio
+async def test_multi_rate_limit_async_past():
+  limits = [[RateLimit(2, 0.2), RateLimit(3, 1)], [RateLimit(10, 1)]]
+  past_queues: List[AsyncPastResourceQueue] = []
+  async def factory(len_resource: int, longest_period_in_seconds: float) -> AsyncPastResourceQueue:
+    past_queues.append(AsyncPastResourceQueue(len_resource, longest_period_in_seconds))
+    return past_queues[-1]
+  mrl = await MultiRateLimit.create(limits, factory, 2)
+  assert mrl._sync_past_queue is None
+  start = time.time()
+  tickets = [mrl.reserve([1, 1], wait_and_return(0, (None, i))) for i in range(4)]
+  assert [await t.future for t in tickets] == [0, 1, 2, 3]
+  # The 3rd waits for the 0.2 seconds window, and the 4th for the 1 second window
+  assert time.time() - start >= 1
+  assert past_queues[0].queries > 0
+  await mrl.term()
+  mrl = await MultiRateLimit.create(limits, None, 2)
+  assert isinstance(mrl._sync_past_queue, ArrayPastResourceQueue)
+  await mrl.term()
+
+@pytest.mark.asyncio
+async def test_multi_rate_limit_reserve_many():
+  limits = [[RateLimit(3, 0.2)], [RateLimit(100, 1)]]
+  mrl = await MultiRateLimit.create(limits, None, 2)
+  assert mrl.reserve_many([]) == []
+  t0 = mrl.reserve([1, 1], wait_and_return(0, (None, 'a')))
+  # Nothing is scheduled if any item is invalid
+  coros = [wait_and_return(0, (None, 'b')), wait_and_return(0, (None, 'c'))]
+  with pytest.raises(ValueError):
+    mrl.reserve_many([([1, 1], coros[0]), ([4, 1], coros[1])])
+  with pytest.raises(ValueError):
+    mrl.reserve_many([([1, 1], coros[0]), ([1], coros[1])])
+  assert mrl.waiting_numbers() == {0}
+  await cosume_coroutine_to_avoid_warnings(*coros)
+  assert await t0.future == 'a'
+  tickets = mrl.reserve_many([([1, 2], wait_and_return(0, (None, i))) for i in range(5)])
+  assert [t.reserve_number for t in tickets] == [1, 2, 3, 4, 5]
+  assert mrl.waiting_numbers() == {1, 2, 3, 4, 5}
+  assert (await mrl.stats()).next_uses == [5, 10]
+  assert [await t.future for t in tickets] == [0, 1, 2, 3, 4]
+  assert mrl.scheduler_stats().dispatches == 6
+  await mrl.term()
+  with pytest.raises(Exception):
+    mrl.reserve_many([])
+
+@pytest.mark.asyncio
+async def test_multi_rate_limit_priority():
+  limits = [[RateLimit(1, 0.1)]]
+  mrl = await MultiRateLimit.create(limits, None, 1)
+  order: List[str] = []
+  async def work(name: str):
+    order.append(name)
+    return None, name
+  t0 = mrl.reserve([1], work('a'))
+  await asyncio.sleep(0.01)
+  tickets = mrl.reserve_many([([1], work('b')), ([1], work('c'))], 1)
+  t3 = mrl.reserve([1], work('d'))
+  t4 = mrl.reserve([1], work('e'), -1)
+  t5 = await mrl.reserve_wait([1], work('f'), -1)
+  assert mrl.cancel(t5.reserve_number, True)[0] == [1]
+  await asyncio.gather(t0.future, t3.future, t4.future, *[t.future for t in tickets])
+  assert order == ['a', 'e', 'd', 'b', 'c']
+  async with mrl.acquire([1], 1):
+    order.append('g')
+  assert order[-1] == 'g'
+  await mrl.term()
+
+@pytest.mark.asyncio
+async def test_multi_rate_limit_sparse():
+  limits = [[RateLimit(3, 0.2)], [RateLimit(100, 1)], [RateLimit(10, 1)]]
+  mrl = await MultiRateLimit.create(limits, None, 2)
+  coro = wait_and_return(0, (None, 'x'))
+  for use_resources in [{0: 4}, {3: 1}, {-1: 1}, {0: -1}, {'0': 1}]:
+    with pytest.raises(ValueError):
+      mrl.reserve(use_resources, coro)
+  with pytest.raises(ValueError):
+    mrl.reserve_many([({1: 5}, coro), ({0: 4}, coro)])
+  await cosume_coroutine_to_avoid_warnings(coro)
+  t0 = mrl.reserve({1: 5}, wait_and_return(0.1, ((time.time(), {0: 1, 2: 2}), 'a')))
+  tickets = mrl.reserve_many([({0: 1}, wait_and_return(0, (None, 'b'))), ([0, 1, 1], wait_and_return(0, (None, 'c')))])
+  assert mrl.cancel(tickets[1].reserve_number, True)[0] == [0, 1, 1]
+  assert await tickets[0].future == 'b'
+  await check_stats(mrl, limits, [[1], [0], [0]], [0, 5, 0], [0, 0, 0], 1, set())
+  assert await t0.future == 'a'
+  # Overwritten with sparse resources
+  await check_stats(mrl, limits, [[2], [0], [2]], [0, 0, 0], [0, 0, 0], 0, set())
+  async with mrl.acquire({2: 1}) as slot:
+    slot.settle(time.time(), {2: 3})
+  await check_stats(mrl, limits, [[2], [0], [5]], [0, 0, 0], [0, 0, 0], 0, set())
+  await mrl.term()
+
+@pytest.mark.asyncio
+async def test_multi_rate_limit_sparse_scheduling():
+  limits = [[RateLimit(10, 0.3)], [RateLimit(10, 0.3)]]
+  mrl = await MultiRateLimit.create(limits, None, 2, None, [5, 5])
+  # Overwritten with more than the limit of the resource that is not reserved
+  t0 = mrl.reserve({0: 1}, wait_and_return(0, ((time.time(), [1, 12]), 'a')))
+  assert await t0.future == 'a'
+  start = time.time()
+  # Accepted alone, and kept sparse while waiting
+  t1 = mrl.reserve({1: 6}, wait_and_return(0, (None, 'b')))
+  assert mrl._next_queue.number_to_resource_coro_future[t1.reserve_number][0] == {1: 6}
+  coro = wait_and_return(0, (None, 'x'))
+  # The waiting ones exceed the other resource, as with dense resources
+  with pytest.raises(asyncio.QueueFull):
+    mrl.reserve({0: 1}, coro)
+  await cosume_coroutine_to_avoid_warnings(coro)
+  assert mrl.cancel(t1.reserve_number, True)[0] == [0, 6]
+  # Waits for the window of the resource that is not reserved, as with dense resources
+  t2 = mrl.reserve({0: 1}, wait_and_return(0, (None, 'c')))
+  assert await t2.future == 'c'
+  assert time.time() - start > 0.2
+  await mrl.term()
+  # Charged at dispatch, refunded and backfilled
+  mrl = await MultiRateLimit.create(limits, None, 3, charge_at_dispatch=True, backfill_depth=2)
+  order = []
+  async def work(name: str, wait_in_seconds: float, use_resources):
+    order.append(name)
+    await asyncio.sleep(wait_in_seconds)
+    return (time.time(), use_resources) if use_resources is not None else None, name
+  start = time.time()
+  t0 = mrl.reserve({0: 6}, work('a', 0.1, {0: 2}))
+  t1 = mrl.reserve({0: 6}, work('b', 0, None))
+  t2 = mrl.reserve({1: 3}, work('c', 0, None))
+  assert await asyncio.gather(t0.future, t1.future, t2.future) == ['a', 'b', 'c']
+  # Started by the refund before the window passes
+  assert time.time() - start < 0.25
+  assert order == ['a', 'c', 'b']
+  await check_stats(mrl, limits, [[8], [3]], [0, 0], [0, 0], 0, set())
+  await mrl.term()
+
+@pytest.mark.asyncio
+async def test_multi_rate_limit_token_bucket():
+  # A burst of 2 and then 1 per 0.1 seconds, mixed with a window
+  limits = [[TokenBucketRateLimit(2, 0.2)], [RateLimit(3, 1), TokenBucketRateLimit(5, 1)]]
+  mrl = await MultiRateLimit.create(limits, None, 4)
+  start_times: List[float] = []
+  async def work():
+    start_times.append(time.time())
+    return None, None
+  start = time.time()
+  tickets = [mrl.reserve([1, 1], work()) for _ in range(4)]
+  await asyncio.gather(*[t.future for t in tickets])
+  elapsed = [t - start for t in start_times]
+  assert elapsed[1] < 0.05
+  assert 0.09 < elapsed[2] < 0.15
+  # Waits for the window of the second resource
+  assert 0.99 < elapsed[3] < 1.1
+  stats = await mrl.stats()
+  assert stats.past_uses[0][0] == pytest.approx(1, abs=0.2)
+  assert stats.past_uses[1] == [2, pytest.approx(1, abs=0.2)]
+  await mrl.term()
+  # Many reservations at a high rate, predicted to start at epoch-scale times
+  mrl = await MultiRateLimit.create([[TokenBucketRateLimit(997, 0.7)]], None, 64)
+  tickets = [mrl.reserve([1 + i % 7], work()) for i in range(400)]
+  await asyncio.wait_for(asyncio.gather(*[t.future for t in tickets]), 5)
+  await mrl.term()
+  # Refunded when charged at dispatch
+  mrl = await MultiRateLimit.create([[TokenBucketRateLimit(2, 20)]], None, 1, charge_at_dispatch=True)
+  async with mrl.acquire([2]) as slot:
+    slot.settle(time.time(), [1])
+  await asyncio.sleep(0.01)
+  assert (await mrl.stats()).past_uses[0][0] == pytest.approx(1, abs=0.01)
+  await mrl.term()
+  # Only token buckets need no history
+  mrl = await MultiRateLimit.create([[TokenBucketRateLimit(2, 0.02)]], None, 1)
+  await asyncio.gather(*[mrl.reserve([1], work()).future for _ in range(10)])
+  assert len(mrl._past_queue) <= 2
+  await mrl.term()
+
+@pytest.mark.asyncio
+async def test_multi_rate_limit_backfill():
+  with pytest.raises(ValueError):
+    await MultiRateLimit.create([[RateLimit(10, 0.2)]], None, 3, backfill_depth=-1)
+  for backfill_depth, expected in [(0, ['a', 'b', 'c', 'd']), (4, ['a', 'c', 'b', 'd'])]:
+    mrl = await MultiRateLimit.create([[RateLimit(10, 0.2)]], None, 3, backfill_depth=backfill_depth)
+    order: List[Tuple[str, float]] = []
+    async def work(name: str):
+      order.append((name, time.time()))
+      return None, name
+    start = time.time()
+    t0 = mrl.reserve([6], work('a'))
+    await t0.future
+    # The next cannot start until the first leaves the window
+    tickets = [mrl.reserve([8], work('b')), mrl.reserve([2], work('c')), mrl.reserve([1], work('d'))]
+    await asyncio.gather(*[t.future for t in tickets])
+    assert [name for name, _ in order] == expected
+    times = {name: t - start for name, t in order}
+    # Backfill does not delay the first waiting one
+    assert 0.2 <= times['b'] < 0.3
+    assert times['d'] >= 0.2
+    await mrl.term()
+
+@pytest.mark.asyncio
+async def test_multi_rate_limit_tenant():
+  with pytest.raises(ValueError):
+    await MultiRateLimit.create([[RateLimit(1, 0.05)]], None, 1, tenant_weights={'a': 0})
+  mrl = await MultiRateLimit.create([[RateLimit(1, 0.05)]], None, 1, tenant_weights={'quiet': 2})
+  order: List[str] = []
+  async def work(name: str):
+    order.append(name)
+    return None, name
+  t0 = mrl.reserve([1], work('first'))
+  await asyncio.sleep(0.01)
+  noisy = mrl.reserve_many([([1], work(f'n{i}')) for i in range(4)], tenant='noisy')
+  quiet = [mrl.reserve([1], work(f'q{i}'), tenant='quiet') for i in range(3)]
+  stats = await mrl.stats()
+  assert stats.tenant_waitings == {'noisy': 4, 'quiet': 3}
+  assert stats.tenant_next_uses == {'noisy': [4], 'quiet': [3]}
+  assert stats.next_uses == [7]
+  await asyncio.gather(t0.future, *[t.future for t in noisy + quiet])
+  assert order == ['first', 'q0', 'n0', 'q1', 'q2', 'n1', 'n2', 'n3']
+  assert (await mrl.stats()).tenant_waitings == {}
+  await mrl.term()
+
+@pytest.mark.asyncio
+async def test_multi_rate_limit_deadline():
+  for expire_on_prediction in [False, True]:
+    mrl = await MultiRateLimit.create([[RateLimit(1, 0.2)]], None, 1, expire_on_prediction=expire_on_prediction)
+    start = time.time()
+    t0 = mrl.reserve([1], wait_and_return(0, (None, 'a')))
+    await asyncio.sleep(0.01)
+    t1 = mrl.reserve([1], wait_and_return(0, (None, 'b')), deadline=start + 0.1)
+    t2 = mrl.reserve([1], wait_and_return(0, (None, 'c')))
+    slot = mrl.acquire([1], deadline=start + 0.05)
+    assert await t0.future == 'a'
+    await asyncio.sleep(0.01)
+    # Expired by prediction at once, otherwise at the deadline
+    assert t1.future.done() == expire_on_prediction
+    with pytest.raises(ReservationExpiredError):
+      await slot.__aenter__()
+    assert 0.05 <= time.time() - start < 0.1
+    with pytest.raises(ReservationExpiredError) as e:
+      await t1.future
+    assert 0.1 <= time.time() - start < 0.15 or expire_on_prediction
+    assert e.value.deadline == start + 0.1
+    assert (e.value.predicted is not None) == expire_on_prediction
+    assert mrl.waiting_numbers() == {2}
+    # The quota is left for the one without a deadline
+    assert await t2.future == 'c'
+    assert 0.2 <= time.time() - start < 0.3
+    # Expiring the last one leaves nothing waiting or running
+    t3 = mrl.reserve([1], wait_and_return(0, (None, 'd')), deadline=time.time() + 0.05)
+    process = mrl._in_process
+    with pytest.raises(ReservationExpiredError):
+      await t3.future
+    await check_process_ends(mrl, process)
+    await mrl.term()
+
+@pytest.mark.asyncio
+async def test_multi_rate_limit_reserve_lazy():
+  limits = [[RateLimit(2, 0.2)]]
+  mrl = await MultiRateLimit.create(limits, None, 1)
+  created: List[str] = []
+  async def work(name: str, wait_in_seconds: float = 0):
+    created.append(name)
+    await asyncio.sleep(wait_in_seconds)
+    return None, name
+  t0 = mrl.reserve_lazy([1], work, 'a', wait_in_seconds=0.05)
+  t1 = mrl.reserve_lazy([1], work, 'b')
+  t2 = mrl.reserve_lazy([1], work, 'c')
+  t3 = mrl.reserve_lazy([0], lambda: 'not coroutine')
+  t4 = mrl.reserve_lazy([0], work, 'd')
+  assert created == []
+  # The function is returned instead of the coroutine
+  use_resources, func = mrl.cancel(t2.reserve_number, True)
+  assert use_resources == [1]
+  assert asyncio.iscoroutine(func) == False
+  assert await t0.future == 'a'
+  assert await t1.future == 'b'
+  assert created == ['a', 'b']
+  with pytest.raises(ValueError):
+    await t3.future
+  assert await t4.future == 'd'
+  assert created == ['a', 'b', 'd']
+  assert mrl.scheduler_stats().dispatches == 3
+  with pytest.raises(ValueError):
+    mrl.reserve_lazy([3], work, 'e')
+  with pytest.raises(ValueError):
+    mrl.reserve_lazy([1], 'not callable')
+  # Wait for the limit period
+  await asyncio.sleep(0.2)
+  t5 = mrl.reserve_lazy([1], work, 'f', 0.1)
+  t6 = mrl.reserve_lazy([1], work, 'g')
+  await asyncio.sleep(0.01)
+  assert len(await mrl.term(True)) == 1
+  assert await t5.future == 'f'
+  assert t6.future.cancelled()
+  assert created == ['a', 'b', 'd', 'f']
+  # Only a function that fails leaves nothing waiting or running
+  mrl = await MultiRateLimit.create(limits, None, 1)
+  def fail():
+    raise KeyError()
+  t7 = mrl.reserve_lazy([1], fail)
+  process = mrl._in_process
+  with pytest.raises(KeyError):
+    await t7.future
+  await check_process_ends(mrl, process)
+  await mrl.term()
+
+@pytest.mark.asyncio
+async def test_multi_rate_limit_max_waiting():
+  limits = [[RateLimit(10, 1)], [RateLimit(10, 1)]]
+  with pytest.raises(ValueError):
+    await MultiRateLimit.create(limits, None, 1, 0)
+  with pytest.raises(ValueError):
+    await MultiRateLimit.create(limits, None, 1, None, [1])
+  with pytest.raises(ValueError):
+    await MultiRateLimit.create(limits, None, 1, None, [1, -1])
+  mrl = await MultiRateLimit.create(limits, None, 1, 2, [5, 10])
+  t0 = mrl.reserve([1, 0], wait_and_return(0.1, (None, 0)))
+  await asyncio.sleep(0.01)
+  # A single reservation exceeding max_waiting_resources is accepted while nothing is waiting
+  t1 = mrl.reserve([6, 0], wait_and_return(0.1, (None, 1)))
+  coro = wait_and_return(0, (None, -1))
+  with pytest.raises(asyncio.QueueFull):
+    mrl.reserve([0, 0], coro)
+  mrl.cancel(t1.reserve_number, True)
+  t2 = mrl.reserve_lazy([3, 0], wait_and_return, 0.1, (None, 2))
+  with pytest.raises(asyncio.QueueFull):
+    mrl.reserve([3, 0], coro)
+  with pytest.raises(asyncio.QueueFull):
+    mrl.reserve_many([([1, 0], coro), ([1, 0], coro)])
+  t3 = mrl.reserve([2, 0], wait_and_return(0.1, (None, 3)))
+  with pytest.raises(asyncio.QueueFull):
+    mrl.reserve([0, 0], coro)
+  await cosume_coroutine_to_avoid_warnings(coro)
+  # Waiting for space in order
+  w4 = asyncio.create_task(mrl.reserve_wait([1, 0], wait_and_return(0.1, (None, 4))))
+  coro5 = wait_and_return(0.1, (None, 5))
+  w5 = asyncio.create_task(mrl.reserve_wait([1, 0], coro5))
+  w6 = asyncio.create_task(mrl.reserve_wait([1, 0], wait_and_return(0.1, (None, 6))))
+  await asyncio.sleep(0.01)
+  assert not w4.done() and not w5.done()
+  w5.cancel()
+  assert await t0.future == 0
+  await asyncio.sleep(0.01)
+  # t2 started, so that there is space for one
+  assert w4.done() and not w6.done()
+  t4 = await w4
+  assert mrl.waiting_numbers() == {t3.reserve_number, t4.reserve_number}
+  with pytest.raises(asyncio.CancelledError):
+    await w5
+  await cosume_coroutine_to_avoid_warnings(coro5)
+  assert await t2.future == 2
+  t6 = await w6
+  assert t6.reserve_number > t4.reserve_number
+  assert [await t.future for t in [t3, t4, t6]] == [3, 4, 6]
+  # Waiting calls fail on termination
+  mrl.reserve([1, 0], wait_and_return(0.1, (None, 7)))
+  mrl.reserve([1, 0], wait_and_return(0.1, (None, 8)))
+  await asyncio.sleep(0.01)
+  mrl.reserve([1, 0], wait_and_return(0.1, (None, 9)))
+  coro = wait_and_return(0, (None, 10))
+  w10 = asyncio.create_task(mrl.reserve_wait([1, 0], coro))
+  await asyncio.sleep(0.01)
+  await mrl.term(True)
+  with pytest.raises(Exception):
+    await w10
+  await cosume_coroutine_to_avoid_warnings(coro)
+
+@pytest.mark.asyncio
+async def test_multi_rate_limit_amap():
+  limits = [[RateLimit(100, 1)]]
+  mrl = await MultiRateLimit.create(limits, None, 3)
+  pulled: List[int] = []
+  def items():
+    for i in range(10):
+      pulled.append(i)
+      yield i
+  async def async_items():
+    for i in range(10):
+      pulled.append(i)
+      yield i
+  async def work(i: int):
+    # Later items finish earlier
+    await asyncio.sleep(0.01 * (10 - i))
+    return None, i * 10
+  # In the order of the items
+  results = []
+  async for r in mrl.amap(items(), lambda i: [1], work, 4):
+    # Items are read only within the window
+    assert len(pulled) <= len(results) + 4
+    results.append(r)
+  assert results == [i * 10 for i in range(10)]
+  # In the order of completion
+  pulled.clear()
+  results = []
+  async for r in mrl.amap(async_items(), lambda i: [1], work, 10, False):
+    results.append(r)
+  assert len(pulled) == 10
+  assert sorted(results) == [i * 10 for i in range(10)]
+  assert results[:3] != [0, 10, 20]
+  # Exceptions are raised, and the rest are canceled
+  async def fail(i: int):
+    await asyncio.sleep(0.01)
+    if i == 1:
+      raise KeyError()
+    return None, i
+  results = []
+  with pytest.raises(KeyError):
+    async for r in mrl.amap(range(100), lambda i: [1], fail, 5):
+      results.append(r)
+  assert results == [0]
+  assert mrl.waitings() == 0
+  with pytest.raises(ValueError):
+    async for r in mrl.amap(range(1), lambda i: [1], fail, 0):
+      pass
+  with pytest.raises(ValueError):
+    async for r in mrl.amap(range(1), lambda i: [101], fail):
+      pass
+  await mrl.term()
+
+@pytest.mark.asyncio
+async def test_multi_rate_limit_acquire():
+  limits = [[RateLimit(3, 0.3)], [RateLimit(100, 1)]]
+  mrl = await MultiRateLimit.create(limits, None, 2)
+  with pytest.raises(ValueError):
+    mrl.acquire([4, 0])
+  async with mrl.acquire([1, 10]) as slot:
+    assert isinstance(slot, ResourceSlot)
+    assert slot.reserve_number == 0
+    assert mrl.runnings() == 1
+    # No task is created
+    assert [r.task for r in mrl._current_buffer.records] == [None, None]
+    await check_stats(mrl, limits, [[0], [0]], [1, 10], [0, 0], 1, set())
+  await check_stats(mrl, limits, [[1], [10]], [0, 0], [0, 0], 0, set())
+  # Overwritten
+  async with mrl.acquire([1, 10]) as slot:
+    with pytest.raises(ValueError):
+      slot.settle(time.time(), [1])
+    slot.settle(time.time(), [0, 5])
+  await check_stats(mrl, limits, [[1], [15]], [0, 0], [0, 0], 0, set())
+  # Charged even with an exception
+  with pytest.raises(KeyError):
+    async with mrl.acquire([1, 1]):
+      raise KeyError()
+  await check_stats(mrl, limits, [[2], [16]], [0, 0], [0, 0], 0, set())
+  # Waits in order with the other reservations
+  t0 = mrl.reserve([1, 0], wait_and_return(0, (None, 0)))
+  order: List[int] = []
+  async def use(i: int):
+    async with mrl.acquire([1, 0]):
+      order.append(i)
+  t1 = asyncio.create_task(use(1))
+  t2 = asyncio.create_task(use(2))
+  await asyncio.sleep(0.05)
+  assert await t0.future == 0
+  assert mrl.waitings() == 2
+  # Canceled while waiting
+  t1.cancel()
+  await asyncio.sleep(0.05)
+  assert mrl.waitings() == 1
+  await t2
+  assert order == [2]
+  await mrl.term()
+  # Canceled after its future is canceled but before leaving the waiting queue, with nothing else left
+  mrl = await MultiRateLimit.create(limits, None, 1, charge_at_dispatch=True)
+  t3 = mrl.reserve([1, 0], wait_and_return(0.01, (None, 3)))
+  t4 = asyncio.create_task(use(4))
+  await asyncio.sleep(0)
+  assert mrl.runnings() == 1 and mrl.waitings() == 1
+  process = mrl._in_process
+  mrl._current_buffer.records[0].task.add_done_callback(lambda _: t4.cancel())
+  assert await t3.future == 3
+  with pytest.raises(asyncio.CancelledError):
+    await t4
+  await check_process_ends(mrl, process)
+  assert order == [2]
+  await mrl.term()
+
+@pytest.mark.asyncio
+async def test_multi_rate_limit_charge_at_dispatch():
+  limits = [[RateLimit(2, 0.2)]]
+  mrl = await MultiRateLimit.create(limits, None, 3, charge_at_dispatch=True)
+  started: List[float] = []
+  async def work(wait_in_seconds: float, overwrite: List[int] = None):
+    started.append(time.time())
+    await asyncio.sleep(wait_in_seconds)
+    return (None if overwrite is None else (time.time(), overwrite)), None
+  start = time.time()
+  tickets = [mrl.reserve([1], work(0.5)) for _ in range(3)]
+  await check_stats(mrl, limits, [[2]], [0], [1], 2, {2})
+  # The 3rd starts when the window rolls over, while the others are running
+  await asyncio.sleep(0.25)
+  await check_stats(mrl, limits, [[1]], [0], [0], 3, set())
+  assert started[2] - start < 0.3
+  await asyncio.gather(*[t.future for t in tickets])
+  await asyncio.sleep(0.2)
+  await check_stats(mrl, limits, [[0]], [0], [0], 0, set())
+  # Refunded at completion
+  started.clear()
+  t0 = mrl.reserve([2], work(0.05, [0]))
+  t1 = mrl.reserve([2], work(0, [2]))
+  await t0.future
+  await t1.future
+  assert started[1] - started[0] < 0.15
+  await check_stats(mrl, limits, [[2]], [0], [0], 0, set())
+  # Additionally charged at completion
+  await asyncio.sleep(0.2)
+  t2 = mrl.reserve([1], work(0, [2]))
+  await t2.future
+  await check_stats(mrl, limits, [[2]], [0], [0], 0, set())
+  await mrl.term()
@@ -1,12 +1,15 @@
+import asyncio
 import os
 import pytest
 import shutil
 
 from aiofiles.os import wrap
 from os.path import isfile
+from typing import List
 
-from multi_rate_limit.rate_limit import RateLimit, SecondRateLimit, MinuteRateLimit, HourRateLimit, DayRateLimit
-from multi_rate_limit.rate_limit import FilePastResourceQueue, IPastResourceQueue, ResourceOverwriteError
+from multi_rate_limit.rate_limit import RateLimit, SecondRateLimit, MinuteRateLimit, HourRateLimit, DayRateLimit, TokenBucketRateLimit
+from multi_rate_limit.rate_limit import ArrayPastResourceQueue, FilePastResourceQueue, IPastResourceQueue, ISyncPastResourceQueue, ResourceOverwriteError
+from multi_rate_limit.rate_limit import FsyncPolicy, JournalPolicy, MmapPastResourceQueue
 
 @pytest.mark.parametrize(
     "limit, period",
@@ -79,6 +82,21 @@ def test_day_rate_limit(limit: int, period: float):
   assert rl.period_in_seconds == 86400 * period
   assert rl.resource_limit == limit
 
+@pytest.mark.parametrize(
+    "limit, period",
+    [
+      (1, 0.5),
+      (4, 3)
+    ]
+)
+def test_token_bucket_rate_limit(limit: int, period: float):
+  rl = TokenBucketRateLimit(limit, period)
+  assert isinstance(rl, RateLimit)
+  assert rl.period_in_seconds == period
+  assert rl.resource_limit == limit
+  with pytest.raises(ValueError):
+    TokenBucketRateLimit(limit, 0)
+
 
 def test_resource_overwrite_error():
   use_time = 100
@@ -94,11 +112,18 @@ def test_resource_overwrite_error():
   assert text.find(str(cause)) >= 0
 
 
+@pytest.mark.parametrize(
+    "queue_class",
+    [
+      ArrayPastResourceQueue,
+      FilePastResourceQueue,
+    ]
+)
 @pytest.mark.asyncio
-async def test_past():
+async def test_past(queue_class):
   # Empty queue
-  queue = FilePastResourceQueue(2, 60)
-  assert len(queue._time_resource_queue) == 1
+  queue = queue_class(2, 60)
+  assert len(queue) == 1
   assert queue.pos_time_after(-0.01) == 0
   assert queue.pos_time_after(0) == 1
   assert await queue.sum_resource_after(-0.01, 0) == 0
@@ -109,7 +134,7 @@ async def test_past():
   assert await queue.time_accum_resource_within(1, 1) == 0
   # Single data queue
   await queue.add(100, [1, 2])
-  assert len(queue._time_resource_queue) == 2
+  assert len(queue) == 2
   assert queue.pos_time_after(-0.01) == 0
   assert queue.pos_time_after(0) == 1
   assert queue.pos_time_after(99) == 1
@@ -128,7 +153,7 @@ async def test_past():
   assert await queue.time_accum_resource_within(1, 2) == 0
   # Single data queue
   await queue.add(200, [1, 10])
-  assert len(queue._time_resource_queue) == 2
+  assert len(queue) == 2
   assert queue.pos_time_after(99) == 0
   assert queue.pos_time_after(100) == 1
   assert queue.pos_time_after(199) == 1
@@ -148,7 +173,7 @@ async def test_past():
   # Single data queue with a added value
   # Total: (200, [3, 10])
   await queue.add(199, [2, 0])
-  assert len(queue._time_resource_queue) == 2
+  assert len(queue) == 2
   assert queue.pos_time_after(99) == 0
   assert queue.pos_time_after(100) == 1
   assert queue.pos_time_after(199) == 1
@@ -169,7 +194,7 @@ async def test_past():
   # Inherited: (200, [3, 10])
   await queue.add(210, [1, 1])
   await queue.add(220, [2, 3])
-  assert len(queue._time_resource_queue) == 4
+  assert len(queue) == 4
   assert queue.pos_time_after(99) == 0
   assert queue.pos_time_after(100) == 1
   assert queue.pos_time_after(199) == 1
@@ -215,22 +240,99 @@ async def test_past_with_file(datadir):
   test_path = (datadir / 'test.tsv')
   await wrap(shutil.copyfile)(original_path, test_path)
   queue = await FilePastResourceQueue.create(2, 60, test_path)
-  assert len(queue._time_resource_queue) == 4
-  assert queue._time_resource_queue[0] == (0, [0, 0])
-  assert queue._time_resource_queue[1] == (100, [1, 10])
-  assert queue._time_resource_queue[2] == (110, [2, 15])
-  assert queue._time_resource_queue[3] == (120, [4, 30])
+  assert len(queue) == 4
+  assert queue[0] == (0, [0, 0])
+  assert queue[1] == (100, [1, 10])
+  assert queue[2] == (110, [2, 15])
+  assert queue[3] == (120, [4, 30])
   await queue.add(175, [10, 30])
   await queue.term()
   queue = await FilePastResourceQueue.create(2, 60, test_path)
-  assert len(queue._time_resource_queue) == 3
-  assert queue._time_resource_queue[0] == (110, [2, 15])
-  assert queue._time_resource_queue[1] == (120, [4, 30])
-  assert queue._time_resource_queue[2] == (175, [14, 60])
+  assert len(queue) == 3
+  assert queue[0] == (110, [2, 15])
+  assert queue[1] == (120, [4, 30])
+  assert queue[2] == (175, [14, 60])
   # Delete the temporary folder just in case
   if await wrap(isfile)(test_path):
     await wrap(os.remove)(test_path)
 
+def read_lines(path) -> List[str]:
+  with open(path) as f:
+    return f.readlines()
+
+@pytest.mark.parametrize(
+    "fsync_policy",
+    [
+      FsyncPolicy.NONE,
+      FsyncPolicy.INTERVAL,
+      FsyncPolicy.EVERY_BATCH,
+    ]
+)
+@pytest.mark.asyncio
+async def test_past_with_journal(datadir, fsync_policy: FsyncPolicy):
+  test_path = (datadir / 'test.tsv')
+  await wrap(shutil.copyfile)(datadir / 'original.tsv', test_path)
+  queue = await FilePastResourceQueue.create(2, 60, test_path, JournalPolicy(3, 0.1, fsync_policy))
+  # Compacted in the background
+  assert len(read_lines(test_path)) == 3
+  await queue._compaction_task
+  assert len(read_lines(test_path)) == 4
+  # Buffered until the flush size
+  await queue.add(130, [1, 1])
+  await queue.add(140, [1, 1])
+  await asyncio.sleep(0)
+  assert len(read_lines(test_path)) == 4
+  await queue.add(150, [1, 1])
+  await asyncio.sleep(0.05)
+  assert read_lines(test_path)[4:] == ['130.0\t5\t31\n', '140.0\t6\t32\n', '150.0\t7\t33\n']
+  # Flushed by the interval
+  await queue.add(160, [1, 1])
+  await asyncio.sleep(0.01)
+  assert len(read_lines(test_path)) == 7
+  await asyncio.sleep(0.2)
+  assert read_lines(test_path)[7:] == ['160.0\t8\t34\n']
+  # Flushed when finished
+  await queue.add(170, [1, 1])
+  await queue.term()
+  assert read_lines(test_path)[8:] == ['170.0\t9\t35\n']
+  queue = await FilePastResourceQueue.create(2, 60, test_path)
+  assert len(queue) == 7
+  assert queue[0] == (110, [2, 15])
+  assert queue[-1] == (170, [9, 35])
+
+@pytest.mark.parametrize(
+    "block_size",
+    [
+      3,
+      65536,
+    ]
+)
+@pytest.mark.asyncio
+async def test_past_tail_read(datadir, block_size: int):
+  test_path = (datadir / 'test.tsv')
+  with open(test_path, 'w') as f:
+    for i in range(1, 1001):
+      f.write(f'{i}\t{i}\t{2 * i}\n')
+  FilePastResourceQueue._READ_BLOCK_SIZE = block_size
+  try:
+    queue = await FilePastResourceQueue.create(2, 60, test_path)
+  finally:
+    FilePastResourceQueue._READ_BLOCK_SIZE = 65536
+  # Only the information within 60 seconds and one baseline are read
+  assert len(queue) == 61
+  assert queue[0] == (940, [940, 1880])
+  assert queue[-1] == (1000, [1000, 2000])
+  # Appended while compacting
+  await queue.add(1001, [1, 1])
+  await queue.add(1002, [1, 1])
+  await queue.term()
+  assert read_lines(test_path) == [f'{float(i)}\t{i}\t{2 * i - (i - 1000 if i > 1000 else 0)}\n' for i in range(942, 1003)]
+  # Broken end of file
+  with open(test_path, 'a') as f:
+    f.write('1003\t1')
+  with pytest.raises(ValueError):
+    await FilePastResourceQueue.create(2, 60, test_path)
+
 @pytest.mark.asyncio
 async def test_past_parse_line():
   queue = await FilePastResourceQueue.create(2, 60)
@@ -248,4 +350,173 @@ async def test_past_parse_line():
 async def test_past_not_found(datadir):
   not_found_file = (datadir / 'not_found.tsv')
   queue = await FilePastResourceQueue.create(2, 60, not_found_file)
-  assert len(queue._time_resource_queue) == 1
+  assert len(queue) == 1
+
+@pytest.mark.asyncio
+async def test_past_compaction():
+  queue = await ArrayPastResourceQueue.create(2, 60)
+  count = 3 * ArrayPastResourceQueue._MIN_COMPACT_SIZE
+  for i in range(1, count + 1):
+    await queue.add(i, [1, 2])
+  # Only the information within 60 seconds and one baseline remain
+  assert len(queue) == 61
+  assert queue[0] == (count - 60, [count - 60, 2 * (count - 60)])
+  assert queue[-1] == (count, [count, 2 * count])
+  assert list(queue)[1] == queue[1]
+  assert len(queue._times) < 2 * ArrayPastResourceQueue._MIN_COMPACT_SIZE
+  with pytest.raises(IndexError):
+    queue[61]
+  with pytest.raises(IndexError):
+    queue[-62]
+  assert queue.pos_time_after(count - 60) == 1
+  assert await queue.sum_resource_after(count - 60, 0) == 60
+  assert await queue.sum_resource_after(count - 10, 1) == 20
+  assert await queue.sum_resource_after(0, 1) == 120
+  assert queue.pos_accum_resouce_within(0, 10) == 50
+  assert await queue.time_accum_resource_within(0, 10) == count - 10
+  assert await queue.time_accum_resource_within(1, 1000) == count - 60
+
+@pytest.mark.asyncio
+async def test_past_mmap(datadir):
+  test_path = (datadir / 'test.bin')
+  queue = await MmapPastResourceQueue.create(2, 60, test_path, 2)
+  assert list(queue) == [(0, [0, 0])]
+  assert await queue.sum_resource_after(-0.01, 0) == 0
+  assert await queue.time_accum_resource_within(1, 1) == 0
+  await queue.add(100, [1, 10])
+  await queue.add(110, [1, 5])
+  await queue.add(109, [0, 0])
+  await queue.add(120, [2, 15])
+  # Grown from the capacity 2, copied to the added half and wrapping around the circular region
+  assert queue._capacity == 4
+  assert queue._head == 2
+  assert list(queue) == [(0, [0, 0]), (100, [1, 10]), (110, [2, 15]), (120, [4, 30])]
+  assert queue.pos_time_after(99) == 1
+  assert queue.pos_time_after(110) == 3
+  assert await queue.sum_resource_after(99, 0) == 4
+  assert await queue.sum_resource_after(110, 1) == 15
+  assert queue.pos_accum_resouce_within(1, 15) == 2
+  assert await queue.time_accum_resource_within(1, 15) == 110
+  assert await queue.time_accum_resource_within(1, 29) == 100
+  # Reuse the slots freed by trimming
+  await queue.add(175, [10, 30])
+  await queue.add(180, [1, 1])
+  assert queue._capacity == 4
+  assert queue._head == 1
+  assert list(queue) == [(120, [4, 30]), (175, [14, 60]), (180, [15, 61])]
+  assert await queue.sum_resource_after(170, 0) == 11
+  assert await queue.sum_resource_after(175, 1) == 1
+  assert await queue.time_accum_resource_within(0, 0) == 180
+  assert await queue.time_accum_resource_within(0, 1) == 175
+  assert await queue.time_accum_resource_within(0, 11) == 120
+  await queue.term()
+  await queue.term()
+  # Reuse without parsing
+  queue = await MmapPastResourceQueue.create(2, 60, test_path)
+  assert list(queue) == [(120, [4, 30]), (175, [14, 60]), (180, [15, 61])]
+  await queue.add(190, [1, 2])
+  await queue.term()
+  queue = await MmapPastResourceQueue.create(2, 10, test_path)
+  assert list(queue) == [(180, [15, 61]), (190, [16, 63])]
+  await queue.term()
+  with pytest.raises(ValueError):
+    await MmapPastResourceQueue.create(3, 60, test_path)
+  with pytest.raises(IndexError):
+    queue = await MmapPastResourceQueue.create(2, 10, test_path)
+    queue[2]
+  await queue.term()
+  # A crash while growing leaves the old layout
+  crash_path = (datadir / 'crash.bin')
+  queue = await MmapPastResourceQueue.create(2, 60, crash_path, 2)
+  await queue.add(100, [1, 10])
+  await queue.add(170, [1, 10])
+  assert queue._head == 1
+  def crash():
+    raise RuntimeError('crash')
+  queue._write_header = crash
+  with pytest.raises(RuntimeError):
+    await queue.add(200, [1, 1])
+  queue._unmap()
+  queue._file.close()
+  queue = await MmapPastResourceQueue.create(2, 60, crash_path)
+  assert list(queue) == [(100, [1, 10]), (170, [2, 20])]
+  await queue.term()
+
+@pytest.mark.asyncio
+async def test_past_mmap_convert(datadir):
+  test_path = (datadir / 'test.bin')
+  await MmapPastResourceQueue.convert_from_tsv(2, 60, datadir / 'original.tsv', test_path)
+  queue = await MmapPastResourceQueue.create(2, 60, test_path)
+  file_queue = await FilePastResourceQueue.create(2, 60, datadir / 'original.tsv')
+  assert list(queue) == list(file_queue)
+  await queue.term()
+  await file_queue.term()
+  # The oldest record kept by trimming is the baseline instead of zeros
+  tsv_path = datadir / 'trimmed.tsv'
+  with open(tsv_path, 'w') as f:
+    f.write('0.0\t0\n100.0\t5\n200.0\t10\n300.0\t15\n')
+  await MmapPastResourceQueue.convert_from_tsv(1, 50, tsv_path, test_path)
+  queue = await MmapPastResourceQueue.create(1, 50, test_path)
+  file_queue = await FilePastResourceQueue.create(1, 50, tsv_path)
+  assert list(queue) == list(file_queue) == [(200.0, [10]), (300.0, [15])]
+  assert await queue.sum_resource_after(260, 0) == await file_queue.sum_resource_after(260, 0) == 5
+  await queue.term()
+  await file_queue.term()
+
+@pytest.mark.asyncio
+async def test_past_sync(datadir):
+  test_path = (datadir / 'test.bin')
+  await MmapPastResourceQueue.convert_from_tsv(2, 60, datadir / 'original.tsv', test_path)
+  queues: List[ISyncPastResourceQueue] = [await MmapPastResourceQueue.create(2, 60, test_path)
+      , await FilePastResourceQueue.create(2, 60, datadir / 'original.tsv')]
+  for queue in queues:
+    assert isinstance(queue, ISyncPastResourceQueue)
+    times = [t for t, _ in queue]
+    for time in [times[0] - 1, *times, (times[0] + times[-1]) / 2, times[-1] + 1]:
+      for order in range(2):
+        assert queue.sum_resource_after_sync(time, order) == await queue.sum_resource_after(time, order)
+    for amount in range(0, 20):
+      for order in range(2):
+        assert queue.time_accum_resource_within_sync(order, amount) == await queue.time_accum_resource_within(order, amount)
+    await queue.term()
+
+@pytest.mark.asyncio
+async def test_past_batch():
+  queue = ArrayPastResourceQueue(2, 60)
+  for i in range(1, 100):
+    await queue.add(i * 0.5, [i % 3, i % 5])
+  times = [[10, 30.2, -1, 30.2, 49.5, 100], [0, 25]]
+  expected_sums = [[await queue.sum_resource_after(t, i) for t in ts] for i, ts in enumerate(times)]
+  amounts = [[0, 5, 5, 40, 1000], [7]]
+  expected_times = [[await queue.time_accum_resource_within(i, a) for a in ams] for i, ams in enumerate(amounts)]
+  # Sorted sweep
+  assert queue.sum_resource_after_batch_sync(times) == expected_sums
+  assert await queue.sum_resource_after_batch(times) == expected_sums
+  assert queue.time_accum_resource_within_batch_sync(amounts) == expected_times
+  assert await queue.time_accum_resource_within_batch(amounts) == expected_times
+  # Default implementations
+  assert ISyncPastResourceQueue.sum_resource_after_batch_sync(queue, times) == expected_sums
+  assert await IPastResourceQueue.sum_resource_after_batch(queue, times) == expected_sums
+  assert ISyncPastResourceQueue.time_accum_resource_within_batch_sync(queue, amounts) == expected_times
+  assert await IPastResourceQueue.time_accum_resource_within_batch(queue, amounts) == expected_times
+
+@pytest.mark.asyncio
+async def test_past_windows():
+  periods = [[1, 5], [5]]
+  queue = ArrayPastResourceQueue(2, 5)
+  queue.set_windows(periods)
+  assert queue.sum_resource_windows_sync(0) == [[0, 0], [0]]
+  current_time = 0
+  for i in range(1, 3000):
+    current_time = i * 0.01
+    await queue.add(current_time, [1, i % 3])
+    # Including jumps forward and backward in time
+    for t in [current_time, current_time + 0.005, current_time + 3, current_time - 2, current_time]:
+      assert queue.sum_resource_windows_sync(t) == queue.sum_resource_after_batch_sync([[t - p for p in ps] for ps in periods])
+  # The arrays have been compacted while the cursors were in use
+  assert len(queue._times) < 3000
+  expected = queue.sum_resource_after_batch_sync([[current_time - p for p in ps] for ps in periods])
+  assert expected[0] == [100, 500]
+  assert queue.sum_resource_windows_sync(current_time) == expected
+  # Default implementation
+  assert ISyncPastResourceQueue.sum_resource_windows_sync(queue, current_time) == expected
@@ -1,10 +1,12 @@
 import asyncio
+import math
 import pytest
+import random
 
-from typing import Any
+from typing import Any, List, Optional
 
 from multi_rate_limit.rate_limit import ResourceOverwriteError
-from multi_rate_limit.resource_queue import CurrentResourceBuffer, NextResourceQueue
+from multi_rate_limit.resource_queue import CreditLedger, CurrentResourceBuffer, NextResourceQueue, TokenBuckets
 
 
 async def wait_and_return(wait_in_seconds: float, result: Any):
@@ -15,6 +17,15 @@ async def wait_and_error(wait_in_seconds: float, error: Exception):
   await asyncio.sleep(wait_in_seconds)
   raise error
 
+def resources_of(buf: CurrentResourceBuffer) -> List[Optional[List[int]]]:
+  return [r.use_resources for r in buf.records]
+
+def tasks_of(buf: CurrentResourceBuffer) -> List[Optional[asyncio.Task]]:
+  return [r.task for r in buf.records]
+
+def futures_of(buf: CurrentResourceBuffer) -> List[Optional[asyncio.Future]]:
+  return [r.future for r in buf.records]
+
 @pytest.mark.asyncio
 async def test_current():
   loop = asyncio.get_running_loop()
@@ -22,10 +33,10 @@ async def test_current():
   buf = CurrentResourceBuffer(2, 2)
   assert buf.is_empty() == True
   assert buf.is_full() == False
-  assert buf.resource_buffer == [None, None]
-  assert buf.task_buffer == [None, None]
-  assert buf.future_buffer == [None, None]
-  assert buf.next == 0
+  assert resources_of(buf) == [None, None]
+  assert tasks_of(buf) == [None, None]
+  assert futures_of(buf) == [None, None]
+  assert buf.free == [1, 0]
   assert buf.active_run == 0
   assert buf.sum_resources == [0, 0]
   # Start a coroutine
@@ -34,24 +45,26 @@ async def test_current():
   assert buf.start_coroutine([1, 2], coro1, f1) == True
   assert buf.is_empty() == False
   assert buf.is_full() == False
-  assert buf.resource_buffer == [[1, 2], None]
-  assert buf.task_buffer[0].get_name() == '0'
-  assert buf.task_buffer[1] is None
-  assert buf.future_buffer[0].done() == False
-  assert buf.future_buffer[1] is None
-  assert buf.next == 1
+  assert resources_of(buf) == [[1, 2], None]
+  assert buf.position(buf.records[0].task) == 0
+  assert buf.records[1].task is None
+  assert buf.records[0].future.done() == False
+  assert buf.records[1].future is None
+  assert buf.free == [1]
   assert buf.active_run == 1
   assert buf.sum_resources == [1, 2]
   # End a coroutine
-  await buf.task_buffer[0]
-  assert buf.end_coroutine(100, buf.task_buffer[0]) == (100, [1, 2])
+  task = buf.records[0].task
+  await task
+  assert buf.end_coroutine(100, task) == (100, [1, 2])
   assert await f1 == 'r1'
   assert buf.is_empty() == True
   assert buf.is_full() == False
-  assert buf.resource_buffer == [None, None]
-  assert buf.task_buffer == [None, None]
-  assert buf.future_buffer == [None, None]
-  assert buf.next == 1
+  assert resources_of(buf) == [None, None]
+  assert tasks_of(buf) == [None, None]
+  assert futures_of(buf) == [None, None]
+  assert buf.free == [1, 0]
+  assert buf.task_positions == {}
   assert buf.active_run == 0
   assert buf.sum_resources == [0, 0]
   # Start many coroutines
@@ -66,41 +79,42 @@ async def test_current():
   assert buf.start_coroutine([3, 4], coro3, f3) == False
   assert buf.is_empty() == False
   assert buf.is_full() == True
-  assert buf.resource_buffer == [[2, 3], [1, 2]]
-  assert buf.task_buffer[0].get_name() == '0'
-  assert buf.task_buffer[1].get_name() == '1'
-  assert buf.future_buffer[0].done() == False
-  assert buf.future_buffer[1].done() == False
-  assert buf.next == 1
+  assert resources_of(buf) == [[1, 2], [2, 3]]
+  assert buf.position(buf.records[0].task) == 0
+  assert buf.position(buf.records[1].task) == 1
+  assert buf.records[0].future.done() == False
+  assert buf.records[1].future.done() == False
+  assert buf.free == []
   assert buf.active_run == 2
   assert buf.sum_resources == [3, 5]
   # End many coroutines
-  await asyncio.wait([*buf.task_buffer, asyncio.create_task(coro3)])
-  assert buf.end_coroutine(100, buf.task_buffer[1]) == (90, [1, 1])
-  assert buf.end_coroutine(100, buf.task_buffer[0]) == (110, [3, 3])
+  tasks = tasks_of(buf)
+  await asyncio.wait([*tasks, asyncio.create_task(coro3)])
+  assert buf.end_coroutine(100, tasks[0]) == (90, [1, 1])
+  assert buf.end_coroutine(100, tasks[1]) == (110, [3, 3])
   assert await f1 == 'r1'
   with pytest.raises(ValueError):
     await f2
   assert buf.is_empty() == True
   assert buf.is_full() == False
-  assert buf.resource_buffer == [None, None]
-  assert buf.task_buffer == [None, None]
-  assert buf.future_buffer == [None, None]
-  assert buf.next == 1
+  assert resources_of(buf) == [None, None]
+  assert tasks_of(buf) == [None, None]
+  assert futures_of(buf) == [None, None]
+  assert buf.free == [0, 1]
   assert buf.active_run == 0
   assert buf.sum_resources == [0, 0]
-  # First In Last Out
+  # Last In First Out
   f1 = loop.create_future()
   coro1 = wait_and_error(0.3, ValueError())
   assert buf.start_coroutine([1, 2], coro1, f1) == True
   assert buf.is_empty() == False
   assert buf.is_full() == False
-  assert buf.resource_buffer == [None, [1, 2]]
-  assert buf.task_buffer[0] is None
-  assert buf.task_buffer[1].get_name() == '1'
-  assert buf.future_buffer[0] is None
-  assert buf.future_buffer[1].done() == False
-  assert buf.next == 0
+  assert resources_of(buf) == [None, [1, 2]]
+  assert buf.records[0].task is None
+  assert buf.position(buf.records[1].task) == 1
+  assert buf.records[0].future is None
+  assert buf.records[1].future.done() == False
+  assert buf.free == [0]
   assert buf.active_run == 1
   assert buf.sum_resources == [1, 2]
   f2 = loop.create_future()
@@ -108,26 +122,27 @@ async def test_current():
   assert buf.start_coroutine([2, 3], coro2, f2) == True
   assert buf.is_empty() == False
   assert buf.is_full() == True
-  assert buf.resource_buffer == [[2, 3], [1, 2]]
-  assert buf.task_buffer[0].get_name() == '0'
-  assert buf.task_buffer[1].get_name() == '1'
-  assert buf.future_buffer[0].done() == False
-  assert buf.future_buffer[1].done() == False
-  assert buf.next == 1
+  assert resources_of(buf) == [[2, 3], [1, 2]]
+  assert buf.position(buf.records[0].task) == 0
+  assert buf.position(buf.records[1].task) == 1
+  assert buf.records[0].future.done() == False
+  assert buf.records[1].future.done() == False
+  assert buf.free == []
   assert buf.active_run == 2
   assert buf.sum_resources == [3, 5]
-  await asyncio.wait([buf.task_buffer[0]])
-  assert buf.end_coroutine(100, buf.task_buffer[0]) == (100, [2, 3])
+  task = buf.records[0].task
+  await asyncio.wait([task])
+  assert buf.end_coroutine(100, task) == (100, [2, 3])
   with pytest.raises(ValueError):
     await f2
   assert buf.is_empty() == False
   assert buf.is_full() == False
-  assert buf.resource_buffer == [None, [1, 2]]
-  assert buf.task_buffer[0] is None
-  assert buf.task_buffer[1].get_name() == '1'
-  assert buf.future_buffer[0] is None
-  assert buf.future_buffer[1].done() == False
-  assert buf.next == 1
+  assert resources_of(buf) == [None, [1, 2]]
+  assert buf.records[0].task is None
+  assert buf.position(buf.records[1].task) == 1
+  assert buf.records[0].future is None
+  assert buf.records[1].future.done() == False
+  assert buf.free == [0]
   assert buf.active_run == 1
   assert buf.sum_resources == [1, 2]
   f2 = loop.create_future()
@@ -135,38 +150,41 @@ async def test_current():
   assert buf.start_coroutine([2, 3], coro2, f2) == True
   assert buf.is_empty() == False
   assert buf.is_full() == True
-  assert buf.resource_buffer == [[2, 3], [1, 2]]
-  assert buf.task_buffer[0].get_name() == '0'
-  assert buf.task_buffer[1].get_name() == '1'
-  assert buf.future_buffer[0].done() == False
-  assert buf.future_buffer[1].done() == False
-  assert buf.next == 1
+  assert resources_of(buf) == [[2, 3], [1, 2]]
+  assert buf.position(buf.records[0].task) == 0
+  assert buf.position(buf.records[1].task) == 1
+  assert buf.records[0].future.done() == False
+  assert buf.records[1].future.done() == False
+  assert buf.free == []
   assert buf.active_run == 2
   assert buf.sum_resources == [3, 5]
-  await asyncio.wait([buf.task_buffer[0]])
-  assert buf.end_coroutine(100, buf.task_buffer[0]) == (100, [2, 3])
+  task = buf.records[0].task
+  await asyncio.wait([task])
+  assert buf.end_coroutine(100, task) == (100, [2, 3])
   with pytest.raises(ValueError):
     await f2
   assert buf.is_empty() == False
   assert buf.is_full() == False
-  assert buf.resource_buffer == [None, [1, 2]]
-  assert buf.task_buffer[0] is None
-  assert buf.task_buffer[1].get_name() == '1'
-  assert buf.future_buffer[0] is None
-  assert buf.future_buffer[1].done() == False
-  assert buf.next == 1
+  assert resources_of(buf) == [None, [1, 2]]
+  assert buf.records[0].task is None
+  assert buf.position(buf.records[1].task) == 1
+  assert buf.records[0].future is None
+  assert buf.records[1].future.done() == False
+  assert buf.free == [0]
   assert buf.active_run == 1
   assert buf.sum_resources == [1, 2]
-  await asyncio.wait([buf.task_buffer[1]])
-  assert buf.end_coroutine(100, buf.task_buffer[1]) == (100, [1, 2])
+  task = buf.records[1].task
+  await asyncio.wait([task])
+  assert buf.end_coroutine(100, task) == (100, [1, 2])
   with pytest.raises(ValueError):
     await f1
   assert buf.is_empty() == True
   assert buf.is_full() == False
-  assert buf.resource_buffer == [None, None]
-  assert buf.task_buffer == [None, None]
-  assert buf.future_buffer == [None, None]
-  assert buf.next == 1
+  assert resources_of(buf) == [None, None]
+  assert tasks_of(buf) == [None, None]
+  assert futures_of(buf) == [None, None]
+  assert buf.free == [0, 1]
+  assert buf.task_positions == {}
   assert buf.active_run == 0
   assert buf.sum_resources == [0, 0]
 
@@ -178,19 +196,34 @@ async def test_current_invalid_resource_overwrite():
   f = loop.create_future()
   coro = wait_and_return(0.01, ((0, 0), None))
   buf.start_coroutine([1, 2], coro, f)
-  await asyncio.wait([buf.task_buffer[0]])
-  assert buf.end_coroutine(100, buf.task_buffer[0]) == (100, [1, 2])
+  task = buf.records[0].task
+  await asyncio.wait([task])
+  assert buf.end_coroutine(100, task) == (100, [1, 2])
   with pytest.raises(TypeError):
     await f
   # With ResourceOverwriteError
   f = loop.create_future()
   coro = wait_and_error(0.01, ResourceOverwriteError(0, [0], Exception()))
   buf.start_coroutine([1, 2], coro, f)
-  await asyncio.wait([buf.task_buffer[1]])
-  assert buf.end_coroutine(100, buf.task_buffer[1]) == (100, [1, 2])
+  task = buf.records[0].task
+  await asyncio.wait([task])
+  assert buf.end_coroutine(100, task) == (100, [1, 2])
   with pytest.raises(ValueError):
     await f
 
+@pytest.mark.asyncio
+async def test_current_done_callback():
+  loop = asyncio.get_running_loop()
+  buf = CurrentResourceBuffer(2, 2)
+  dones = []
+  f = loop.create_future()
+  assert buf.start_coroutine([1, 2], wait_and_return(0.01, (None, 'r')), f, dones.append) == True
+  task = buf.records[0].task
+  await asyncio.sleep(0.05)
+  assert dones == [task]
+  assert buf.end_coroutine(100, dones[0]) == (100, [1, 2])
+  assert await f == 'r'
+
 
 @pytest.mark.asyncio
 async def test_next():
@@ -269,3 +302,231 @@ async def test_next():
   assert queue.pop() == ([4, 5], dummy, f)
   # Avoiding a warning for an unfinished coroutine
   await asyncio.wait([asyncio.create_task(dummy)])
+
+@pytest.mark.asyncio
+async def test_next_push_many():
+  dummy = wait_and_error(0.1, ValueError())
+  f = asyncio.get_running_loop().create_future()
+  queue = NextResourceQueue(2)
+  assert queue.push_many([]) == 0
+  assert queue.is_empty() == True
+  assert queue.sum_resources == [0, 0]
+  assert queue.push([1, 2], dummy, f) == 0
+  assert queue.push_many([([2, 3], dummy, f), ([3, 4], dummy, f)]) == 1
+  assert len(queue.number_to_resource_coro_future) == 3
+  assert queue.next_add == 3
+  assert queue.sum_resources == [6, 9]
+  assert queue.cancel(1) == ([2, 3], dummy, f, False)
+  assert queue.pop() == ([1, 2], dummy, f)
+  assert queue.pop() == ([3, 4], dummy, f)
+  assert queue.is_empty() == True
+  assert queue.sum_resources == [0, 0]
+  # Avoiding a warning for an unfinished coroutine
+  await asyncio.wait([asyncio.create_task(dummy)])
+
+@pytest.mark.asyncio
+async def test_next_priority():
+  dummy = wait_and_error(0.1, ValueError())
+  f = asyncio.get_running_loop().create_future()
+  queue = NextResourceQueue(2)
+  assert queue.push([1, 1], dummy, f) == 0
+  assert queue.push([2, 2], dummy, f, 1) == 1
+  assert queue.push([3, 3], dummy, f, -1) == 2
+  assert queue.push_many([([4, 4], dummy, f), ([5, 5], dummy, f)], -1) == 3
+  assert queue.sum_resources == [15, 15]
+  # The smaller priority first, and FIFO within the same priority
+  assert queue.peek_number() == 2
+  assert queue.next_run == 0
+  assert queue.cancel(3) == ([4, 4], dummy, f, False)
+  assert queue.cancel(2) == ([3, 3], dummy, f, True)
+  assert queue.pop() == ([5, 5], dummy, f)
+  assert queue.push([6, 6], dummy, f, 1) == 5
+  assert queue.pop() == ([1, 1], dummy, f)
+  assert queue.pop() == ([2, 2], dummy, f)
+  assert queue.pop() == ([6, 6], dummy, f)
+  assert queue.pop() is None
+  assert queue.peek() is None
+  assert queue.is_empty() == True
+  assert queue.sum_resources == [0, 0]
+  assert queue.next_run == 6
+  # Avoiding a warning for an unfinished coroutine
+  await asyncio.wait([asyncio.create_task(dummy)])
+
+@pytest.mark.asyncio
+async def test_next_tenant():
+  dummy = wait_and_error(0.1, ValueError())
+  f = asyncio.get_running_loop().create_future()
+  queue = NextResourceQueue(1, [0.1], {'b': 2.0})
+  assert queue.push_many([([10], dummy, f) for _ in range(4)], 0, 'a') == 0
+  assert queue.push_many([([10], dummy, f) for _ in range(3)], 0, 'b') == 4
+  assert queue.push([10], dummy, f, 0, 'b') == 7
+  assert queue.push([1], dummy, f) == 8
+  assert queue.tenant_counts == {'a': 4, 'b': 4}
+  assert queue.tenant_sums == {'a': [40], 'b': [40]}
+  # The tenant with the double weight gets the double share, in order of finish tags and then numbers
+  assert queue.peek_numbers(9) == [8, 4, 0, 5, 6, 1, 7, 2, 3]
+  assert queue.cancel(6) == ([10], dummy, f, False)
+  assert queue.tenant_counts == {'a': 4, 'b': 3}
+  assert queue.tenant_sums == {'a': [40], 'b': [30]}
+  numbers = []
+  while not queue.is_empty():
+    numbers.append(queue.peek_number())
+    queue.pop()
+  assert numbers == [8, 4, 0, 5, 1, 7, 2, 3]
+  assert queue.tenant_counts == {}
+  assert queue.tenant_sums == {}
+  assert queue.sum_resources == [0]
+  # Tags start over when nothing is waiting
+  assert queue.push([10], dummy, f, 0, 'a') == 9
+  assert queue.push([10], dummy, f, 0, 'b') == 10
+  assert queue.peek_numbers(2) == [10, 9]
+  # Avoiding a warning for an unfinished coroutine
+  await asyncio.wait([asyncio.create_task(dummy)])
+
+@pytest.mark.asyncio
+async def test_next_sparse():
+  dummy = wait_and_error(0.1, ValueError())
+  f = asyncio.get_running_loop().create_future()
+  queue = NextResourceQueue(3, [1.0, 0.5, 0.1])
+  # Sparse ones are kept as they are, and summed only where used
+  assert queue.push({2: 10}, dummy, f, 0, 'a') == 0
+  assert queue.push_many([({1: 4}, dummy, f), ([1, 1, 1], dummy, f), ({0: 1, 2: 2}, dummy, f)], 0, 'a') == 1
+  assert queue.sum_resources == [2, 5, 13]
+  assert queue.tenant_sums == {'a': [2, 5, 13]}
+  assert queue.cancel(1) == ({1: 4}, dummy, f, False)
+  assert queue.sum_resources == [2, 1, 13]
+  assert queue.tenant_sums == {'a': [2, 1, 13]}
+  assert queue.pop() == ({2: 10}, dummy, f)
+  assert queue.pop() == ([1, 1, 1], dummy, f)
+  assert queue.pop() == ({0: 1, 2: 2}, dummy, f)
+  assert queue.sum_resources == [0, 0, 0]
+  assert queue.tenant_sums == {}
+  # The cost of a sparse one is its largest used resource multiplied by the scale
+  assert queue.push({0: 1}, dummy, f, 0, 'b') == 4
+  assert queue.push({1: 4}, dummy, f, 0, 'c') == 5
+  assert queue.push([0, 0, 5], dummy, f, 0, 'd') == 6
+  assert queue.peek_numbers(3) == [6, 4, 5]
+  buf = CurrentResourceBuffer(3, 2)
+  assert buf.start_slot({1: 4}) == 0
+  assert buf.start_slot([1, 1, 1]) == 1
+  assert buf.sum_resources == [1, 5, 1]
+  assert buf.end_slot(0) == {1: 4}
+  assert buf.sum_resources == [1, 1, 1]
+  # Avoiding a warning for an unfinished coroutine
+  await asyncio.wait([asyncio.create_task(dummy)])
+
+@pytest.mark.asyncio
+async def test_next_deadline():
+  dummy = wait_and_error(0.1, ValueError())
+  f = asyncio.get_running_loop().create_future()
+  queue = NextResourceQueue(1)
+  assert queue.next_deadline() is None
+  assert queue.push([1], dummy, f, deadline=3.0) == 0
+  assert queue.push([2], dummy, f) == 1
+  assert queue.push_many([([3], dummy, f), ([4], dummy, f)], deadline=2.0) == 2
+  assert queue.deadline(0) == 3.0
+  assert queue.deadline(1) is None
+  assert queue.next_deadline() == 2.0
+  assert queue.cancel(2) == ([3], dummy, f, False)
+  assert queue.next_deadline() == 2.0
+  assert queue.expire(1.9) == []
+  assert queue.expire(2.0) == [(2.0, [4], dummy, f)]
+  assert queue.sum_resources == [3]
+  assert queue.pop() == ([1], dummy, f)
+  assert queue.next_deadline() is None
+  assert queue.expire(10.0) == []
+  assert queue.pop() == ([2], dummy, f)
+  assert queue.is_empty() == True
+  # Avoiding a warning for an unfinished coroutine
+  await asyncio.wait([asyncio.create_task(dummy)])
+
+@pytest.mark.asyncio
+async def test_next_cancel_many():
+  dummy = wait_and_error(0.1, ValueError())
+  f = asyncio.get_running_loop().create_future()
+  queue = NextResourceQueue(1)
+  queue.push_many([([1], dummy, f) for _ in range(100)], 0, 'a')
+  queue.push_many([([1], dummy, f) for _ in range(100)], 1, deadline=1.0)
+  # Canceled numbers are dropped from the flows once they outnumber the waiting ones
+  for number in range(1, 199):
+    assert queue.cancel(number) == ([1], dummy, f, False)
+    assert queue.stale + len(queue.number_to_resource_coro_future) == sum([len(flow) for flow in queue.flows.values()])
+  assert queue.stale < 64
+  assert queue.peek_numbers(3) == [0, 199]
+  assert queue.cancel(0) == ([1], dummy, f, True)
+  assert queue.pop() == ([1], dummy, f)
+  assert queue.pop() is None
+  assert queue.next_deadline() is None
+  assert queue.tenant_counts == {}
+  # Avoiding a warning for an unfinished coroutine
+  await asyncio.wait([asyncio.create_task(dummy)])
+
+@pytest.mark.asyncio
+async def test_current_lazy():
+  loop = asyncio.get_running_loop()
+  buf = CurrentResourceBuffer(2, 2)
+  f1 = loop.create_future()
+  assert buf.start_coroutine([1, 2], lambda: wait_and_return(0.01, (None, 'r')), f1) == True
+  assert buf.active_run == 1
+  assert buf.sum_resources == [1, 2]
+  assert asyncio.iscoroutine(buf.records[0].task.get_coro())
+  # Not started if the function fails
+  f2 = loop.create_future()
+  assert buf.start_coroutine([1, 1], lambda: 'not coroutine', f2) == False
+  with pytest.raises(ValueError):
+    await f2
+  f3 = loop.create_future()
+  def raise_error():
+    raise KeyError()
+  assert buf.start_coroutine([1, 1], raise_error, f3) == False
+  with pytest.raises(KeyError):
+    await f3
+  assert buf.active_run == 1
+  assert buf.sum_resources == [1, 2]
+  await asyncio.sleep(0.05)
+  assert buf.end_coroutine(100, buf.records[0].task) == (100, [1, 2])
+  assert await f1 == 'r'
+
+def test_credit_ledger():
+  ledger = CreditLedger(2, [[1, 10], [10]])
+  assert ledger.window_sums(100) == [[0, 0], [0]]
+  # Out of the shorter window already
+  ledger.add(100, 95, [1, 2])
+  ledger.add(100, 99.5, [3, 4])
+  ledger.add(100, 98, [5, 6])
+  assert ledger.window_sums(100) == [[3, 9], [12]]
+  assert ledger.window_sums(100.5) == [[0, 9], [12]]
+  assert ledger.window_sums(105) == [[0, 8], [10]]
+  assert ledger.window_sums(108) == [[0, 3], [4]]
+  assert ledger.window_sums(200) == [[0, 0], [0]]
+
+def test_token_buckets():
+  # 1 per second with a burst of 2, and 2 per second with a burst of 4, with no bucket for the last resource
+  buckets = TokenBuckets([[2, 4], []], [[2, 2], []])
+  assert buckets.levels(100) == [[0, 0], []]
+  assert buckets.margins(100) == [2, float('inf')]
+  assert buckets.time_to_start([2, 5]) <= 100
+  buckets.add(100, [2, 5])
+  assert buckets.levels(100) == [[2, 2], []]
+  assert buckets.margins(101) == [1, float('inf')]
+  # Room for 2 more when drained by 2 in the first bucket
+  assert buckets.time_to_start([2, 0]) == pytest.approx(102)
+  assert buckets.time_to_start([1, 0]) == pytest.approx(101)
+  # Added at the current time after drained
+  buckets.add(110, [1, 0])
+  assert buckets.levels(110) == [[1, 1], []]
+  buckets.refund([1, 0])
+  assert buckets.levels(110) == [[0, 0], []]
+  buckets.refund([1, 0])
+  assert buckets.margins(110) == [2, float('inf')]
+
+def test_token_buckets_rounding():
+  # At epoch-scale times, the predicted start must be the earliest time when the resources fit
+  rand = random.Random(0)
+  buckets = TokenBuckets([[997]], [[0.7]])
+  for _ in range(1000):
+    buckets.tats = [[1.7e9 + rand.random() * 1000]]
+    sum_resources = [rand.randint(1, 997)]
+    time_to_start = buckets.time_to_start(sum_resources)
+    assert buckets.fits(time_to_start, sum_resources)
+    assert not buckets.fits(math.nextafter(time_to_start, -math.inf), sum_resources)